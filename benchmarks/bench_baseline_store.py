@@ -0,0 +1,90 @@
+"""
+Benchmark comparisons reading baselines from PNG against the raw baseline store
+and a packed baseline archive.
+
+The decoded image cache is disabled so every PNG comparison pays for decoding,
+as it would in a fresh test run.
+
+Example:
+python benchmarks/bench_baseline_store.py --pairs 20 --size 1920 1080
+python benchmarks/bench_baseline_store.py --pairs 2000 --size 64 64
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # type: ignore  # noqa: E402
+
+from mayatest import baseline_store, image_utils  # noqa: E402
+
+
+def make_pairs(directory, count, size):
+    """Write count synthetic expected/actual pairs."""
+    gradient = Image.linear_gradient("L").resize(size)
+    pairs = []
+    for index in range(count):
+        expected = Image.merge("RGB", (gradient, Image.effect_noise(size, 8 + index), gradient.rotate(90)))
+        actual = expected.copy()
+        actual.paste((255, 0, 0), (0, 0, 32, 32))
+        paths = (
+            os.path.join(directory, f"{index:04d}_EXPECTED.png"),
+            os.path.join(directory, f"{index:04d}_ACTUAL.png"),
+        )
+        expected.save(paths[0])
+        actual.save(paths[1])
+        pairs.append(paths)
+    return pairs
+
+
+def run(pairs, backend):
+    """Compare every pair, returning elapsed seconds and the results."""
+    start = time.perf_counter()
+    results = [image_utils.compare_images(expected, actual, backend) for expected, actual in pairs]
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pairs", type=int, default=20)
+    parser.add_argument("--size", type=int, nargs=2, default=(1920, 1080))
+    parser.add_argument("--backend", choices=(image_utils.BACKEND_NUMPY, image_utils.BACKEND_PIL))
+    args = parser.parse_args()
+
+    image_utils.set_image_cache_size(0)
+    with tempfile.TemporaryDirectory() as directory:
+        pairs = make_pairs(directory, args.pairs, tuple(args.size))
+        png_time, png_results = run(pairs, args.backend)
+
+        store = baseline_store.BaselineStore()
+        image_utils.set_baseline_store(store)
+        convert_time, _ = run(pairs, args.backend)
+        raw_time, raw_results = run(pairs, args.backend)
+        store.close()
+
+        start = time.perf_counter()
+        baseline_store.build_archive(directory)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        baseline_store.build_archive(directory)
+        rebuild_time = time.perf_counter() - start
+        store = baseline_store.BaselineStore()
+        image_utils.set_baseline_store(store)
+        archive_time, archive_results = run(pairs, args.backend)
+        store.close()
+        image_utils.set_baseline_store(None)
+
+    print(f"png baselines:        {png_time:7.2f}s")
+    print(f"raw, first run:       {convert_time:7.2f}s  (includes conversion)")
+    print(f"raw, converted:       {raw_time:7.2f}s  ({png_time / raw_time:.2f}x)")
+    print(f"archive build:        {build_time:7.2f}s  (rebuild unchanged {rebuild_time:.2f}s)")
+    print(f"archive:              {archive_time:7.2f}s  ({png_time / archive_time:.2f}x)")
+    print(f"identical results:    {png_results == raw_results == archive_results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark image_utils.compare_many against worker counts on synthetic pairs.
+
+Example:
+python benchmarks/bench_compare_many.py --pairs 200 --size 1920 1080
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # type: ignore  # noqa: E402
+
+from mayatest import image_utils  # noqa: E402
+
+
+def make_pairs(directory, count, size):
+    """Write count synthetic expected/actual pairs and return their paths."""
+    rng = random.Random(0)
+    pairs = []
+    for index in range(count):
+        expected = Image.effect_noise(size, 64).convert("RGB")
+        actual = expected.copy()
+        actual.paste((rng.randrange(256), 0, 0), (0, 0, size[0] // 8, size[1] // 8))
+        expected_path = os.path.join(directory, f"{index:05d}_EXPECTED.png")
+        actual_path = os.path.join(directory, f"{index:05d}_ACTUAL.png")
+        expected.save(expected_path)
+        actual.save(actual_path)
+        pairs.append((expected_path, actual_path))
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pairs", type=int, default=64)
+    parser.add_argument("--size", type=int, nargs=2, default=(1920, 1080))
+    parser.add_argument("--workers", type=int, nargs="+")
+    args = parser.parse_args()
+
+    cpu_count = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({1, 2, 4, cpu_count} & set(range(1, cpu_count + 1)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        pairs = make_pairs(directory, args.pairs, tuple(args.size))
+        baseline = None
+        for workers in worker_counts:
+            start = time.perf_counter()
+            errors = [error for _, _, error in image_utils.compare_many(pairs, workers) if error]
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(
+                f"workers={workers:<3} {elapsed:8.2f}s  {len(pairs) / elapsed:8.1f} pairs/s  "
+                f"speedup={baseline / elapsed:5.2f}x  errors={len(errors)}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark image_utils.find_image_pairs against the previous quadratic pairing.
+
+The directory holds empty files, pairing only looks at names. The previous
+algorithm is only timed up to --legacy-limit files since it grows with the
+square of the file count.
+
+Example:
+python benchmarks/bench_find_pairs.py --files 50000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mayatest import image_index, image_utils  # noqa: E402
+
+
+def legacy_find_image_pairs(directory):
+    """The pairing ContactSheetDialog used before find_image_pairs, for reference."""
+    image_pairs = []
+    image_files = [
+        f
+        for f in os.listdir(directory)
+        if image_index.is_image_file(f) and os.path.isfile(os.path.join(directory, f))
+    ]
+
+    def sort_key(filepath):
+        basename = os.path.basename(filepath)
+        return "ACTUAL" not in basename, basename
+
+    while image_files:
+        file1 = image_files.pop(0)
+        for file2 in image_files[:]:
+            if file1.split("_")[0] == file2.split("_")[0]:
+                image_pair = [os.path.join(directory, file1), os.path.join(directory, file2)]
+                image_pairs.append(sorted(image_pair, key=sort_key))
+                image_files.remove(file2)
+    return image_pairs
+
+
+def make_directory(directory, files):
+    """Create files empty images named as ACTUAL/EXPECTED pairs."""
+    for index in range(files // 2):
+        for variant in ("ACTUAL", "EXPECTED"):
+            open(os.path.join(directory, f"shot{index:06d}_{variant}.png"), "wb").close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, nargs="+", default=[1000, 5000, 50000])
+    parser.add_argument("--legacy-limit", type=int, default=5000)
+    args = parser.parse_args()
+
+    for files in args.files:
+        with tempfile.TemporaryDirectory() as directory:
+            make_directory(directory, files)
+            start = time.perf_counter()
+            pairs = image_utils.find_image_pairs(directory)
+            elapsed = time.perf_counter() - start
+            line = f"files={files:<7} find_image_pairs {elapsed:8.3f}s  pairs={len(pairs)}"
+            if files <= args.legacy_limit:
+                start = time.perf_counter()
+                legacy = legacy_find_image_pairs(directory)
+                legacy_elapsed = time.perf_counter() - start
+                line += f"  legacy {legacy_elapsed:8.3f}s ({legacy_elapsed / elapsed:.0f}x)  pairs={len(legacy)}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
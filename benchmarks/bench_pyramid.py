@@ -0,0 +1,90 @@
+"""
+Benchmark compare_images_pyramid against the full-resolution metric.
+
+Generates identical, subtly different and clearly broken synthetic pairs, then
+reports how often each pyramid level decided the verdict, whether the verdict
+agreed with compare_images, and the time spent by each path.
+
+Example:
+python benchmarks/bench_pyramid.py --pairs 30 --threshold 0.1
+"""
+
+import argparse
+import collections
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # type: ignore  # noqa: E402
+
+from mayatest import image_utils  # noqa: E402
+
+
+def make_pairs(directory, count, size):
+    """Write count synthetic pairs cycling through identical, subtle and broken actuals."""
+    rng = random.Random(0)
+    gradient = Image.linear_gradient("L").resize(size)
+    expected = Image.merge("RGB", (gradient, Image.effect_noise(size, 16), gradient.rotate(90)))
+    pairs = []
+    for index in range(count):
+        actual = expected.copy()
+        kind = index % 3
+        if kind == 1:
+            for _ in range(rng.randrange(1, 20)):
+                x, y = rng.randrange(size[0] - 4), rng.randrange(size[1] - 4)
+                actual.paste((255, 255, 255), (x, y, x + 4, y + 4))
+        elif kind == 2:
+            actual.paste((255, 0, 0), (0, 0, size[0] // 3, size[1] // 3))
+        expected_path = os.path.join(directory, f"{index:04d}_EXPECTED.png")
+        actual_path = os.path.join(directory, f"{index:04d}_ACTUAL.png")
+        expected.save(expected_path)
+        actual.save(actual_path)
+        pairs.append((expected_path, actual_path))
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pairs", type=int, default=30)
+    parser.add_argument("--size", type=int, nargs=2, default=(1920, 1080))
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--band", type=float, default=image_utils.DEFAULT_PYRAMID_BAND)
+    parser.add_argument("--backend", choices=(image_utils.BACKEND_NUMPY, image_utils.BACKEND_PIL))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        pairs = make_pairs(directory, args.pairs, tuple(args.size))
+        levels = collections.Counter()
+        disagreements = 0
+        full_time = pyramid_time = 0.0
+        for expected, actual in pairs:
+            # Decode outside the timed sections so both paths only pay for diffing
+            image_utils.load_image(expected)
+            image_utils.load_image(actual)
+
+            start = time.perf_counter()
+            full = image_utils.compare_images(expected, actual, args.backend)
+            full_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            result = image_utils.compare_images_pyramid(
+                expected, actual, args.threshold, band=args.band, backend=args.backend
+            )
+            pyramid_time += time.perf_counter() - start
+
+            levels[result.level] += 1
+            disagreements += result.passed != (full <= args.threshold)
+
+    print(f"full resolution: {full_time:7.2f}s")
+    print(f"pyramid:         {pyramid_time:7.2f}s  ({full_time / pyramid_time:.2f}x)")
+    for level, count in sorted(levels.items(), reverse=True):
+        print(f"decided at 1/{level}: {count}")
+    print(f"verdicts disagreeing with the full metric: {disagreements} of {len(pairs)}")
+
+
+if __name__ == "__main__":
+    main()
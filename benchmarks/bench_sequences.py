@@ -0,0 +1,78 @@
+"""
+Benchmark image_utils.compare_sequences on a synthetic turntable sequence.
+
+A share of the actual frames are byte-identical copies of the baseline, the
+rest differ in a small region, like a turntable where only a few frames change.
+
+Example:
+python benchmarks/bench_sequences.py --frames 240 --size 1920 1080 --identical 0.75
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # type: ignore  # noqa: E402
+
+from mayatest import image_utils  # noqa: E402
+
+
+def make_sequences(directory, frames, size, identical):
+    """Write expected and actual frame sequences and return their patterns."""
+    rng = random.Random(0)
+    base = Image.effect_noise(size, 64).convert("RGB")
+    for frame in range(1, frames + 1):
+        expected = base.rotate(frame * 360.0 / frames)
+        expected_path = os.path.join(directory, f"turntable_EXPECTED.{frame:04d}.png")
+        actual_path = os.path.join(directory, f"turntable_ACTUAL.{frame:04d}.png")
+        expected.save(expected_path, compress_level=1)
+        if rng.random() < identical:
+            shutil.copyfile(expected_path, actual_path)
+        else:
+            expected.paste((255, 0, 0), (0, 0, size[0] // 16, size[1] // 16))
+            expected.save(actual_path, compress_level=1)
+    return (
+        os.path.join(directory, "turntable_EXPECTED.####.png"),
+        os.path.join(directory, "turntable_ACTUAL.####.png"),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--frames", type=int, default=240)
+    parser.add_argument("--size", type=int, nargs=2, default=(960, 540))
+    parser.add_argument("--identical", type=float, default=0.75, help="Share of byte-identical frames")
+    parser.add_argument("--workers", type=int, nargs="+")
+    args = parser.parse_args()
+
+    cpu_count = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({1, cpu_count})
+
+    with tempfile.TemporaryDirectory() as directory:
+        expected, actual = make_sequences(directory, args.frames, tuple(args.size), args.identical)
+
+        start = time.perf_counter()
+        for frame in range(1, args.frames + 1):
+            image_utils.compare_images(expected.replace("####", f"{frame:04d}"), actual.replace("####", f"{frame:04d}"))
+        serial = time.perf_counter() - start
+        image_utils.image_cache.clear()
+        print(f"compare_images loop      {serial:8.2f}s  {args.frames / serial:8.1f} frames/s")
+
+        for workers in worker_counts:
+            start = time.perf_counter()
+            result = image_utils.compare_sequences(expected, actual, 0.1, workers=workers)
+            elapsed = time.perf_counter() - start
+            print(
+                f"compare_sequences w={workers:<3} {elapsed:8.2f}s  {args.frames / elapsed:8.1f} frames/s  "
+                f"speedup={serial / elapsed:5.2f}x  skipped={len(result.skipped)}  failed={len(result.failed_frames)}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark peak memory of compare_images against compare_images_streaming.
+
+Each measurement runs in a fresh interpreter so the peak resident set size
+only covers one comparison. Requires the resource module (Linux/macOS).
+
+Example:
+python benchmarks/bench_streaming.py --band-height 256
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image  # type: ignore  # noqa: E402
+
+from mayatest import image_utils  # noqa: E402
+
+RESOLUTIONS = {"4K": (3840, 2160), "8K": (7680, 4320)}
+
+
+def make_pair(directory, name, size):
+    """Write a synthetic expected/actual pair of the given size."""
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 32)
+    expected = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.ROTATE_180)))
+    actual = expected.copy()
+    actual.paste((255, 0, 0), (0, 0, size[0] // 4, size[1] // 4))
+    paths = (os.path.join(directory, f"{name}_EXPECTED.png"), os.path.join(directory, f"{name}_ACTUAL.png"))
+    expected.save(paths[0])
+    actual.save(paths[1])
+    return paths
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB."""
+    # ru_maxrss survives exec on Linux, so prefer the per-address-space VmHWM
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def measure(mode, expected_path, actual_path, band_height):
+    """Run one comparison and print the elapsed time, peak RSS in MB and the metric."""
+    start = time.perf_counter()
+    if mode == "full":
+        result = image_utils.compare_images(expected_path, actual_path)
+    else:
+        result = image_utils.compare_images_streaming(expected_path, actual_path, band_height)
+    elapsed = time.perf_counter() - start
+    print(f"{elapsed} {peak_rss_mb()} {result!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--band-height", type=int, default=image_utils.DEFAULT_BAND_HEIGHT)
+    parser.add_argument("--resolutions", nargs="+", default=list(RESOLUTIONS), choices=list(RESOLUTIONS))
+    parser.add_argument("--measure", nargs=3, metavar=("MODE", "EXPECTED", "ACTUAL"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(*args.measure, band_height=args.band_height)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.resolutions:
+            paths = make_pair(directory, name, RESOLUTIONS[name])
+            for mode in ("full", "streaming"):
+                output = subprocess.check_output(
+                    [sys.executable, __file__, "--band-height", str(args.band_height), "--measure", mode] + list(paths),
+                    text=True,
+                )
+                elapsed, peak_mb, result = output.split()
+                print(
+                    f"{name:<3} {mode:<10} {float(elapsed):7.2f}s  peak RSS {float(peak_mb):8.1f} MB  "
+                    f"diff={float(result):.4f}%"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Benchmark suite for the image comparisons, runnable without Maya.
+
+Synthetic pairs are generated at several resolutions, modes and difference
+densities and every comparison target is timed on each of them. Each target
+runs in a fresh interpreter so its peak memory is not skewed by the others.
+Throughput, latency percentiles and peak memory are written as JSON.
+
+With --baseline the run is compared against a saved report and the script
+exits with status 1 when a case's median latency grew by more than
+--tolerance, so a slowdown in a comparison backend fails loudly.
+
+Example:
+python benchmarks/bench_suite.py --output baseline.json
+python benchmarks/bench_suite.py --baseline baseline.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import PIL  # type: ignore  # noqa: E402
+from PIL import Image  # type: ignore  # noqa: E402
+
+from mayatest import image_utils  # noqa: E402
+
+RESOLUTIONS = {"256": (256, 256), "HD": (1920, 1080), "4K": (3840, 2160)}
+MODES = ("RGB", "RGBA")
+# Fraction of pixels that differ between expected and actual
+DENSITIES = (0.0, 0.001, 0.1)
+# Threshold used by the compare_and_assert targets
+THRESHOLD = 0.1
+
+
+def _compare_and_assert(**options):
+    def target(expected, actual):
+        return image_utils.compare_and_assert(expected, actual, THRESHOLD, "benchmark", **options)
+    return target
+
+
+TARGETS = {
+    "compare_images[pil]": lambda expected, actual: image_utils.compare_images(
+        expected, actual, backend=image_utils.BACKEND_PIL
+    ),
+    "compare_images[numpy]": lambda expected, actual: image_utils.compare_images(
+        expected, actual, backend=image_utils.BACKEND_NUMPY
+    ),
+    "compare_images_streaming": image_utils.compare_images_streaming,
+    "compare_and_assert": _compare_and_assert(),
+    "compare_and_assert[early_exit]": _compare_and_assert(early_exit=True),
+    "compare_and_assert[pyramid]": _compare_and_assert(pyramid=True),
+    "compare_and_assert[quick_reject]": _compare_and_assert(quick_reject=True),
+}
+
+
+def make_pair(directory, resolution, mode, density, seed=0):
+    """Write a synthetic pair where about density of the pixels differ and return its paths."""
+    size = RESOLUTIONS[resolution]
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 32).convert("L")
+    bands = [gradient, noise, gradient.transpose(Image.Transpose.ROTATE_180), gradient][: len(mode)]
+    expected = Image.merge(mode, bands)
+
+    # Replace a random subset of the pixels with inverted ones
+    random_bytes = rng.randbytes(size[0] * size[1])
+    cutoff = int(density * 256)
+    mask = Image.frombytes("L", size, random_bytes).point(lambda value: 255 if value < cutoff else 0)
+    inverted = Image.merge(mode, [band.point(lambda value: 255 - value) for band in expected.split()])
+    actual = Image.composite(inverted, expected, mask)
+
+    name = f"{resolution}_{mode}_{density}"
+    paths = (os.path.join(directory, f"{name}_EXPECTED.png"), os.path.join(directory, f"{name}_ACTUAL.png"))
+    expected.save(paths[0], compress_level=1)
+    actual.save(paths[1], compress_level=1)
+    return paths
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB, or None if unknown."""
+    # ru_maxrss survives exec on Linux, so prefer the per-address-space VmHWM
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def measure(target, expected, actual, repeat, warm):
+    """Time one target on one pair in this process and print the measurements as JSON."""
+    function = TARGETS[target]
+    image_utils.set_baseline_store(None)
+    latencies = []
+    for _ in range(repeat):
+        if not warm:
+            image_utils.image_cache.clear()
+            image_utils.normalized_cache.clear()
+        start = time.perf_counter()
+        function(expected, actual)
+        latencies.append(time.perf_counter() - start)
+    print(json.dumps({"latencies": latencies, "peak_rss_mb": peak_rss_mb()}))
+
+
+def run_case(target, expected, actual, repeat, warm):
+    """Measure a target in a fresh interpreter and return its latencies and peak memory."""
+    command = [sys.executable, os.path.abspath(__file__), "--measure", target, expected, actual, "--repeat", str(repeat)]
+    if warm:
+        command.append("--warm")
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    # compare_and_assert prints its verdict, the measurements are the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(name, size, latencies, peak):
+    """Return the report entry of one case."""
+    mean = sum(latencies) / len(latencies)
+    median = percentile(latencies, 0.5)
+    return {
+        "name": name,
+        "repeat": len(latencies),
+        "mean_s": mean,
+        "p50_s": median,
+        "p90_s": percentile(latencies, 0.9),
+        "p99_s": percentile(latencies, 0.99),
+        "pairs_per_s": 1.0 / median if median else None,
+        "megapixels_per_s": size[0] * size[1] / 1e6 / median if median else None,
+        "peak_rss_mb": peak,
+    }
+
+
+def environment():
+    """Return the interpreter and library versions the run was made with."""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "pillow": PIL.__version__,
+        "numpy": image_utils.np.__version__ if image_utils.np is not None else None,
+    }
+
+
+def compare_reports(baseline, report, tolerance):
+    """Print the change of every case against a baseline report and return the names that slowed down."""
+    previous = {case["name"]: case for case in baseline["cases"]}
+    regressions = []
+    for case in report["cases"]:
+        old = previous.get(case["name"])
+        if old is None:
+            continue
+        ratio = case["p50_s"] / old["p50_s"] if old["p50_s"] else 1.0
+        slower = ratio > 1.0 + tolerance
+        if slower:
+            regressions.append(case["name"])
+        print(f"{'SLOWER' if slower else 'ok':<7}{case['name']:<60} {ratio:6.2f}x  p50 {case['p50_s'] * 1000:9.2f}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--resolutions", nargs="+", default=["256", "HD"], choices=list(RESOLUTIONS))
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--densities", nargs="+", type=float, default=list(DENSITIES))
+    parser.add_argument("--targets", nargs="+", default=list(TARGETS), choices=list(TARGETS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warm", action="store_true", help="Keep decoded images cached between repeats")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed median slowdown, 0.2 is 20%%")
+    parser.add_argument("--measure", nargs=3, metavar=("TARGET", "EXPECTED", "ACTUAL"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(*args.measure, repeat=args.repeat, warm=args.warm)
+        return
+
+    targets = [target for target in args.targets if image_utils.np is not None or "numpy" not in target]
+    report = {"environment": environment(), "warm": args.warm, "cases": []}
+    with tempfile.TemporaryDirectory() as directory:
+        for resolution in args.resolutions:
+            for mode in args.modes:
+                for density in args.densities:
+                    expected, actual = make_pair(directory, resolution, mode, density)
+                    for target in targets:
+                        name = f"{target} {resolution} {mode} density={density}"
+                        result = run_case(target, expected, actual, args.repeat, args.warm)
+                        case = summarize(name, RESOLUTIONS[resolution], result["latencies"], result["peak_rss_mb"])
+                        report["cases"].append(case)
+                        print(f"{name:<60} p50 {case['p50_s'] * 1000:9.2f}ms", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(baseline, report, args.tolerance)
+        if regressions:
+            print(f"FAILED: {len(regressions)} case(s) slower than the baseline by more than {args.tolerance:.0%}")
+            for name in regressions:
+                print(f"  {name}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
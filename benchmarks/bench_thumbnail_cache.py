@@ -0,0 +1,58 @@
+"""
+Benchmark building contact sheet thumbnails with a cold and a warm ThumbnailCache.
+
+Example:
+python benchmarks/bench_thumbnail_cache.py --images 50 --size 3840 2160
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # type: ignore  # noqa: E402
+
+from mayatest import thumbnail_cache  # noqa: E402
+
+
+def make_images(directory, count, size):
+    """Write count synthetic captures and return their paths."""
+    base = Image.effect_noise(size, 32).convert("RGB")
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, f"{index:05d}_ACTUAL.png")
+        base.rotate(index).save(path, compress_level=1)
+        paths.append(path)
+    return paths
+
+
+def run(cache, paths, thumb_size):
+    """Build every thumbnail and return the elapsed seconds."""
+    start = time.perf_counter()
+    for path in paths:
+        cache.thumbnail(path, *thumb_size)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", type=int, default=50)
+    parser.add_argument("--size", type=int, nargs=2, default=(3840, 2160))
+    parser.add_argument("--thumb-size", type=int, nargs=2, default=(200, 200))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_images(directory, args.images, tuple(args.size))
+        cache = thumbnail_cache.ThumbnailCache(os.path.join(directory, "thumbnails"))
+        cold = run(cache, paths, args.thumb_size)
+        warm = run(thumbnail_cache.ThumbnailCache(cache.directory), paths, args.thumb_size)
+
+    print(f"first open:   {cold:7.2f}s  {args.images / cold:8.1f} images/s")
+    print(f"second open:  {warm:7.2f}s  {args.images / warm:8.1f} images/s  ({cold / warm:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""
+Memory-mappable raw copies of PNG baseline images.
+
+Decoding reference PNGs dominates comparison time when the same baselines are
+checked on every run. The store converts each baseline once into an
+uncompressed .mtraw file with a small header and serves it afterwards as a
+memory-mapped image_utils.RawImage, so comparisons read the pixels straight from the
+OS page cache. A raw file is rebuilt as soon as its source PNG changes.
+
+Folders of many small baselines can instead be packed into a single archive
+with build_archive: the raw pixels of every image plus an index table mapping
+names to offsets, mapped once. Every comparison reads baselines from the
+archive next to them, with or without a BaselineStore installed and even when
+the PNG itself is gone, and build_archive only decodes images that changed
+since the last build. The archive file and the sources of the images served
+from it are stat'ed at most once per ARCHIVE_CHECK_INTERVAL, so comparing a
+folder of small baselines does not pay a stat per image and comparison.
+
+Example:
+build_archive(REFERENCE_DIR)
+image_utils.set_baseline_store(BaselineStore())
+compare_and_assert(EXPECTED, ACTUAL, 0.1, 'shaded')
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from PIL import Image  # type: ignore
+
+from mayatest.image_index import is_image_file
+from mayatest.image_utils import RawImage, load_image
+
+RAW_EXTENSION = ".mtraw"
+RAW_DIR = ".mayatest_raw"
+RAW_MAGIC = b"MTRAW\x00\x00\x01"
+
+# magic, mode, width, height, source mtime_ns, source size, padded to 64 bytes
+# so the pixel data starts on a cache line
+HEADER = struct.Struct("<8s8sIIqq")
+HEADER_SIZE = 64
+
+# Name of the packed archive written next to the images
+ARCHIVE_FILE = ".mayatest_baselines.mtpack"
+ARCHIVE_MAGIC = b"MTPACK\x00\x01"
+ARCHIVE_VERSION = 1
+# magic, index offset, index length. Images start on 64 byte boundaries
+ARCHIVE_HEADER = struct.Struct("<8sqq")
+ARCHIVE_ALIGNMENT = 64
+# Seconds during which an archive, and whether its images are up to date, is not checked again
+ARCHIVE_CHECK_INTERVAL = 1.0
+
+# Archive path to its BaselineArchive, or None when the directory has none
+_archives = {}
+# Archive path to the time.monotonic() of its last check
+_archive_checks = {}
+_archives_lock = threading.Lock()
+
+
+class RawBaseline(RawImage):
+    """A RawImage backed by a memory-mapped .mtraw file."""
+
+    def __init__(self, path, raw_file, raw_map, header):
+        _, mode, width, height, self.source_mtime_ns, self.source_size = header
+        self.path = path
+        self._file = raw_file
+        self._map = raw_map
+        self._view = memoryview(raw_map)
+        super(RawBaseline, self).__init__(
+            self._view[HEADER_SIZE:], width, height, mode.rstrip(b"\x00").decode()
+        )
+
+    def matches(self, stat):
+        '''Return True if the raw file was converted from a source with this stat.'''
+        return self.source_mtime_ns == stat.st_mtime_ns and self.source_size == stat.st_size
+
+    def close(self):
+        '''Release the mapping. Views handed out earlier must no longer be used.'''
+        try:
+            self.buffer.release()
+            self._view.release()
+            self._map.close()
+        except BufferError:
+            # A cropped or NumPy view still references the map, let the garbage collector close it
+            pass
+        self._file.close()
+
+
+def read_header(raw_file):
+    '''Return the unpacked header of an open .mtraw file, or None if it is not one.'''
+    data = raw_file.read(HEADER_SIZE)
+    if len(data) < HEADER_SIZE:
+        return None
+    header = HEADER.unpack_from(data)
+    if header[0] != RAW_MAGIC:
+        return None
+    return header
+
+
+def write_raw(raw_path, image, stat):
+    '''Write a decoded image and the stat of its source as a .mtraw file.'''
+    header = HEADER.pack(
+        RAW_MAGIC, image.mode.encode(), image.width, image.height, stat.st_mtime_ns, stat.st_size
+    )
+    temp_path = f"{raw_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(header.ljust(HEADER_SIZE, b"\x00"))
+        f.write(image.tobytes())
+    os.replace(temp_path, raw_path)
+
+
+class ArchiveImage(RawImage):
+    """A RawImage whose pixels are a view into a mapped BaselineArchive."""
+
+    def __init__(self, name, buffer, entry, archive):
+        self.name = name
+        self.source_mtime_ns = entry["mtime_ns"]
+        self.source_size = entry["size"]
+        super(ArchiveImage, self).__init__(buffer, entry["width"], entry["height"], entry["mode"], owner=archive)
+
+    def matches(self, stat):
+        '''Return True if the image was packed from a source with this stat.'''
+        return self.source_mtime_ns == stat.st_mtime_ns and self.source_size == stat.st_size
+
+
+class BaselineArchive(object):
+    """A memory-mapped archive of raw baseline images, see build_archive."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            magic, index_offset, index_length = ARCHIVE_HEADER.unpack(self._file.read(ARCHIVE_HEADER.size))
+            if magic != ARCHIVE_MAGIC:
+                raise ValueError(f"Not a baseline archive: {path}")
+            stat = os.fstat(self._file.fileno())
+            self.stat_key = (stat.st_mtime_ns, stat.st_size)
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (struct.error, ValueError):
+            self._file.close()
+            raise ValueError(f"Not a baseline archive: {path}")
+        self._view = memoryview(self._map)
+        index = json.loads(bytes(self._view[index_offset:index_offset + index_length]).decode("utf-8"))
+        if index.get("version") != ARCHIVE_VERSION:
+            self.close()
+            raise ValueError(f"Unsupported baseline archive version: {path}")
+        self.entries = index["entries"]
+        # Name to the image served for it, see current
+        self._current = {}
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def names(self):
+        '''Return the names of the packed images.'''
+        return list(self.entries)
+
+    def data(self, name):
+        '''Return a read-only view of the raw pixels of a packed image.'''
+        entry = self.entries[name]
+        return self._view[entry["offset"]:entry["offset"] + entry["length"]]
+
+    def get(self, name, stat=None):
+        '''Return a packed image as an ArchiveImage, or None if it is missing or stale.
+
+        @param stat: Stat of the source image. When given the image must have been packed from it.
+        '''
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        if stat is not None and (entry["mtime_ns"] != stat.st_mtime_ns or entry["size"] != stat.st_size):
+            return None
+        return ArchiveImage(name, self.data(name), entry, self)
+
+    def current(self, name, source_path):
+        '''Return a packed image if it is up to date with its source or the source is gone, else None.
+
+        The answer is remembered until forget_checks, see get_archive.
+        '''
+        if name in self._current:
+            return self._current[name]
+        try:
+            stat = os.stat(source_path)
+        except FileNotFoundError:
+            stat = None
+        image = self._current[name] = self.get(name, stat)
+        return image
+
+    def forget_checks(self):
+        '''Check the sources of the packed images again on their next use.'''
+        self._current = {}
+
+    def close(self):
+        '''Release the mapping. Images handed out earlier must no longer be used.'''
+        try:
+            self._view.release()
+            self._map.close()
+        except BufferError:
+            # An image still references the map, let the garbage collector close it
+            pass
+        self._file.close()
+
+
+def archive_path(directory):
+    '''Return where the archive of a directory is stored.'''
+    return os.path.join(os.path.abspath(directory), ARCHIVE_FILE)
+
+
+def get_archive(directory):
+    '''Return the shared BaselineArchive of a directory, or None if it has none.
+
+    The archive file is stat'ed at most once per ARCHIVE_CHECK_INTERVAL. It is
+    reopened when it was rebuilt since it was mapped, and the sources of its
+    images are checked again.
+    '''
+    path = archive_path(directory)
+    now = time.monotonic()
+    with _archives_lock:
+        if path in _archive_checks and now - _archive_checks[path] < ARCHIVE_CHECK_INTERVAL:
+            return _archives.get(path)
+        _archive_checks[path] = now
+        archive = _archives.get(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Images handed out earlier still reference the mapping, let the garbage collector close it
+            _archives[path] = None
+            return None
+        if archive is None or archive.stat_key != (stat.st_mtime_ns, stat.st_size):
+            try:
+                archive = BaselineArchive(path)
+            except (OSError, ValueError):
+                archive = None
+            _archives[path] = archive
+        else:
+            archive.forget_checks()
+        return archive
+
+
+def open_archived(source_path):
+    '''Return the image at source_path from its directory's archive, or None if it is not packed there.
+
+    A packed image is only returned if it is up to date with the source file,
+    or if the source file no longer exists. Both are checked at most once per
+    ARCHIVE_CHECK_INTERVAL.
+    '''
+    source_path = os.path.abspath(source_path)
+    archive = get_archive(os.path.dirname(source_path))
+    name = os.path.basename(source_path)
+    if archive is None or name not in archive:
+        return None
+    return archive.current(name, source_path)
+
+
+def build_archive(directory, path=None):
+    '''Pack the images of a directory into an archive and return the names that were decoded.
+
+    Images whose stat matches their entry in the existing archive are copied
+    over without decoding them, so rebuilding after a few changes is cheap.
+    Images whose mode has no raw layout are left out.
+
+    @param directory: Directory holding the baseline images.
+    @param path: Archive file. Defaults to a .mayatest_baselines.mtpack file in the directory.
+    '''
+    directory = os.path.abspath(directory)
+    path = path or archive_path(directory)
+    try:
+        previous = BaselineArchive(path)
+    except (OSError, ValueError):
+        previous = None
+
+    entries = {}
+    decoded = []
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as f, os.scandir(directory) as scan:
+            f.write(b"\x00" * ARCHIVE_ALIGNMENT)
+            for dir_entry in sorted(scan, key=lambda entry: entry.name):
+                if not dir_entry.is_file() or not is_image_file(dir_entry.name):
+                    continue
+                stat = dir_entry.stat()
+                offset = f.tell()
+                old = previous.entries.get(dir_entry.name) if previous else None
+                if old and old["mtime_ns"] == stat.st_mtime_ns and old["size"] == stat.st_size:
+                    f.write(previous.data(dir_entry.name))
+                    entry = dict(old, offset=offset)
+                else:
+                    with Image.open(dir_entry.path) as image:
+                        if image.mode not in RawImage.MODES:
+                            continue
+                        data = image.tobytes()
+                    f.write(data)
+                    entry = {
+                        "mode": image.mode,
+                        "width": image.width,
+                        "height": image.height,
+                        "length": len(data),
+                        "mtime_ns": stat.st_mtime_ns,
+                        "size": stat.st_size,
+                        "offset": offset,
+                    }
+                    decoded.append(dir_entry.name)
+                entries[dir_entry.name] = entry
+                # Pad so the next image starts on a cache line
+                f.write(b"\x00" * (-f.tell() % ARCHIVE_ALIGNMENT))
+
+            index = json.dumps({"version": ARCHIVE_VERSION, "entries": entries}).encode("utf-8")
+            index_offset = f.tell()
+            f.write(index)
+            f.seek(0)
+            f.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, index_offset, len(index)))
+    finally:
+        if previous is not None:
+            previous.close()
+    # Drop the shared mapping so the file can be replaced, get_archive maps the new one
+    with _archives_lock:
+        shared = _archives.pop(path, None)
+        _archive_checks.pop(path, None)
+    if shared is not None:
+        shared.close()
+    os.replace(temp_path, path)
+    return decoded
+
+
+class BaselineStore(object):
+    """Converts PNG baselines to raw files on first use and serves them memory-mapped.
+
+    @param cache_dir: Directory for the raw files. By default they are kept in a
+        .mayatest_raw folder next to each source image.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.conversions = 0
+        self._baselines = {}
+        self._lock = threading.Lock()
+
+    def raw_path(self, source_path):
+        '''Return where the raw copy of a source image is stored.'''
+        source_path = os.path.abspath(source_path)
+        name = os.path.basename(source_path) + RAW_EXTENSION
+        if self.cache_dir is None:
+            return os.path.join(os.path.dirname(source_path), RAW_DIR, name)
+        # Keep raw files of same-named baselines from different folders apart
+        folder = hashlib.sha1(os.path.dirname(source_path).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, folder, name)
+
+    def open(self, source_path):
+        '''Return the baseline at source_path as a memory-mapped RawBaseline.
+
+        An up to date image in the directory's archive is returned as an
+        ArchiveImage instead, and is used even if the source file is missing.
+        Images whose mode has no raw layout are decoded through the image cache.
+        '''
+        source_path = os.path.abspath(source_path)
+        baseline = open_archived(source_path)
+        if baseline is not None:
+            return baseline
+        stat = os.stat(source_path)
+
+        with self._lock:
+            baseline = self._baselines.get(source_path)
+            if baseline is not None:
+                if baseline.matches(stat):
+                    return baseline
+                del self._baselines[source_path]
+                baseline.close()
+
+            raw_path = self.raw_path(source_path)
+            baseline = self._map(raw_path, stat)
+            if baseline is None:
+                with Image.open(source_path) as image:
+                    if image.mode not in RawImage.MODES:
+                        return load_image(source_path)
+                    image.load()
+                    os.makedirs(os.path.dirname(raw_path), exist_ok=True)
+                    write_raw(raw_path, image, stat)
+                self.conversions += 1
+                baseline = self._map(raw_path, stat)
+
+            self._baselines[source_path] = baseline
+            return baseline
+
+    def close(self):
+        '''Release every memory-mapped baseline.'''
+        with self._lock:
+            for baseline in self._baselines.values():
+                baseline.close()
+            self._baselines.clear()
+
+    @staticmethod
+    def _map(raw_path, stat):
+        '''Map an existing raw file if it was converted from a source with this stat.'''
+        try:
+            raw_file = open(raw_path, "rb")
+        except OSError:
+            return None
+        header = read_header(raw_file)
+        if header is None or header[4] != stat.st_mtime_ns or header[5] != stat.st_size:
+            raw_file.close()
+            return None
+        raw_map = mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return RawBaseline(raw_path, raw_file, raw_map, header)
@@ -1,8 +1,24 @@
 """
 Contact Sheet UI
 A tool to compare images in a directory and display them in a contact sheet.
+
+The sheet is a list view over a PairModel. A PairDelegate paints each row, so
+only the rows in the viewport are compared and have their thumbnails decoded.
+Pairs are compared on a QThreadPool, rows painted most recently first, and
+show a grey pending indicator until their score arrives. Thumbnails are
+decoded at reduced size on a QThreadPool, with placeholders painted until they
+arrive, and kept in a thumbnail_cache.ThumbnailCache so reopening a directory
+only decodes the images that changed.
+
+The directory is watched while the dialog is open. Bursts of changes are
+collapsed into one refresh, which re-pairs the directory and only drops the
+scores and thumbnails of the images whose mtime or size changed.
+
+Scores recorded by the test run in the directory's results_manifest are shown
+as they are, only pairs without an up to date result are compared.
 """
 
+import bisect
 import os
 import maya.OpenMayaUI as omui
 # pylint: disable=no-name-in-module
@@ -12,9 +28,16 @@ from mayatest.Qt import (
     QtWidgets,
     QtCompat,
 ) 
-from mayatest.image_utils import compare_images
+from mayatest import baseline_store, results_manifest
+from mayatest.thumbnail_cache import ThumbnailCache
+from mayatest.image_utils import compare_images_grid, find_image_pairs, format_hot_tiles, pair_key
 
-SORT_KEY = "ACTUAL"
+# Minimum QPixmapCache budget in KB while a contact sheet is open
+THUMBNAIL_CACHE_KB = 128 * 1024
+# Most full image sizes remembered for the pixmaps in QPixmapCache
+FULL_SIZES_LIMIT = 100000
+# Quiet time after the last change in the directory before the sheet is refreshed
+REFRESH_DELAY_MS = 500
 
 
 def maya_main_window():
@@ -25,50 +48,523 @@ def maya_main_window():
     return QtCompat.wrapInstance(int(main_window_ptr), QtWidgets.QWidget)
 
 
-class CustomImageWidget(QtWidgets.QWidget):
+def qimage_from_pil(image):
     """
-    A custom widget to display an image with a background color
+    Convert a PIL image into a QImage that owns its own pixel data
     """
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    data = image.tobytes("raw", "RGBA")
+    qimage = QtGui.QImage(
+        data, image.width, image.height, image.width * 4, QtGui.QImage.Format_RGBA8888
+    )
+    # Detach from the bytes object, which Qt does not keep alive
+    return qimage.copy()
 
-    def __init__(self, width, height, image_path, parent=None):
-        super(CustomImageWidget, self).__init__(parent)
-        self.set_size(width, height)
-        self.set_image(image_path)
-        self.set_background_color(QtCore.Qt.black)
 
-    def set_size(self, width, height):
-        self.setFixedSize(width, height)
+def file_stamp(image_path):
+    """
+    Return the (mtime, size) of an image, or None if it does not exist on disk
+    """
+    try:
+        stat = os.stat(image_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
 
-    def set_image(self, image_path):
-        image = QtGui.QImage(image_path)
 
-        # Calculate scaled image size while preserving aspect ratio
-        scaled_image = image.scaled(
-            self.width(),
-            self.height(),
-            QtCore.Qt.KeepAspectRatio,
-            QtCore.Qt.SmoothTransformation,
-        )
+def resolve_image(image_path):
+    """
+    Return the packed copy of an image from its directory's baseline archive, or the path itself
+    """
+    packed = baseline_store.open_archived(image_path)
+    return image_path if packed is None else packed
+
+
+def load_thumbnail(image_path, width, height, cache):
+    """
+    Return the thumbnail QImage and full (width, height) of an image
+
+    Images are read through ThumbnailCache.thumbnail, so reopening a directory
+    only decodes the images that changed. Packed baselines are mapped rather
+    than decoded and are scaled down directly. Safe to call from worker threads.
+    """
+    packed = baseline_store.open_archived(image_path)
+    if packed is not None:
+        # thumbnail() swaps in new pixels, the mapped archive is left untouched
+        image = packed.to_pil()
+        image.thumbnail((width, height))
+        return qimage_from_pil(image), packed.size
+
+    image, full_size = cache.thumbnail(image_path, width, height)
+    return qimage_from_pil(image), full_size
+
+
+# Full size of the source of each thumbnail pixmap, by QPixmapCache key. The
+# cache is shared by the process, so dialogs opened later reuse its pixmaps
+_full_sizes = {}
+
+
+class ThumbnailSignals(QtCore.QObject):
+    """
+    Carries decoded thumbnails from the worker threads back to the UI thread
+    """
+
+    loaded = QtCore.Signal(int, str, object, object, object)
+    failed = QtCore.Signal(int, str, object)
+
+
+class ThumbnailTask(QtCore.QRunnable):
+    """
+    Decodes one thumbnail on a QThreadPool
+    """
+
+    def __init__(self, generation, image_path, stamp, width, height, cache, signals):
+        super(ThumbnailTask, self).__init__()
+        self.generation = generation
+        self.image_path = image_path
+        self.stamp = stamp
+        self.width = width
+        self.height = height
+        self.cache = cache
+        self.signals = signals
+
+    def run(self):
+        try:
+            qimage, full_size = load_thumbnail(self.image_path, self.width, self.height, self.cache)
+        except Exception:  # pylint: disable=broad-except
+            self.signals.failed.emit(self.generation, self.image_path, self.stamp)
+            return
+        self.signals.loaded.emit(self.generation, self.image_path, self.stamp, qimage, full_size)
+
+
+class ScoreSignals(QtCore.QObject):
+    """
+    Carries pair scores from the worker threads back to the UI thread
+    """
+
+    scored = QtCore.Signal(object, object, object, object, object)
+
+
+class ScoreTask(QtCore.QRunnable):
+    """
+    Scores one pair on a QThreadPool, from the results manifest or by comparing its images
+    """
+
+    def __init__(self, entry, signals):
+        super(ScoreTask, self).__init__()
+        self.entry = entry
+        self.request = entry.request
+        self.paths = entry.paths[:2]
+        self.stamps = entry.stamps
+        self.signals = signals
+
+    def run(self):
+        result = grid = error = None
+        try:
+            # Rows list the ACTUAL image first
+            result = results_manifest.lookup(self.paths[1], self.paths[0], self.stamps[::-1])
+            if result is not None and not result["exact"]:
+                # Only a bound on the score was recorded, e.g. by an early exit
+                result = None
+            if result is None:
+                grid = compare_images_grid(resolve_image(self.paths[0]), resolve_image(self.paths[1]))
+        except Exception as e:  # pylint: disable=broad-except
+            error = e
+        self.signals.scored.emit(self.entry, self.request, result, grid, error)
+
+
+class PairEntry(object):
+    """
+    One row of the contact sheet: the images sharing a name prefix and their comparison
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.name = pair_key(os.path.basename(paths[0]))
+        self.reset()
+
+    def reset(self):
+        self.grid = None
+        self.error = None
+        # Result recorded by the test run, used instead of comparing the images
+        self.result = None
+        # (mtime, size) of the compared images when the score was requested
+        self.stamps = None
+        # Token of the queued score task, results of any other task are stale
+        self.request = None
+
+    @property
+    def scored(self):
+        return self.grid is not None or self.error is not None or self.result is not None
+
+    @property
+    def percentage_diff(self):
+        if self.result is not None:
+            return self.result["score"]
+        return None if self.grid is None else self.grid.percentage_diff
+
+    def hot_tiles(self):
+        """
+        Return the (box, percentage) tuples of the most different tiles
+        """
+        if self.result is not None:
+            return [(tuple(box), percentage) for box, percentage in self.result["hot_tiles"]]
+        return [] if self.grid is None else self.grid.hot_tiles()
+
+
+class PairModel(QtCore.QAbstractListModel):
+    """
+    List model of the image pairs of a directory
+
+    Pairs are only compared and their thumbnails only decoded once a view asks
+    for them, so opening a directory costs the same whatever its size.
+    Comparisons run on a thread pool, the last requested first, so the rows in
+    the viewport go ahead of those queued before a scroll. Thumbnails are
+    decoded at reduced size on another pool and the rows showing them are
+    repainted as they arrive.
+
+    update_pairs() applies a new listing of the directory in place: rows are
+    inserted and removed as needed, and only the images whose mtime or size
+    changed since they were compared or decoded lose their score and thumbnail.
+    """
+
+    PAIR_ROLE = QtCore.Qt.UserRole + 1
+
+    def __init__(self, threshold, thumb_width, thumb_height, parent=None):
+        super(PairModel, self).__init__(parent)
+        self.threshold = threshold
+        self.thumb_width = thumb_width
+        self.thumb_height = thumb_height
+        self.entries = []
+        # Full resolution size of each image, used to place hot tiles on thumbnails
+        self.image_sizes = {}
+        # Rows showing each image, to repaint them when its thumbnail arrives
+        self.path_rows = {}
+        self.pending = set()
+        self.failed = set()
+        # (mtime, size) of each image when its thumbnail was queued
+        self.thumbnail_stamps = {}
+        # Results of tasks queued before the last set_pairs are dropped
+        self.generation = 0
+
+        # Thumbnails survive the dialog on disk, so reopening a directory only reads them back
+        self.thumbnail_cache = ThumbnailCache()
+        self.thread_pool = QtCore.QThreadPool(self)
+        self.signals = ThumbnailSignals(self)
+        self.signals.loaded.connect(self.on_thumbnail_loaded)
+        self.signals.failed.connect(self.on_thumbnail_failed)
+
+        # Comparisons get their own pool so cancelling or queueing them does not hold up thumbnails
+        self.score_pool = QtCore.QThreadPool(self)
+        # Grows with every request so the most recently painted rows are scored first
+        self.score_priority = 0
+        self.score_signals = ScoreSignals(self)
+        self.score_signals.scored.connect(self.on_scored)
+
+    def set_pairs(self, pairs):
+        self.cancel()
+        self.beginResetModel()
+        self.generation += 1
+        self.entries = [PairEntry(pair) for pair in pairs]
+        self.image_sizes = {}
+        self.update_path_rows()
+        self.failed = set()
+        self.thumbnail_stamps = {}
+        self.endResetModel()
+
+    def update_pairs(self, pairs):
+        """
+        Apply a new listing of the directory, keeping what is still up to date
+
+        @param pairs: Image groups as returned by find_image_pairs, sorted by name
+        """
+        groups = {pair_key(os.path.basename(pair[0])): pair for pair in pairs}
+        listed = {path for pair in pairs for path in pair}
+
+        # Rows whose images are all gone
+        for row in reversed(range(len(self.entries))):
+            if self.entries[row].name not in groups:
+                self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+                entry = self.entries.pop(row)
+                self.endRemoveRows()
+                for path in entry.paths:
+                    if path not in listed:
+                        self.forget_thumbnail(path)
+
+        changed = set()
+        for row, entry in enumerate(self.entries):
+            paths = groups[entry.name]
+            compared = list(entry.paths[:2])
+            if list(paths) != list(entry.paths):
+                # A variant was added or removed, e.g. a DIFF image was written
+                for path in entry.paths:
+                    if path not in listed:
+                        self.forget_thumbnail(path)
+                entry.paths = paths
+                changed.add(row)
+            if entry.stamps is not None and (
+                list(paths[:2]) != compared or entry.stamps != [file_stamp(path) for path in compared]
+            ):
+                entry.reset()
+                changed.add(row)
+            for path in paths:
+                if path in self.thumbnail_stamps and self.thumbnail_stamps[path] != file_stamp(path):
+                    self.forget_thumbnail(path)
+                    changed.add(row)
+
+        # New groups, inserted where they sort
+        names = [entry.name for entry in self.entries]
+        for name in sorted(set(groups) - set(names)):
+            row = bisect.bisect(names, name)
+            self.beginInsertRows(QtCore.QModelIndex(), row, row)
+            self.entries.insert(row, PairEntry(groups[name]))
+            names.insert(row, name)
+            self.endInsertRows()
+            changed = {index + 1 if index >= row else index for index in changed}
+
+        self.update_path_rows()
+        self.rows_changed(sorted(changed))
+
+    def update_path_rows(self):
+        self.path_rows = {}
+        for row, entry in enumerate(self.entries):
+            for path in entry.paths:
+                self.path_rows.setdefault(path, []).append(row)
+
+    def forget_thumbnail(self, path):
+        """
+        Drop the thumbnail of an image that changed so the next paint decodes it again
+        """
+        if path in self.thumbnail_stamps:
+            QtGui.QPixmapCache.remove(self.thumbnail_key(path, self.thumbnail_stamps.pop(path)))
+        self.image_sizes.pop(path, None)
+        self.pending.discard(path)
+        self.failed.discard(path)
+
+    def thumbnail_key(self, path, stamp):
+        # QPixmapCache outlives the model, the stamp keeps pixmaps of older versions of a file from being hit
+        stamp = "-" if stamp is None else f"{stamp[0]}:{stamp[1]}"
+        return f"{path}|{stamp}|{self.thumb_width}x{self.thumb_height}"
+
+    def cancel(self):
+        """
+        Drop queued comparisons and thumbnail decodes, running ones finish but are ignored
+        """
+        self.score_pool.clear()
+        for entry in self.entries:
+            entry.request = None
+        self.thread_pool.clear()
+        self.pending = set()
+        self.generation += 1
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.entries)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        entry = self.entries[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return entry.name
+        if role == QtCore.Qt.ToolTipRole:
+            lines = list(entry.paths)
+            if len(entry.paths) > 1 and not entry.scored:
+                lines.append("Pending")
+            elif entry.error is not None:
+                lines.append(f"Error: {entry.error}")
+            elif entry.hot_tiles() and not self.passed(entry):
+                lines.append(f"Hot tiles: {format_hot_tiles(entry.hot_tiles())}")
+            if entry.result is not None:
+                lines.append(
+                    f"Recorded by the test run: {entry.result['score']:.2f}% "
+                    f"({entry.result['metric']} metric, threshold {entry.result['threshold']})"
+                )
+            return "\n".join(lines)
+        if role == self.PAIR_ROLE:
+            return entry
+        return None
+
+    def passed(self, entry):
+        # Recorded results keep the verdict of the test run, whose threshold and metric may differ
+        if entry.result is not None:
+            return entry.result["passed"]
+        return entry.percentage_diff is not None and entry.percentage_diff < self.threshold
+
+    def score(self, row):
+        """
+        Return the entry of a row, queueing the comparison of its first two images if needed
+
+        A result the test run recorded for the pair is used as long as neither
+        image changed since.
+        """
+        entry = self.entries[row]
+        if entry.scored or entry.request is not None or len(entry.paths) < 2:
+            return entry
+        # Taken before comparing, so a file rewritten meanwhile is compared again on refresh
+        entry.stamps = [file_stamp(path) for path in entry.paths[:2]]
+        entry.request = object()
+        self.score_priority += 1
+        self.score_pool.start(ScoreTask(entry, self.score_signals), self.score_priority)
+        return entry
+
+    def on_scored(self, entry, request, result, grid, error):
+        # Entries refreshed or cancelled since the task was queued are stale
+        if entry.request is not request:
+            return
+        entry.request = None
+        entry.result = result
+        entry.grid = grid
+        entry.error = error
+        self.rows_changed(self.path_rows.get(entry.paths[0], ()))
+
+    def thumbnail(self, path):
+        """
+        Return the thumbnail of an image, or None while it is being decoded
+        """
+        if path not in self.thumbnail_stamps:
+            # Stat'ed once per model, update_pairs notices when the file changes
+            self.thumbnail_stamps[path] = file_stamp(path)
+        stamp = self.thumbnail_stamps[path]
+        key = self.thumbnail_key(path, stamp)
+        pixmap = QtGui.QPixmap()
+        # Without its full size a pixmap could not show hot tiles, decode it again
+        if key in _full_sizes and QtGui.QPixmapCache.find(key, pixmap):
+            self.image_sizes[path] = _full_sizes[key]
+            return pixmap
+        if path not in self.pending and path not in self.failed:
+            self.pending.add(path)
+            self.thread_pool.start(
+                ThumbnailTask(
+                    self.generation,
+                    path,
+                    stamp,
+                    self.thumb_width,
+                    self.thumb_height,
+                    self.thumbnail_cache,
+                    self.signals,
+                )
+            )
+        return None
+
+    def is_current(self, generation, path, stamp):
+        # Results of tasks queued before a reset, or before their image changed, are dropped
+        return generation == self.generation and self.thumbnail_stamps.get(path) == stamp
+
+    def on_thumbnail_loaded(self, generation, path, stamp, qimage, full_size):
+        if not self.is_current(generation, path, stamp):
+            return
+        self.pending.discard(path)
+        self.image_sizes[path] = full_size
+        key = self.thumbnail_key(path, stamp)
+        if len(_full_sizes) >= FULL_SIZES_LIMIT:
+            _full_sizes.clear()
+        _full_sizes[key] = full_size
+        # QPixmaps can only be created on the UI thread
+        QtGui.QPixmapCache.insert(key, QtGui.QPixmap.fromImage(qimage))
+        self.rows_changed(self.path_rows.get(path, ()))
+
+    def on_thumbnail_failed(self, generation, path, stamp):
+        if not self.is_current(generation, path, stamp):
+            return
+        self.pending.discard(path)
+        self.failed.add(path)
+        self.rows_changed(self.path_rows.get(path, ()))
 
-        self.pixmap = QtGui.QPixmap.fromImage(scaled_image)
-        self.update()
+    def rows_changed(self, rows):
+        for row in rows:
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
 
-    def set_background_color(self, color):
-        self.background_color = color
-        self.update()
 
-    def paintEvent(self, event):
-        painter = QtGui.QPainter(self)
+class PairDelegate(QtWidgets.QStyledItemDelegate):
+    """
+    Paints a contact sheet row: pass/fail indicator, name and one thumbnail per image
 
-        # Fill background with background_color
-        painter.fillRect(0, 0, self.width(), self.height(), self.background_color)
+    Only rows inside the viewport are painted, which is when they get compared
+    and their thumbnails decoded.
+    """
 
-        # Calculate centering offsets
-        x_offset = (self.width() - self.pixmap.width()) // 2
-        y_offset = (self.height() - self.pixmap.height()) // 2
+    INDICATOR_WIDTH = 10
+    LABEL_WIDTH = 50
+    SPACING = 6
+
+    def __init__(self, thumb_width, thumb_height, parent=None):
+        super(PairDelegate, self).__init__(parent)
+        self.thumb_width = thumb_width
+        self.thumb_height = thumb_height
+
+    def sizeHint(self, option, index):
+        entry = index.data(PairModel.PAIR_ROLE)
+        columns = max(len(entry.paths), 2) if entry is not None else 2
+        width = self.INDICATOR_WIDTH + self.LABEL_WIDTH + columns * (self.thumb_width + self.SPACING)
+        return QtCore.QSize(width, self.thumb_height + self.SPACING)
+
+    def paint(self, painter, option, index):
+        model = index.model()
+        entry = model.score(index.row())
+        rect = option.rect
+        painter.save()
+
+        # Pass/fail indicator
+        if len(entry.paths) < 2:
+            color = None
+        elif not entry.scored:
+            # Pending until the comparison comes back from the pool
+            color = QtCore.Qt.gray
+        elif model.passed(entry):
+            color = QtCore.Qt.green
+        else:
+            color = QtCore.Qt.red
+        if color is not None:
+            painter.fillRect(rect.x(), rect.y(), self.INDICATOR_WIDTH, self.thumb_height, color)
+
+        x = rect.x() + self.INDICATOR_WIDTH
+        painter.setPen(option.palette.color(QtGui.QPalette.Text))
+        painter.drawText(
+            QtCore.QRect(x, rect.y(), self.LABEL_WIDTH, self.thumb_height), QtCore.Qt.AlignCenter, entry.name
+        )
+
+        x += self.LABEL_WIDTH
+        hot_tiles = []
+        if entry.scored and not model.passed(entry):
+            hot_tiles = [box for box, _ in entry.hot_tiles()]
+        for path in entry.paths:
+            cell = QtCore.QRect(x, rect.y(), self.thumb_width, self.thumb_height)
+            self.paint_thumbnail(painter, model, path, cell, hot_tiles)
+            x += self.thumb_width + self.SPACING
+        painter.restore()
+
+    def paint_thumbnail(self, painter, model, path, cell, hot_tiles):
+        painter.fillRect(cell, QtCore.Qt.black)
+        pixmap = model.thumbnail(path)
+        if pixmap is None:
+            # Placeholder until the thumbnail arrives
+            painter.setPen(QtCore.Qt.gray)
+            label = "Failed to load" if path in model.failed else "Loading..."
+            painter.drawText(cell, QtCore.Qt.AlignCenter, label)
+            return
 
         # Draw pixmap centered
-        painter.drawPixmap(x_offset, y_offset, self.pixmap)
+        x_offset = cell.x() + (cell.width() - pixmap.width()) // 2
+        y_offset = cell.y() + (cell.height() - pixmap.height()) // 2
+        painter.drawPixmap(x_offset, y_offset, pixmap)
+
+        # Outline the hot tiles of a failing pair, scaled like the pixmap
+        image_size = model.image_sizes.get(path)
+        if hot_tiles and image_size and image_size[0]:
+            scale = pixmap.width() / image_size[0]
+            painter.setPen(QtGui.QPen(QtCore.Qt.red, 2))
+            painter.setBrush(QtCore.Qt.NoBrush)
+            for left, upper, right, lower in hot_tiles:
+                painter.drawRect(
+                    x_offset + int(left * scale),
+                    y_offset + int(upper * scale),
+                    max(int((right - left) * scale), 1),
+                    max(int((lower - upper) * scale), 1),
+                )
 
 
 class ContactSheetDialog(QtWidgets.QDialog):
@@ -92,6 +588,10 @@ class ContactSheetDialog(QtWidgets.QDialog):
         self.image_dir = image_dir
         self.threshold = threshold
 
+        # Keep enough thumbnails for a few screens of rows, the previous limit is restored on close
+        self.previous_cache_limit = QtGui.QPixmapCache.cacheLimit()
+        QtGui.QPixmapCache.setCacheLimit(max(QtGui.QPixmapCache.cacheLimit(), THUMBNAIL_CACHE_KB))
+
         self.create_widgets()
         self.create_layout()
         self.create_connections()
@@ -99,97 +599,104 @@ class ContactSheetDialog(QtWidgets.QDialog):
         self.load_images()
 
     def create_widgets(self):
+        self.browse_btn = QtWidgets.QPushButton("Change Directory...")
         self.close_btn = QtWidgets.QPushButton("Close")
 
         # Create a header layout
         self.header_layout = QtWidgets.QHBoxLayout()
 
-        # Create a scroll area
-        self.scroll_area = QtWidgets.QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-
-        # Create a widget to contain the grid layout
-        self.scroll_widget = QtWidgets.QWidget()
-
-        # Create the grid layout and set it on the scroll widget
-        self.image_layout = QtWidgets.QGridLayout(self.scroll_widget)
-
-        # Set the scroll widget as the widget for the scroll area
-        self.scroll_area.setWidget(self.scroll_widget)
+        # Shown instead of the list when the directory has no pairs
+        self.message_label = QtWidgets.QLabel("No image pairs found in the directory")
+        self.message_label.setAlignment(QtCore.Qt.AlignCenter)
+        self.message_label.hide()
+
+        # Rows are painted by the delegate, only the visible ones ever are
+        self.model = PairModel(self.threshold, self.img_width, self.img_height, self)
+        self.view = QtWidgets.QListView()
+        self.view.setModel(self.model)
+        self.view.setItemDelegate(PairDelegate(self.img_width, self.img_height, self.view))
+        self.view.setUniformItemSizes(True)
+        self.view.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self.view.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+
+        # Tests keep writing images while the sheet is open, a burst of writes
+        # restarts the timer so it only refreshes once things settle
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(REFRESH_DELAY_MS)
 
     def create_layout(self):
         button_layout = QtWidgets.QHBoxLayout()
+        button_layout.addWidget(self.browse_btn)
+        button_layout.addStretch()
         button_layout.addWidget(self.close_btn)
 
         main_layout = QtWidgets.QVBoxLayout(self)
         main_layout.addLayout(self.header_layout)
-        main_layout.addWidget(
-            self.scroll_area
-        )  # Add the scroll area to the main layout
+        main_layout.addWidget(self.message_label)
+        main_layout.addWidget(self.view)
         main_layout.addLayout(button_layout)
 
     def create_connections(self):
+        self.browse_btn.clicked.connect(self.browse_directory)
         self.close_btn.clicked.connect(self.close)
+        self.watcher.directoryChanged.connect(self.refresh_timer.start)
+        self.refresh_timer.timeout.connect(self.refresh)
+
+    def closeEvent(self, event):
+        # Stop decoding thumbnails nobody will see
+        self.refresh_timer.stop()
+        self.model.cancel()
+        QtGui.QPixmapCache.setCacheLimit(self.previous_cache_limit)
+        super(ContactSheetDialog, self).closeEvent(event)
 
     def create_column_headers(self):
         # Create headers for 'Actual' and 'Expected'
-        self.header_layout.addStretch()  # Add stretch before the label
+        self.header_layout.addSpacing(PairDelegate.INDICATOR_WIDTH + PairDelegate.LABEL_WIDTH)
         headers = ["Actual", "Expected"]
         for header in headers:
             header_label = QtWidgets.QLabel(header)
-            header_label.setFixedWidth(self.img_width)  # Set fixed width
+            header_label.setFixedWidth(self.img_width + PairDelegate.SPACING)  # Set fixed width
             header_label.setAlignment(QtCore.Qt.AlignCenter)
-
-            # Add stretch to push headers to the right side
-            self.header_layout.addWidget(header_label, alignment=QtCore.Qt.AlignCenter)
+            self.header_layout.addWidget(header_label)
+        self.header_layout.addStretch()
 
     def load_images(self):
+        if self.watcher.directories():
+            self.watcher.removePaths(self.watcher.directories())
+        if os.path.isdir(self.image_dir):
+            self.watcher.addPath(self.image_dir)
         image_pairs = self.find_image_pairs(self.image_dir)
-        if not image_pairs:
-            label = QtWidgets.QLabel("No image pairs found in the directory")
-            self.image_layout.addWidget(label, 0, 1, QtCore.Qt.AlignCenter)
-            return
-
-        row = 0
-        for pair in image_pairs:
-            # Create the color indicator
-            color_indicator = QtWidgets.QWidget()
-            color_indicator.setFixedSize(
-                10, self.img_height
-            )  # Set fixed size for the indicator
-
-            # Compare images and set background color
-            if len(pair) > 1:  # Ensure there are at least two images to compare
-                threshold = compare_images(pair[0], pair[1])
-                if threshold < self.threshold:
-                    color_indicator.setStyleSheet("background-color: green;")
-                else:
-                    color_indicator.setStyleSheet("background-color: red;")
-            else:
-                color_indicator.setStyleSheet("background-color: none;")
-
-            label = QtWidgets.QLabel(os.path.basename(pair[0]).split("_")[0])
-            # Set a fixed width for the label to make it much smaller
-            label.setFixedWidth(50)
-
-            # Add the color indicator to the layout
-            self.image_layout.addWidget(color_indicator, row, 0)
-            self.image_layout.addWidget(label, row, 1, QtCore.Qt.AlignCenter)
-
-            col = 2
-            for image_path in pair:
-                image_widget = CustomImageWidget(
-                    self.img_width, self.img_height, image_path
-                )
-                self.image_layout.addWidget(image_widget, row, col)
-                col += 1
+        self.show_pairs(image_pairs)
+        # An existing sidecar index still lets identical pairs skip the diff, but it
+        # is not refreshed here since hashing every image would defeat the lazy rows
+        self.model.set_pairs(image_pairs)
+
+    def browse_directory(self):
+        image_dir = QtWidgets.QFileDialog.getExistingDirectory(self, "Select Image Directory", self.image_dir)
+        if image_dir:
+            self.set_directory(image_dir)
+
+    def set_directory(self, image_dir):
+        """
+        Show another directory, dropping the comparisons and thumbnails queued for the current one
+        """
+        self.refresh_timer.stop()
+        self.image_dir = image_dir
+        self.load_images()
 
-            row += 1
+    def refresh(self):
+        """
+        Re-pair the directory after it changed, keeping the rows that are still up to date
+        """
+        image_pairs = self.find_image_pairs(self.image_dir)
+        self.show_pairs(image_pairs)
+        self.model.update_pairs(image_pairs)
 
-        # Adjust column stretch factors to make sure the label and indicator columns stay small
-        self.image_layout.setColumnStretch(0, 0)
-        self.image_layout.setColumnStretch(1, 0)
-        self.image_layout.setColumnStretch(2, 1)
+    def show_pairs(self, image_pairs):
+        self.message_label.setVisible(not image_pairs)
+        self.view.setVisible(bool(image_pairs))
 
     def find_image_pairs(self, directory):
         # Check if directory exists
@@ -197,31 +704,9 @@ class ContactSheetDialog(QtWidgets.QDialog):
             print(f"Error: Directory '{directory}' does not exist.")
             return []
 
-        image_pairs = []
-        image_files = os.listdir(directory)
-        image_files = [
-            f for f in image_files if os.path.isfile(os.path.join(directory, f))
-        ]
-
-        # Define a function to extract the basename and check if it contains 'ACTUAL'
-        def sort_key(filepath):
-            basename = os.path.basename(filepath)
-            return SORT_KEY not in basename, basename
-
-        while image_files:
-            file1 = image_files.pop(0)
-            for file2 in image_files[:]:
-                if file1.split("_")[0] == file2.split("_")[0]:
-                    image_pair = [
-                        os.path.join(directory, file1),
-                        os.path.join(directory, file2),
-                    ]
-                    # Sort image_pair based on custom sort key
-                    sorted_image_pair = sorted(image_pair, key=sort_key)
-                    image_pairs.append(sorted_image_pair)
-                    image_files.remove(file2)
-
-        return image_pairs
+        # Baselines packed into an archive need not exist as separate files
+        archive = baseline_store.get_archive(directory)
+        return find_image_pairs(directory, archive.names() if archive is not None else ())
 
 
 if __name__ == "__main__":
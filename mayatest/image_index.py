@@ -0,0 +1,195 @@
+"""
+Sidecar index of content hashes for a directory of reference images.
+
+For every image the index stores the file stat, a hash of the file bytes, a
+hash of the decoded pixels and a dHash perceptual hash. Comparisons use it to
+recognise byte-identical and pixel-identical pairs without diffing them, and
+the dHash rules out clearly different images before their pixels are hashed.
+Entries are only rehashed when a file's mtime or size changes.
+
+Example:
+index = update_index(REFERENCE_DIR)
+index.entry(os.path.join(REFERENCE_DIR, "cube_EXPECTED.png"))["pixel_hash"]
+"""
+
+import hashlib
+import json
+import os
+import threading
+from PIL import Image  # type: ignore
+
+# Name of the sidecar file written next to the images
+INDEX_FILE = ".mayatest_index.json"
+INDEX_VERSION = 1
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".tga")
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    '''Return the SHA-1 hex digest of the bytes of the file at path.'''
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def pixel_hash(image):
+    '''Return a SHA-1 hex digest of the mode, size and decoded pixels of an image.'''
+    digest = hashlib.sha1(f"{image.mode} {image.width} {image.height}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def dhash(image, hash_size=8):
+    '''Return the difference hash of an image as a hex string.'''
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(small.tobytes())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+def hamming_distance(hash_a, hash_b):
+    '''Return the number of differing bits between two hex hashes.'''
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+
+def is_image_file(name):
+    '''Return True if the file name has a known image extension.'''
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+class ImageIndex(object):
+    """Content hashes of the images in one directory, stored in a JSON sidecar."""
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, INDEX_FILE)
+        self.entries = {}
+        self.dirty = False
+        self._loaded_mtime = None
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        '''Read the sidecar file, starting empty if it is missing or unreadable.'''
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._loaded_mtime = os.stat(self.path).st_mtime_ns
+        except (OSError, ValueError):
+            data = {}
+        if data.get("version") == INDEX_VERSION:
+            self.entries = data.get("entries", {})
+        else:
+            self.entries = {}
+        self.dirty = False
+
+    def save(self):
+        '''Write the sidecar file if any entry changed since it was loaded.'''
+        with self._lock:
+            if not self.dirty:
+                return
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": INDEX_VERSION, "entries": self.entries}, f, indent=1)
+            os.replace(temp_path, self.path)
+            self._loaded_mtime = os.stat(self.path).st_mtime_ns
+            self.dirty = False
+
+    def is_stale(self):
+        '''Return True if another process rewrote the sidecar since it was loaded.'''
+        try:
+            return os.stat(self.path).st_mtime_ns != self._loaded_mtime
+        except OSError:
+            return False
+
+    def current_entry(self, path, stat=None):
+        '''Return the index entry for an image in this directory if it is up to date, else None.'''
+        stat = stat or os.stat(path)
+        entry = self.entries.get(os.path.basename(path))
+        if entry and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            return entry
+        return None
+
+    def entry(self, path, stat=None):
+        '''Return the index entry for an image in this directory, rehashing it if it changed.'''
+        name = os.path.basename(path)
+        stat = stat or os.stat(path)
+        entry = self.current_entry(path, stat)
+        if entry is not None:
+            return entry
+
+        with Image.open(path) as image:
+            image.load()
+            entry = {
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "file_hash": file_hash(path),
+                "pixel_hash": pixel_hash(image),
+                "dhash": dhash(image),
+            }
+        with self._lock:
+            self.entries[name] = entry
+            self.dirty = True
+        return entry
+
+    def update(self):
+        '''Hash new and changed images, drop removed ones and save the sidecar.'''
+        seen = set()
+        with os.scandir(self.directory) as scan:
+            for dir_entry in scan:
+                if not dir_entry.is_file() or not is_image_file(dir_entry.name):
+                    continue
+                seen.add(dir_entry.name)
+                self.entry(dir_entry.path, dir_entry.stat())
+        with self._lock:
+            for name in set(self.entries) - seen:
+                del self.entries[name]
+                self.dirty = True
+        self.save()
+        return self
+
+
+def get_index(directory, create=False):
+    '''Return the shared ImageIndex of a directory.
+
+    @param directory: Directory holding the images.
+    @param create: If False, return None when the directory has no sidecar file yet.
+    '''
+    directory = os.path.abspath(directory)
+    with _indexes_lock:
+        index = _indexes.get(directory)
+        if index is None:
+            if not create and not os.path.isfile(os.path.join(directory, INDEX_FILE)):
+                return None
+            index = _indexes[directory] = ImageIndex(directory)
+        elif not index.dirty and index.is_stale():
+            index.load()
+    return index
+
+
+def update_index(directory):
+    '''Create or incrementally refresh the sidecar index of a directory.'''
+    return get_index(directory, create=True).update()
+
+
+def lookup(path, rehash=True):
+    '''Return the index entry of an image if its directory is indexed, else None.
+
+    @param rehash: If False, return None instead of hashing an image that is new or changed since it was indexed.
+    '''
+    if not is_image_file(path):
+        return None
+    index = get_index(os.path.dirname(path) or os.curdir)
+    if index is None:
+        return None
+    return index.entry(path) if rehash else index.current_entry(path)
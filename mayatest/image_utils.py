@@ -1,41 +1,2038 @@
 """
 Use PIL to compare two images and assert if they are similar within a threshold.
 
+NumPy is used to diff the decoded pixels in bulk when it is installed, otherwise
+the comparison falls back to the pure PIL implementation.
+
+Decoded images are kept in a process-wide LRU cache (image_cache) keyed by path,
+mtime and size so repeated comparisons and the contact sheet do not decode the
+same file twice.
+
+When the expected image's directory has an image_index sidecar, pairs that the
+index proves byte- or pixel-identical are reported as 0% without a diff.
+
+Expected images can be served as memory-mapped raw arrays instead of decoded
+PNGs by installing a baseline_store.BaselineStore with set_baseline_store.
+Baselines packed into their directory's archive with baseline_store.build_archive
+are always read from it, in every comparison mode and even when the PNG is gone,
+see packed_baseline.
+
+Comparisons can be limited to rectangles and/or a binary mask. Only the selected
+pixels are diffed and counted. PNG rows are decoded from the top of the image
+down to the bottom of the selection's bounding box and the rows below it are
+not decoded, so a selection near the top of a render saves the most.
+
+Besides the default mean absolute difference ("mad"), compare_metric and
+compare_and_assert can score pairs with any metric in the METRICS registry,
+see register_metric and select_metric.
+
+Images of different modes, or a baseline a few pixels off the actual size, can
+be normalized before comparing, see load_pair. Normalized baselines are cached
+per target geometry in normalized_cache.
+
+compare_images_grid also returns the difference summed per tile, computed in
+the same pass as the global score, so failures can point at the hot tiles.
+
+When compare_and_assert fails it can write an amplified diff heatmap and a
+side-by-side composite, built from the decoded images on a background writer
+thread (artifact_writer).
+
+Every compare_and_assert on files records its score and verdict in the
+results_manifest of the actual image's directory, so viewers can show the
+results without diffing the pairs again, see set_record_results.
+
+compare_sequences compares two frame sequences, matched by frame number, in
+parallel and can stop at the first failing frame.
+
+find_image_pairs groups the images of a directory by name prefix, e.g. the
+ACTUAL, EXPECTED and DIFF variants of one capture.
+
+Wherever a comparison takes an image path it also accepts an in-memory image:
+a PIL Image, a QImage, a RawImage or NumPy array of 8-bit pixels, or a Maya
+MImage. Captures can then be compared without a PNG round-trip and only
+written to disk when they fail.
+
 Example:
 compare_and_assert(EXPECTED, ACTUAL, 0.1, 'shaded')
 """
 
+import atexit
+import collections
+import ctypes
+import multiprocessing
+import numbers
 import os
-from PIL import Image, ImageChops  # type: ignore
-
-
-def compare_images(expected_image_path, actual_image_path):
-    '''Compare two images and return the percentage difference between them.'''
-    with Image.open(expected_image_path) as expected_image, Image.open(
-        actual_image_path
-    ) as actual_image:
-        # Calculate the difference between images
-        diff = ImageChops.difference(expected_image, actual_image)
-        # Calculate the percentage difference
-        percentage_diff = (
-            sum(sum(pixel) for pixel in diff.getdata())
-            / (255.0 * expected_image.width * expected_image.height)
-        ) * 100
+import queue
+import re
+import struct
+import sys
+import threading
+import zlib
+from concurrent import futures
+from PIL import Image, ImageChops, ImageOps  # type: ignore
+from mayatest import image_index, results_manifest
+
+try:
+    import numpy as np  # type: ignore
+except ImportError:
+    np = None
+
+BACKEND_NUMPY = "numpy"
+BACKEND_PIL = "pil"
+
+# Default byte budget of the decoded image cache
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+
+# Number of prepared region/mask selections kept per process
+SELECTION_CACHE_SIZE = 256
+
+# Name tokens of the images grouped by find_image_pairs, in display order
+PAIR_VARIANTS = ("ACTUAL", "EXPECTED", "DIFF")
+
+# Stages of compare_with_stages, cheapest first
+STAGE_IDENTICAL = "identical"
+STAGE_REJECTED = "rejected"
+STAGE_PRECISE = "precise"
+STAGES = (STAGE_IDENTICAL, STAGE_REJECTED, STAGE_PRECISE)
+
+# Default metric, the channel difference a pixel may have before over_tolerance
+# counts it, the SSIM window size and the number of cached metric results
+DEFAULT_METRIC = "mad"
+DEFAULT_PIXEL_TOLERANCE = 8
+DEFAULT_SSIM_WINDOW = 7
+METRIC_CACHE_SIZE = 4096
+
+# PNG signature and the PIL modes of the 8-bit, non-palette PNG color types
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOR_MODES = {0: "L", 2: "RGB", 4: "LA", 6: "RGBA"}
+
+# Rows decoded at a time by the streaming comparison
+DEFAULT_BAND_HEIGHT = 256
+
+# Reduction factors tried by the pyramid comparison, coarsest first, and how far
+# above the threshold a coarse lower bound must be to fail a pair
+DEFAULT_PYRAMID_LEVELS = (8,)
+DEFAULT_PYRAMID_BAND = 0.05
+
+# Policies for comparing images of different modes or sizes, the resampling
+# filter used on baselines, the largest size change resampled and the byte
+# budget of the normalized baselines cache
+NORMALIZE_MODE = "mode"
+NORMALIZE_SIZE = "size"
+NORMALIZE_POLICIES = (NORMALIZE_MODE, NORMALIZE_SIZE)
+DEFAULT_RESAMPLE = Image.BILINEAR
+DEFAULT_MAX_SIZE_CHANGE = 0.05
+DEFAULT_NORMALIZED_CACHE_BYTES = 128 * 1024 * 1024
+ALPHA_MODES = ("LA", "La", "PA", "RGBA", "RGBa")
+GRAYSCALE_MODES = ("1", "L", "LA", "La", "I", "I;16", "F")
+
+# Edge length in pixels of the tiles of a difference grid and the number of
+# hot tiles a failure message lists
+DEFAULT_TILE_SIZE = 64
+DEFAULT_HOT_TILES = 3
+
+# Factor the heatmap multiplies channel differences by so faint changes show up
+DEFAULT_HEATMAP_GAIN = 8
+
+
+def image_nbytes(image):
+    '''Return roughly how many bytes PIL uses to hold the decoded image.'''
+    # PIL stores single band 8-bit images packed and everything else in 32-bit pixels
+    bytes_per_pixel = 1 if image.mode in ("1", "L", "P") else 4
+    return image.width * image.height * bytes_per_pixel
+
+
+class ImageCache(object):
+    """A thread safe LRU cache of decoded images with a byte budget.
+
+    Entries are keyed by (path, mtime, size) so a file that changes on disk is
+    decoded again instead of being served stale. Cached images are shared and
+    must not be modified by the caller.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._images = collections.OrderedDict()
+        self._keys = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path):
+        '''Return the cache key for the file currently at path.'''
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    def contains(self, path):
+        '''Return True if the current version of the file at path is cached.'''
+        key = self.key(path)
+        with self._lock:
+            return key in self._images
+
+    def get(self, path):
+        '''Return the decoded image at path, decoding it on a miss.'''
+        key = self.key(path)
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+
+        with Image.open(path) as image:
+            image.load()
+        self.put(key, image)
+        return image
+
+    def find(self, key):
+        '''Return the image stored under key, or None.'''
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return image
+
+    def put(self, key, image):
+        '''Store a decoded image, evicting the least recently used ones.'''
+        nbytes = image_nbytes(image)
+        with self._lock:
+            # Drop entries for older versions of the same file
+            old_key = self._keys.get(key[0])
+            if old_key is not None:
+                self._remove(old_key)
+            if nbytes > self.max_bytes:
+                return
+            self._images[key] = image
+            self._keys[key[0]] = key
+            self._nbytes += nbytes
+            self._evict(self.max_bytes)
+
+    def resize(self, max_bytes):
+        '''Change the byte budget, evicting entries that no longer fit.'''
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict(max_bytes)
+
+    def clear(self):
+        '''Drop every cached image and reset the counters.'''
+        with self._lock:
+            self._images.clear()
+            self._keys.clear()
+            self._nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        '''Return the cache counters as a dictionary.'''
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._images),
+                "bytes": self._nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _evict(self, max_bytes):
+        while self._images and self._nbytes > max_bytes:
+            key = next(iter(self._images))
+            self._remove(key)
+            self.evictions += 1
+
+    def _remove(self, key):
+        image = self._images.pop(key, None)
+        if image is not None:
+            self._nbytes -= image_nbytes(image)
+        if self._keys.get(key[0]) == key:
+            del self._keys[key[0]]
+
+
+class RawImage(object):
+    """Uncompressed 8-bit pixels in a buffer, laid out like PIL's raw mode of the same name.
+
+    The buffer is wrapped without copying. NumPy sees it as a (height, width,
+    bands) array view and PIL maps it directly for the modes it can map. owner
+    is kept alive for as long as the RawImage, for buffers that do not hold a
+    reference to the object owning their memory.
+    """
+
+    MODES = ("L", "LA", "RGB", "RGBA", "RGBX")
+
+    def __init__(self, buffer, width, height, mode="RGBA", owner=None):
+        if mode not in self.MODES:
+            raise ValueError(f"Unsupported raw image mode: {mode}")
+        self.buffer = memoryview(buffer).cast("B")
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.owner = owner
+        if len(self.buffer) != width * height * len(mode):
+            raise ValueError(
+                f"Buffer holds {len(self.buffer)} bytes, expected {width * height * len(mode)}"
+            )
+
+    @classmethod
+    def from_array(cls, array):
+        '''Wrap a (height, width) or (height, width, bands) uint8 NumPy array.'''
+        if array.dtype != np.uint8:
+            raise TypeError(f"Expected an array of uint8 pixels, got {array.dtype}")
+        bands = 1 if array.ndim == 2 else array.shape[2]
+        mode = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}[bands]
+        array = np.ascontiguousarray(array)
+        return cls(array, array.shape[1], array.shape[0], mode, owner=array)
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def getbands(self):
+        return tuple(self.mode)
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.frombuffer(self.buffer, dtype=np.uint8)
+        if len(self.mode) == 1:
+            array = array.reshape(self.height, self.width)
+        else:
+            array = array.reshape(self.height, self.width, len(self.mode))
+        if dtype is not None and dtype != array.dtype:
+            return array.astype(dtype)
+        return array.copy() if copy else array
+
+    def tobytes(self):
+        return self.buffer.tobytes()
+
+    def crop(self, box):
+        '''Return a region of the image, without copying when it spans whole rows.'''
+        left, top, right, bottom = box
+        if left == 0 and right == self.width and 0 <= top <= bottom <= self.height:
+            stride = self.width * len(self.mode)
+            return RawImage(
+                self.buffer[top * stride:bottom * stride],
+                self.width,
+                bottom - top,
+                self.mode,
+                owner=self.owner,
+            )
+        return self.to_pil().crop(box)
+
+    def to_pil(self):
+        '''Return the pixels as a PIL image, sharing the buffer when PIL can map the mode.
+
+        The PIL image keeps the RawImage, and so its owner, alive for as long as
+        it may read the buffer.
+        '''
+        image = Image.frombuffer(self.mode, self.size, self.buffer, "raw", self.mode, 0, 1)
+        image._buffer_owner = self
+        return image
+
+
+# Process-wide cache shared by comparisons, baselines and the contact sheet
+image_cache = ImageCache()
+
+# Baselines converted and resampled to the geometry of the images they are compared with
+normalized_cache = ImageCache(DEFAULT_NORMALIZED_CACHE_BYTES)
+
+# Optional store serving expected images as memory-mapped raw arrays
+baseline_store = None
+
+# Whether compare_and_assert appends its results to the results manifest
+record_results = True
+
+
+def set_image_cache_size(max_bytes):
+    """Set the byte budget of the decoded image cache.
+
+    @param max_bytes: Maximum number of bytes of decoded pixels to keep. 0 disables caching.
+    """
+    image_cache.resize(max_bytes)
+
+
+def load_image(path):
+    '''Return the decoded image at path through the shared image cache.'''
+    return image_cache.get(path)
+
+
+def set_baseline_store(store):
+    """Set the store expected images are read from.
+
+    @param store: A baseline_store.BaselineStore, or None to decode expected images directly.
+    """
+    global baseline_store
+    baseline_store = store
+
+
+def set_record_results(enabled):
+    """Set whether compare_and_assert records its results in the results manifest.
+
+    @param enabled: False stops results from being appended to results_manifest sidecars.
+    """
+    global record_results
+    record_results = enabled
+
+
+def packed_baseline(path):
+    '''Return the up to date copy of a baseline in its directory's archive, or None.
+
+    Every read, size and cache key of an expected image path goes through this
+    first, so packed baselines are used even when their PNG is gone.
+    '''
+    # baseline_store builds on this module, so it can only be imported once both are loaded
+    from mayatest.baseline_store import open_archived  # pylint: disable=import-outside-toplevel
+    return open_archived(path)
+
+
+def baseline_key(path):
+    '''Return the (path, mtime_ns, size) cache key of the current version of a baseline file.
+
+    Packed baselines are keyed on the stat of the PNG they were packed from,
+    which then does not need to exist.
+    '''
+    packed = packed_baseline(path)
+    if packed is not None:
+        return os.path.abspath(path), packed.source_mtime_ns, packed.source_size
+    return ImageCache.key(path)
+
+
+def load_baseline(path):
+    '''Return the expected image at path, from its directory's archive or the baseline store when one is set.'''
+    packed = packed_baseline(path)
+    if packed is not None:
+        return packed
+    if baseline_store is not None:
+        return baseline_store.open(path)
+    return load_image(path)
+
+
+def as_image(image):
+    '''Return a PIL Image or RawImage for a path or any supported in-memory image.'''
+    if is_path(image):
+        return load_image(image)
+    if isinstance(image, (Image.Image, RawImage)):
+        return image
+    if np is not None and isinstance(image, np.ndarray):
+        return RawImage.from_array(image)
+    if hasattr(image, "constBits"):
+        return _image_from_qimage(image)
+    if hasattr(image, "getSize") and hasattr(image, "pixels"):
+        return _image_from_mimage(image)
+    raise TypeError(f"Unsupported image type: {type(image).__name__}")
+
+
+def as_baseline(image):
+    '''Like as_image, but paths are read through load_baseline.'''
+    if is_path(image):
+        return load_baseline(image)
+    return as_image(image)
+
+
+def _image_from_qimage(qimage):
+    '''Wrap a QImage as 8-bit RGB or RGBA pixels, without copying when rows are unpadded.'''
+    qimage_class = type(qimage)
+    if qimage.hasAlphaChannel():
+        target_format, mode = qimage_class.Format_RGBA8888, "RGBA"
+    else:
+        target_format, mode = qimage_class.Format_RGB888, "RGB"
+    if qimage.format() != target_format:
+        qimage = qimage.convertToFormat(target_format)
+
+    width, height = qimage.width(), qimage.height()
+    bits = qimage.constBits()
+    if hasattr(bits, "setsize"):
+        # PyQt returns an unsized sip.voidptr
+        bits.setsize(qimage.bytesPerLine() * height)
+    if qimage.bytesPerLine() == width * len(mode):
+        return RawImage(memoryview(bits)[: width * height * len(mode)], width, height, mode, qimage)
+    # Rows are padded to 32 bits, let PIL skip the padding. RGBA rows are mapped
+    # rather than copied, so the image keeps a converted QImage alive
+    image = Image.frombuffer(mode, (width, height), bits, "raw", mode, qimage.bytesPerLine(), 1)
+    image._buffer_owner = qimage
+    return image
+
+
+def _image_from_mimage(mimage):
+    '''Copy the 8-bit RGBA pixels of a Maya MImage into a top-down PIL image.'''
+    width, height = mimage.getSize()
+    size = width * height * 4
+    pixels = mimage.pixels()
+    if isinstance(pixels, int):
+        # API 2.0 returns the address of the pixel data
+        buffer = (ctypes.c_ubyte * size).from_address(pixels)
+    else:
+        buffer = memoryview(pixels).cast("B")[:size]
+    image = RawImage(buffer, width, height, "RGBA", owner=mimage).to_pil()
+    # MImage rows start at the bottom of the image
+    return image.transpose(Image.FLIP_TOP_BOTTOM)
+
+
+def is_path(image):
+    '''Return True if image refers to a file rather than holding pixels.'''
+    return isinstance(image, (str, bytes, os.PathLike))
+
+
+def as_pil(image):
+    '''Return a PIL image for any image object the comparison accepts.'''
+    image = as_image(image)
+    if isinstance(image, RawImage):
+        return image.to_pil()
+    return image
+
+
+def save_image(image, path):
+    '''Write any supported image to path and return the path.'''
+    as_pil(image).save(path)
+    return path
+
+
+def default_backend():
+    '''Return the fastest comparison backend available in this interpreter.'''
+    return BACKEND_NUMPY if np is not None else BACKEND_PIL
+
+
+def _difference_sum_pil(expected_image, actual_image):
+    '''Sum every channel of the absolute difference from the histogram of a PIL difference image.'''
+    diff = ImageChops.difference(as_pil(expected_image), as_pil(actual_image))
+    # One 256 bin histogram per band, single band images included
+    return sum((index % 256) * count for index, count in enumerate(diff.histogram()))
+
+
+def _difference_sum_numpy(expected_image, actual_image):
+    '''Sum every channel of the absolute difference with NumPy.'''
+    if expected_image.mode != actual_image.mode:
+        # Match ImageChops.difference, which refuses to mix modes
+        raise ValueError("images do not match")
+
+    # ImageChops.difference only diffs the overlapping region
+    width = min(expected_image.width, actual_image.width)
+    height = min(expected_image.height, actual_image.height)
+    expected = _signed(np.asarray(expected_image)[:height, :width])
+    actual = _signed(np.asarray(actual_image)[:height, :width])
+    return int(np.abs(expected - actual).sum(dtype=np.int64))
+
+
+def _signed(array):
+    '''Widen an unsigned pixel array so subtraction cannot wrap around.'''
+    if array.dtype == np.bool_:
+        # Mode "1" pixels are 0 or 255 to PIL
+        return array.astype(np.int16) * 255
+    if array.dtype == np.uint8:
+        return array.astype(np.int16)
+    return array.astype(np.int64)
+
+
+def difference_sum(expected_image, actual_image, backend=None):
+    '''Return the summed absolute channel difference of two PIL or raw images.'''
+    backend = backend or default_backend()
+    if backend == BACKEND_NUMPY:
+        if np is None:
+            raise RuntimeError("The numpy backend requires numpy to be installed.")
+        return _difference_sum_numpy(expected_image, actual_image)
+    if backend == BACKEND_PIL:
+        return _difference_sum_pil(expected_image, actual_image)
+    raise ValueError(f"Invalid backend: {backend}")
+
+
+def percentage_from_sum(total, width, height):
+    '''Convert a summed channel difference into the percentage metric.'''
+    return (total / (255.0 * width * height)) * 100
+
+
+def is_identical_by_index(expected_image_path, actual_image_path):
+    '''Return True if the image index proves both images hold the same pixels.
+
+    Only applies when the expected image's directory is indexed. Actual images
+    are never added to an index. One with an up to date entry is checked against
+    its stored hashes, any other is hashed on the fly by file bytes. Failing that
+    it is decoded through the image cache, so the diff that usually follows
+    reuses it, and a differing dHash rules it out before its pixels are hashed.
+    '''
+    if not is_path(expected_image_path):
+        return False
+    try:
+        expected_entry = image_index.lookup(expected_image_path)
+    except FileNotFoundError:
+        # A packed baseline whose PNG is gone cannot be hashed
+        return False
+    if expected_entry is None:
+        return False
+
+    if is_path(actual_image_path):
+        actual_entry = image_index.lookup(actual_image_path, rehash=False)
+        if actual_entry is not None:
+            return (
+                actual_entry["file_hash"] == expected_entry["file_hash"]
+                or actual_entry["pixel_hash"] == expected_entry["pixel_hash"]
+            )
+        if image_index.file_hash(actual_image_path) == expected_entry["file_hash"]:
+            return True
+    actual_image = as_image(actual_image_path)
+    if image_index.dhash(as_pil(actual_image)) != expected_entry["dhash"]:
+        return False
+    return image_index.pixel_hash(actual_image) == expected_entry["pixel_hash"]
+
+
+class Selection(object):
+    """The pixels of an image selected by rectangles and an optional mask.
+
+    box is the bounding box of the selection, mask an "L" image the size of
+    box that is 255 on selected pixels, or None when the whole box is
+    selected, and count the number of selected pixels.
+    """
+
+    def __init__(self, box, mask, count):
+        self.box = box
+        self.mask = mask
+        self.count = count
+
+
+_selection_cache = collections.OrderedDict()
+_selection_lock = threading.Lock()
+
+
+def _is_box(region):
+    # NumPy integers count too, e.g. a box sliced from an array
+    return len(region) == 4 and all(isinstance(value, numbers.Integral) for value in region)
+
+
+def _boxes(region):
+    '''Return a box or a list of boxes as a list of tuples of ints.'''
+    if _is_box(region):
+        region = [region]
+    return [tuple(int(value) for value in box) for box in region]
+
+
+def prepare_selection(size, region=None, mask=None):
+    '''Build the Selection of an image of the given size.
+
+    @param size: (width, height) of the images being compared.
+    @param region: A (left, top, right, bottom) box or a list of boxes. Defaults to the whole image.
+    @param mask: Path or image the size of the image, non-zero where pixels are compared.
+    '''
+    width, height = size
+    if region is None:
+        boxes = [(0, 0, width, height)]
+    else:
+        boxes = _boxes(region)
+
+    # Clip the boxes to the image and drop the empty ones
+    boxes = [
+        (max(left, 0), max(top, 0), min(right, width), min(bottom, height))
+        for left, top, right, bottom in boxes
+    ]
+    boxes = [box for box in boxes if box[0] < box[2] and box[1] < box[3]]
+    if not boxes:
+        return Selection((0, 0, 0, 0), None, 0)
+
+    bbox = (
+        min(box[0] for box in boxes),
+        min(box[1] for box in boxes),
+        max(box[2] for box in boxes),
+        max(box[3] for box in boxes),
+    )
+    if len(boxes) == 1 and mask is None:
+        return Selection(bbox, None, (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]))
+
+    selected = Image.new("L", (bbox[2] - bbox[0], bbox[3] - bbox[1]), 0)
+    for left, top, right, bottom in boxes:
+        selected.paste(255, (left - bbox[0], top - bbox[1], right - bbox[0], bottom - bbox[1]))
+    if mask is not None:
+        mask_image = as_pil(mask).convert("L").crop(bbox).point(lambda value: 255 if value else 0)
+        selected = ImageChops.multiply(selected, mask_image)
+    return Selection(bbox, selected, selected.histogram()[255])
+
+
+def _source_key(image, baseline=False):
+    '''Return a key identifying the current content of a file, or None for in-memory images.'''
+    if image is None:
+        return ()
+    if is_path(image):
+        return baseline_key(image) if baseline else ImageCache.key(image)
+    return None
+
+
+def _region_key(region):
+    if region is None:
+        return None
+    return tuple(_boxes(region))
+
+
+def selection_for(expected_image_path, size, region=None, mask=None):
+    '''Return the Selection for a reference image, cached while the reference and mask are unchanged.'''
+    expected_key = _source_key(expected_image_path, baseline=True)
+    mask_key = _source_key(mask)
+    if expected_key is None or mask_key is None:
+        return prepare_selection(size, region, mask)
+
+    key = (expected_key, tuple(size), _region_key(region), mask_key)
+    with _selection_lock:
+        selection = _selection_cache.get(key)
+        if selection is not None:
+            _selection_cache.move_to_end(key)
+            return selection
+
+    selection = prepare_selection(size, region, mask)
+    with _selection_lock:
+        _selection_cache[key] = selection
+        while len(_selection_cache) > SELECTION_CACHE_SIZE:
+            _selection_cache.popitem(last=False)
+    return selection
+
+
+def image_size(image, baseline=False):
+    '''Return the (width, height) of an image path or object, reading only the header of files.
+
+    @param baseline: Look the image up with packed_baseline first.
+    '''
+    if is_path(image):
+        packed = packed_baseline(image) if baseline else None
+        if packed is not None:
+            return packed.size
+        if image_cache.contains(image):
+            return load_image(image).size
+        with Image.open(image) as opened:
+            return opened.size
+    return as_image(image).size
+
+
+def load_region(image, box, baseline=False):
+    '''Return the box region of an image.
+
+    PNG files are decoded band by band from the top and decoding stops at the
+    bottom of the box. Rows above the box are still decoded, rows below it are not.
+    '''
+    if (
+        not is_path(image)
+        or (baseline and (baseline_store or packed_baseline(image) is not None))
+        or image_cache.contains(image)
+    ):
+        loaded = as_baseline(image) if baseline else as_image(image)
+        return loaded.crop(box)
+
+    left, top, right, bottom = box
+    size, bands = open_bands(image)
+    region = None
+    band_top = 0
+    for band in bands:
+        band_bottom = band_top + band.height
+        if band_bottom > top:
+            if region is None:
+                region = Image.new(band.mode, (size[0], bottom - top))
+            region.paste(band, (0, band_top - top))
+        band_top = band_bottom
+        if band_top >= bottom:
+            break
+    bands.close()
+    return region.crop((left, 0, right, bottom - top))
+
+
+def masked_difference_sum(expected_image, actual_image, mask, backend=None):
+    '''Return the summed absolute channel difference over the pixels where mask is 255.'''
+    backend = backend or default_backend()
+    if backend == BACKEND_NUMPY and np is not None:
+        if expected_image.mode != actual_image.mode:
+            raise ValueError("images do not match")
+        diff = np.abs(_signed(np.asarray(expected_image)) - _signed(np.asarray(actual_image)))
+        return int(diff[np.asarray(mask) == 255].sum(dtype=np.int64))
+
+    # Histogram the difference under the mask, entirely inside PIL
+    diff = ImageChops.difference(as_pil(expected_image), as_pil(actual_image))
+    histogram = diff.histogram(mask)
+    return sum((index % 256) * count for index, count in enumerate(histogram))
+
+
+def compare_selection(expected_image_path, actual_image_path, region=None, mask=None, backend=None):
+    '''Return the percentage difference over the pixels selected by region and mask.'''
+    expected_size = image_size(expected_image_path, baseline=True)
+    actual_size = image_size(actual_image_path)
+    # Only the overlapping area of both images can be selected
+    overlap = (min(expected_size[0], actual_size[0]), min(expected_size[1], actual_size[1]))
+    selection = selection_for(expected_image_path, overlap, region, mask)
+    if not selection.count:
+        return 0.0
+
+    expected_region = load_region(expected_image_path, selection.box, baseline=True)
+    actual_region = load_region(actual_image_path, selection.box)
+    if selection.mask is None:
+        total = difference_sum(expected_region, actual_region, backend)
+    else:
+        total = masked_difference_sum(expected_region, actual_region, selection.mask, backend)
+    return (total / (255.0 * selection.count)) * 100
+
+
+def common_mode(expected_mode, actual_mode):
+    '''Return the mode two images are converted to before comparing them.
+
+    Alpha and color are kept when either image has them, so nothing the other
+    image holds is thrown away.
+    '''
+    if expected_mode == actual_mode:
+        return expected_mode
+    modes = (expected_mode, actual_mode)
+    alpha = any(mode in ALPHA_MODES for mode in modes)
+    color = any(mode not in GRAYSCALE_MODES for mode in modes)
+    if color:
+        return "RGBA" if alpha else "RGB"
+    return "LA" if alpha else "L"
+
+
+def normalized_baseline(expected_image_path, mode, size, resample=DEFAULT_RESAMPLE):
+    '''Return the expected image converted to mode and resampled to size.
+
+    Baselines read from a path are kept in normalized_cache, keyed on the file
+    and the target geometry, so they are only converted once per geometry.
+    '''
+    size = tuple(size)
+    key = None
+    if is_path(expected_image_path):
+        path, mtime_ns, file_size = baseline_key(expected_image_path)
+        key = ((path, mode, size, resample), mtime_ns, file_size)
+        image = normalized_cache.find(key)
+        if image is not None:
+            return image
+
+    image = as_pil(as_baseline(expected_image_path))
+    if image.mode != mode:
+        image = image.convert(mode)
+    if image.size != size:
+        image = image.resize(size, resample)
+    if key is not None:
+        normalized_cache.put(key, image)
+    return image
+
+
+def load_pair(expected_image_path, actual_image_path, normalize=None, max_size_change=DEFAULT_MAX_SIZE_CHANGE):
+    '''Return the expected and actual image of a pair, normalized as the policy allows.
+
+    @param normalize: None to compare the images as they are, NORMALIZE_MODE to
+        convert both to a common mode, or NORMALIZE_SIZE to also resample the
+        expected image to the size of the actual image.
+    @param max_size_change: Largest fraction of the actual width or height the
+        sizes may differ by before NORMALIZE_SIZE refuses to resample.
+    '''
+    if normalize not in (None,) + NORMALIZE_POLICIES:
+        raise ValueError(f"Invalid normalize policy: {normalize}")
+
+    expected_image = as_baseline(expected_image_path)
+    actual_image = as_image(actual_image_path)
+    if normalize is None:
+        return expected_image, actual_image
+
+    expected_size = expected_image.size
+    mode = common_mode(expected_image.mode, actual_image.mode)
+    size = expected_size
+    if normalize == NORMALIZE_SIZE and expected_size != actual_image.size:
+        for expected_length, actual_length in zip(expected_size, actual_image.size):
+            if abs(expected_length - actual_length) > max_size_change * actual_length:
+                raise ValueError(
+                    f"Image sizes differ too much to resample: {expected_size} and {actual_image.size}"
+                )
+        size = actual_image.size
+
+    if mode != expected_image.mode or size != expected_size:
+        expected_image = normalized_baseline(expected_image_path, mode, size)
+    if actual_image.mode != mode:
+        actual_image = as_pil(actual_image).convert(mode)
+    return expected_image, actual_image
+
+
+def compare_images(expected_image_path, actual_image_path, backend=None, region=None, mask=None, normalize=None):
+    '''Compare two images and return the percentage difference between them.
+
+    With region and/or mask only the selected pixels are compared, and the
+    percentage is relative to the number of selected pixels.
+
+    normalize converts images of different modes, and with NORMALIZE_SIZE
+    resamples a baseline of a slightly different size, see load_pair.
+    '''
+    if is_identical_by_index(expected_image_path, actual_image_path):
+        return 0.0
+
+    if region is not None or mask is not None:
+        if normalize is not None:
+            raise ValueError("normalize cannot be combined with region or mask")
+        return compare_selection(expected_image_path, actual_image_path, region, mask, backend)
+
+    expected_image, actual_image = load_pair(expected_image_path, actual_image_path, normalize)
+
+    # Calculate the difference between images
+    total = difference_sum(expected_image, actual_image, backend)
+    # Calculate the percentage difference
+    percentage_diff = percentage_from_sum(
+        total, expected_image.width, expected_image.height
+    )
 
     return percentage_diff
 
 
-def compare_and_assert(expected_image_path, actual_image_path, threshold, view_type):
-    '''Compare two images and assert if they are similar within a threshold.'''
-    percentage_diff = compare_images(expected_image_path, actual_image_path)
-    if percentage_diff <= threshold:
+class DifferenceGrid(object):
+    """Summed channel differences per tile of a pair, row by row.
+
+    Tiles on the right and bottom edges are smaller when the image size is not a
+    multiple of tile_size. The global score is derived from the same sums.
+    """
+
+    def __init__(self, size, tile_size, sums, expected_size=None):
+        self.size = size
+        self.tile_size = tile_size
+        self.sums = sums
+        # The global percentage is relative to the expected image, like compare_images
+        self.expected_size = expected_size or size
+
+    @property
+    def total(self):
+        return sum(sum(row) for row in self.sums)
+
+    @property
+    def percentage_diff(self):
+        return percentage_from_sum(self.total, *self.expected_size)
+
+    def tile_box(self, column, row):
+        '''Return the (left, upper, right, lower) pixel box of a tile.'''
+        left, upper = column * self.tile_size, row * self.tile_size
+        return left, upper, min(left + self.tile_size, self.size[0]), min(upper + self.tile_size, self.size[1])
+
+    def tile_percentage(self, column, row):
+        '''Return the percentage difference within one tile.'''
+        left, upper, right, lower = self.tile_box(column, row)
+        return percentage_from_sum(self.sums[row][column], right - left, lower - upper)
+
+    def hot_tiles(self, count=DEFAULT_HOT_TILES):
+        '''Return up to count (box, percentage) tuples of the most different tiles, worst first.'''
+        tiles = [
+            (self.tile_percentage(column, row), column, row)
+            for row, sums in enumerate(self.sums)
+            for column, total in enumerate(sums)
+            if total
+        ]
+        tiles.sort(key=lambda tile: (-tile[0], tile[2], tile[1]))
+        return [(self.tile_box(column, row), percentage) for percentage, column, row in tiles[:count]]
+
+    def __repr__(self):
+        return (
+            f"DifferenceGrid(size={self.size!r}, tile_size={self.tile_size!r}, "
+            f"percentage_diff={self.percentage_diff!r})"
+        )
+
+
+def _tile_starts(length, tile_size):
+    return list(range(0, length, tile_size))
+
+
+def _difference_grid_numpy(expected_image, actual_image, tile_size):
+    '''Sum the absolute difference per tile with one vectorized pass over the pixels.'''
+    if expected_image.mode != actual_image.mode:
+        raise ValueError("images do not match")
+    expected_image, actual_image = _overlap(expected_image, actual_image)
+    diff = np.abs(_signed(np.asarray(expected_image)) - _signed(np.asarray(actual_image)))
+    if diff.ndim == 3:
+        diff = diff.sum(axis=2, dtype=np.int64)
+    if not diff.size:
+        return []
+    sums = np.add.reduceat(diff, _tile_starts(diff.shape[0], tile_size), axis=0, dtype=np.int64)
+    sums = np.add.reduceat(sums, _tile_starts(diff.shape[1], tile_size), axis=1)
+    return sums.tolist()
+
+
+def _difference_grid_pil(expected_image, actual_image, tile_size):
+    '''Sum the absolute difference per tile from the histograms of one PIL difference image.'''
+    diff = ImageChops.difference(as_pil(expected_image), as_pil(actual_image))
+    sums = []
+    for upper in _tile_starts(diff.height, tile_size):
+        row = []
+        for left in _tile_starts(diff.width, tile_size):
+            box = (left, upper, min(left + tile_size, diff.width), min(upper + tile_size, diff.height))
+            histogram = diff.crop(box).histogram()
+            row.append(sum((index % 256) * count for index, count in enumerate(histogram)))
+        sums.append(row)
+    return sums
+
+
+def difference_grid(expected_image, actual_image, tile_size=DEFAULT_TILE_SIZE, backend=None):
+    '''Return the DifferenceGrid of two PIL or raw images.'''
+    backend = backend or default_backend()
+    if backend == BACKEND_NUMPY:
+        if np is None:
+            raise RuntimeError("The numpy backend requires numpy to be installed.")
+        sums = _difference_grid_numpy(expected_image, actual_image, tile_size)
+    elif backend == BACKEND_PIL:
+        sums = _difference_grid_pil(expected_image, actual_image, tile_size)
+    else:
+        raise ValueError(f"Invalid backend: {backend}")
+    size = (min(expected_image.width, actual_image.width), min(expected_image.height, actual_image.height))
+    return DifferenceGrid(size, tile_size, sums, expected_image.size)
+
+
+def compare_images_grid(
+    expected_image_path, actual_image_path, tile_size=DEFAULT_TILE_SIZE, backend=None, normalize=None
+):
+    '''Compare two images and return their DifferenceGrid.
+
+    grid.percentage_diff equals what compare_images returns, and grid.hot_tiles()
+    locates the differences, without a second decode or pass.
+    '''
+    if is_identical_by_index(expected_image_path, actual_image_path):
+        size = image_size(expected_image_path, baseline=True)
+        columns, rows = len(_tile_starts(size[0], tile_size)), len(_tile_starts(size[1], tile_size))
+        return DifferenceGrid(size, tile_size, [[0] * columns for _ in range(rows)])
+
+    expected_image, actual_image = load_pair(expected_image_path, actual_image_path, normalize)
+    return difference_grid(expected_image, actual_image, tile_size, backend)
+
+
+def format_hot_tiles(grid, count=DEFAULT_HOT_TILES):
+    '''Return a short description of the hottest tiles of a DifferenceGrid.
+
+    grid may also be a list of (box, percentage) tuples, e.g. recorded in a results manifest.
+    '''
+    tiles = grid.hot_tiles(count) if isinstance(grid, DifferenceGrid) else list(grid)[:count]
+    return ", ".join(f"{tuple(box)} {percentage:.2f}%" for box, percentage in tiles)
+
+
+class ComparisonResult(object):
+    """The outcome of a threshold comparison.
+
+    When the comparison exited early percentage_diff only covers the rows that
+    were compared, but passed is always the verdict the full comparison would give.
+    level is the pyramid reduction factor whose lower bound failed the pair, 1
+    being full resolution, and stage the compare_with_stages stage that decided it.
+    """
+
+    def __init__(
+        self,
+        percentage_diff,
+        passed,
+        early_exit=False,
+        rows_compared=0,
+        rows_total=0,
+        level=1,
+        stage=None,
+    ):
+        self.percentage_diff = percentage_diff
+        self.passed = passed
+        self.early_exit = early_exit
+        self.rows_compared = rows_compared
+        self.rows_total = rows_total
+        self.level = level
+        self.stage = stage
+
+    @property
+    def exact(self):
+        '''True if percentage_diff is the full comparison's score rather than a partial sum or a bound.'''
+        if not self.early_exit or self.stage == STAGE_IDENTICAL:
+            return True
+        # Pairs the index proves identical exit early with an exact 0%
+        return self.stage is None and self.level == 1 and self.rows_total == 0
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={value!r}" for name, value in vars(self).items())
+        return f"ComparisonResult({fields})"
+
+
+def iter_strip_sums(expected_image, actual_image, strip_height=64, backend=None):
+    '''Yield (rows, difference sum) for each horizontal strip of two opened images.'''
+    # Only the overlapping region is diffed, matching ImageChops.difference
+    width = min(expected_image.width, actual_image.width)
+    height = min(expected_image.height, actual_image.height)
+    for top in range(0, height, strip_height):
+        box = (0, top, width, min(top + strip_height, height))
+        yield box[3] - top, difference_sum(
+            expected_image.crop(box), actual_image.crop(box), backend
+        )
+
+
+def compare_within_threshold(
+    expected_image_path, actual_image_path, threshold, strip_height=64, backend=None
+):
+    '''Compare two images strip by strip and stop once the verdict is settled.
+
+    The comparison fails as soon as the accumulated difference exceeds the
+    threshold and passes as soon as the remaining rows could no longer push it
+    over, even if every one of their channels differed completely.
+    '''
+    if is_identical_by_index(expected_image_path, actual_image_path):
+        return ComparisonResult(0.0, 0.0 <= threshold, early_exit=True)
+
+    expected_image = as_baseline(expected_image_path)
+    actual_image = as_image(actual_image_path)
+
+    width = expected_image.width
+    height = expected_image.height
+    overlap_width = min(width, actual_image.width)
+    rows_total = min(height, actual_image.height)
+    max_channel_sum = 255 * overlap_width * len(expected_image.getbands())
+
+    total = 0
+    rows_compared = 0
+    for rows, strip_sum in iter_strip_sums(
+        expected_image, actual_image, strip_height, backend
+    ):
+        total += strip_sum
+        rows_compared += rows
+        if rows_compared == rows_total:
+            break
+        percentage_diff = percentage_from_sum(total, width, height)
+        if percentage_diff > threshold:
+            return ComparisonResult(
+                percentage_diff, False, True, rows_compared, rows_total
+            )
+        worst_case = total + (rows_total - rows_compared) * max_channel_sum
+        if percentage_from_sum(worst_case, width, height) <= threshold:
+            return ComparisonResult(
+                percentage_diff, True, True, rows_compared, rows_total
+            )
+
+    percentage_diff = percentage_from_sum(total, width, height)
+    return ComparisonResult(
+        percentage_diff, percentage_diff <= threshold, False, rows_compared, rows_total
+    )
+
+
+def reduced_difference_sum(expected_image, actual_image, factor, backend=None):
+    '''Return a lower bound of the summed channel difference from factor x factor block averages.
+
+    Only the whole blocks of the overlapping area are compared, and the sum is
+    scaled back to full resolution. Returns (sum, rounding) where rounding is
+    how much rounding the block averages may have added to the sum, or None if
+    the images hold no whole block.
+    '''
+    expected_image, actual_image = _overlap(as_pil(expected_image), as_pil(actual_image))
+    if expected_image.mode != actual_image.mode:
+        raise ValueError("images do not match")
+    box = (0, 0, expected_image.width // factor * factor, expected_image.height // factor * factor)
+    if not box[2] or not box[3]:
+        return None
+    if expected_image.size != box[2:]:
+        expected_image = expected_image.crop(box)
+        actual_image = actual_image.crop(box)
+
+    # Image.reduce rounds each average, which moves a block's difference by up to 1 per band
+    area = factor * factor
+    expected_reduced = expected_image.reduce(factor)
+    actual_reduced = actual_image.reduce(factor)
+    rounding = len(expected_reduced.getbands()) * expected_reduced.width * expected_reduced.height * area
+    return difference_sum(expected_reduced, actual_reduced, backend) * area, rounding
+
+
+def compare_images_pyramid(
+    expected_image_path,
+    actual_image_path,
+    threshold,
+    levels=DEFAULT_PYRAMID_LEVELS,
+    band=DEFAULT_PYRAMID_BAND,
+    backend=None,
+):
+    '''Compare reduced versions of two images first to fail clearly broken pairs early.
+
+    Each level box-filters both images by its reduction factor and scores them
+    with the usual percentage metric. Averaging can only hide differences, so
+    a coarse score, less the rounding of the block averages, is a lower bound
+    of the full one. A pair fails at the first level whose bound is more than
+    band above the threshold. Differences that cancel out within a block, e.g.
+    an inverted checkerboard or a shifted pattern, score nothing at a coarse
+    level, so every other pair moves on to full resolution, which decides
+    whether it passes.
+    '''
+    if is_identical_by_index(expected_image_path, actual_image_path):
+        return ComparisonResult(0.0, 0.0 <= threshold, early_exit=True)
+
+    expected_image = as_baseline(expected_image_path)
+    actual_image = as_image(actual_image_path)
+
+    for factor in sorted(levels, reverse=True):
+        if factor <= 1 or factor > min(expected_image.width, expected_image.height):
+            continue
+        reduced = reduced_difference_sum(expected_image, actual_image, factor, backend)
+        if reduced is None:
+            continue
+        total, rounding = reduced
+        lower_bound = percentage_from_sum(total - rounding, expected_image.width, expected_image.height)
+        if lower_bound > threshold + band:
+            return ComparisonResult(lower_bound, False, early_exit=True, level=factor)
+
+    percentage_diff = percentage_from_sum(
+        difference_sum(expected_image, actual_image, backend),
+        expected_image.width,
+        expected_image.height,
+    )
+    return ComparisonResult(percentage_diff, percentage_diff <= threshold)
+
+
+stage_counts = collections.Counter()
+_stage_lock = threading.Lock()
+
+
+def _count_stage(stage):
+    with _stage_lock:
+        stage_counts[stage] += 1
+
+
+def reset_stage_counts():
+    '''Forget how many pairs each compare_with_stages stage decided.'''
+    with _stage_lock:
+        stage_counts.clear()
+
+
+def stage_summary():
+    '''Return how many pairs each compare_with_stages stage decided, by stage name.'''
+    with _stage_lock:
+        return {stage: stage_counts[stage] for stage in STAGES}
+
+
+def histogram_lower_bound(expected_histogram, actual_histogram, bands):
+    '''Return a lower bound of the summed channel difference from two histograms.
+
+    However the pixels are arranged, the summed absolute difference of a band is
+    at least the earth mover's distance between its two histograms, which is
+    the summed absolute difference of their cumulative counts.
+    '''
+    total = 0
+    for band in range(bands):
+        offset = band * 256
+        expected_count = actual_count = 0
+        for value in range(offset, offset + 255):
+            expected_count += expected_histogram[value]
+            actual_count += actual_histogram[value]
+            total += abs(expected_count - actual_count)
+    return total
+
+
+def compare_with_stages(expected_image_path, actual_image_path, threshold, backend=None):
+    '''Compare two images through cheap PIL stages before the per-pixel metric.
+
+    Pairs with identical histograms and pixels pass as identical. Pairs whose
+    histograms alone prove the difference exceeds the threshold are rejected,
+    with percentage_diff holding that lower bound. Only the remaining pairs
+    are diffed precisely. The verdict always matches compare_images, and
+    stage_summary reports how many pairs each stage decided.
+    '''
+    if is_identical_by_index(expected_image_path, actual_image_path):
+        _count_stage(STAGE_IDENTICAL)
+        return ComparisonResult(0.0, 0.0 <= threshold, early_exit=True, stage=STAGE_IDENTICAL)
+
+    expected_image = as_baseline(expected_image_path)
+    actual_image = as_image(actual_image_path)
+    width, height = expected_image.size
+
+    if expected_image.size == actual_image.size and expected_image.mode == actual_image.mode:
+        expected_histogram = as_pil(expected_image).histogram()
+        actual_histogram = as_pil(actual_image).histogram()
+        if expected_histogram == actual_histogram and expected_image.tobytes() == actual_image.tobytes():
+            _count_stage(STAGE_IDENTICAL)
+            return ComparisonResult(0.0, 0.0 <= threshold, early_exit=True, stage=STAGE_IDENTICAL)
+
+        lower_bound = histogram_lower_bound(
+            expected_histogram, actual_histogram, len(expected_image.getbands())
+        )
+        percentage_diff = percentage_from_sum(lower_bound, width, height)
+        if percentage_diff > threshold:
+            _count_stage(STAGE_REJECTED)
+            return ComparisonResult(percentage_diff, False, early_exit=True, stage=STAGE_REJECTED)
+
+    percentage_diff = percentage_from_sum(
+        difference_sum(expected_image, actual_image, backend), width, height
+    )
+    _count_stage(STAGE_PRECISE)
+    return ComparisonResult(percentage_diff, percentage_diff <= threshold, stage=STAGE_PRECISE)
+
+
+def _read_png_header(png_file):
+    '''Return (width, height, mode) of a PNG that can be decoded in bands, or None.'''
+    if png_file.read(8) != PNG_SIGNATURE:
+        return None
+    length, chunk_type = struct.unpack(">I4s", png_file.read(8))
+    if chunk_type != b"IHDR":
+        return None
+    width, height, bit_depth, color_type, _, _, interlace = struct.unpack(
+        ">IIBBBBB", png_file.read(length)
+    )
+    png_file.read(4)  # CRC
+    if bit_depth != 8 or interlace or color_type not in PNG_COLOR_MODES:
+        return None
+    return width, height, PNG_COLOR_MODES[color_type]
+
+
+def _iter_png_scanlines(png_file, chunk_size=1 << 16):
+    '''Yield the still filtered scanline bytes of a PNG positioned after IHDR.'''
+    decompressor = zlib.decompressobj()
+    while True:
+        header = png_file.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"IEND":
+            break
+        if chunk_type != b"IDAT":
+            png_file.seek(length + 4, os.SEEK_CUR)
+            continue
+        remaining = length
+        while remaining:
+            data = png_file.read(min(chunk_size, remaining))
+            remaining -= len(data)
+            # Bound the output so highly compressed data cannot expand all at once
+            while data:
+                yield decompressor.decompress(data, chunk_size)
+                data = decompressor.unconsumed_tail
+        png_file.read(4)  # CRC
+    yield decompressor.flush()
+
+
+def _iter_png_bands(png_file, width, height, mode, band_height):
+    '''Decode a non-interlaced 8-bit PNG band by band with PIL's PNG decoder.
+
+    The decoder unfilters each band on its own, prefixed with the previous
+    band's last decoded row so the Up, Average and Paeth filters still see the
+    row above. Only one band of filtered and decoded data is held at a time.
+    '''
+    stride = width * len(mode) + 1
+    previous_row = b"\x00" * stride
+    pending = b""
+    top = 0
+    for data in _iter_png_scanlines(png_file):
+        pending += data
+        while top < height:
+            rows = min(band_height, height - top)
+            if len(pending) < rows * stride:
+                break
+            band_data = previous_row + pending[: rows * stride]
+            pending = pending[rows * stride:]
+            band = Image.frombytes(
+                mode, (width, rows + 1), zlib.compress(band_data, 0), "zip", mode
+            )
+            previous_row = b"\x00" + band.crop((0, rows, width, rows + 1)).tobytes()
+            yield band.crop((0, 1, width, rows + 1))
+            top += rows
+    if top < height:
+        raise ValueError("Truncated PNG image data")
+
+
+def open_bands(path, band_height=DEFAULT_BAND_HEIGHT, baseline=False):
+    '''Return (size, bands) where bands yields horizontal strips of an image.
+
+    8-bit non-interlaced PNG files are decoded band by band so only one band is
+    in memory at a time. Any other file is decoded whole and then cut into
+    bands, as are in-memory images.
+
+    @param baseline: Cut packed baselines, see packed_baseline, from their memory-mapped pixels.
+    '''
+    header = None
+    image = packed_baseline(path) if baseline and is_path(path) else None
+    if image is None and is_path(path):
+        image_file = open(path, "rb")
+        header = _read_png_header(image_file)
+        if header is None:
+            image_file.close()
+
+    if header is None:
+        if image is None:
+            image = as_image(path)
+
+        def bands():
+            for top in range(0, image.height, band_height):
+                yield image.crop((0, top, image.width, min(top + band_height, image.height)))
+
+        return image.size, bands()
+
+    width, height, mode = header
+
+    def png_bands():
+        with image_file:
+            for band in _iter_png_bands(image_file, width, height, mode, band_height):
+                yield band
+
+    return (width, height), png_bands()
+
+
+def compare_images_streaming(
+    expected_image_path, actual_image_path, band_height=DEFAULT_BAND_HEIGHT, backend=None
+):
+    '''Compare two images band by band and return the percentage difference.
+
+    Gives the same result as compare_images but peak memory is bounded by the
+    band height instead of the image size. Decoded bands bypass the image cache.
+    '''
+    expected_size, expected_bands = open_bands(expected_image_path, band_height, baseline=True)
+    actual_size, actual_bands = open_bands(actual_image_path, band_height)
+
+    total = 0
+    # zip stops at the shorter image, matching ImageChops.difference
+    for expected_band, actual_band in zip(expected_bands, actual_bands):
+        rows = min(expected_band.height, actual_band.height)
+        if rows < expected_band.height or rows < actual_band.height:
+            expected_band = expected_band.crop((0, 0, expected_band.width, rows))
+            actual_band = actual_band.crop((0, 0, actual_band.width, rows))
+        total += difference_sum(expected_band, actual_band, backend)
+
+    expected_bands.close()
+    actual_bands.close()
+    return percentage_from_sum(total, expected_size[0], expected_size[1])
+
+
+class Metric(object):
+    """A registered comparison metric.
+
+    function(expected_image, actual_image, backend, **options) scores two
+    images as a percentage where 0 means identical. cost is the relative
+    per-pixel cost, robust_to lists the kinds of harmless differences the
+    metric tolerates, and requires_numpy marks metrics without a PIL fallback.
+    """
+
+    def __init__(self, name, function, cost, robust_to=(), requires_numpy=False):
+        self.name = name
+        self.function = function
+        self.cost = cost
+        self.robust_to = frozenset(robust_to)
+        self.requires_numpy = requires_numpy
+
+    @property
+    def available(self):
+        return np is not None or not self.requires_numpy
+
+    def __repr__(self):
+        return f"Metric({self.name!r}, cost={self.cost!r}, robust_to={sorted(self.robust_to)!r})"
+
+
+METRICS = {}
+
+_metric_cache = collections.OrderedDict()
+_metric_cache_lock = threading.Lock()
+
+
+def register_metric(name, cost, robust_to=(), requires_numpy=False):
+    '''Decorator registering a metric function under name in METRICS.'''
+
+    def register(function):
+        METRICS[name] = Metric(name, function, cost, robust_to, requires_numpy)
+        return function
+
+    return register
+
+
+def get_metric(name):
+    '''Return the registered Metric called name.'''
+    try:
+        metric = METRICS[name]
+    except KeyError:
+        raise ValueError(f"Unknown metric: {name}. Available: {', '.join(sorted(METRICS))}")
+    if not metric.available:
+        raise RuntimeError(f"The {name} metric requires numpy to be installed.")
+    return metric
+
+
+def select_metric(robust_to=()):
+    '''Return the name of the cheapest available metric tolerating every kind of difference in robust_to.'''
+    required = set(robust_to)
+    candidates = [
+        metric for metric in METRICS.values() if metric.available and required <= metric.robust_to
+    ]
+    if not candidates:
+        raise ValueError(f"No available metric is robust to: {', '.join(sorted(required))}")
+    return min(candidates, key=lambda metric: (metric.cost, metric.name)).name
+
+
+def _overlap(expected_image, actual_image):
+    '''Crop both images to their overlapping area, like ImageChops.difference does.'''
+    box = (0, 0, min(expected_image.width, actual_image.width), min(expected_image.height, actual_image.height))
+    if expected_image.size != box[2:]:
+        expected_image = expected_image.crop(box)
+    if actual_image.size != box[2:]:
+        actual_image = actual_image.crop(box)
+    return expected_image, actual_image
+
+
+def _absolute_difference(expected_image, actual_image):
+    '''Return the absolute difference of two equally sized images as a NumPy array.'''
+    if expected_image.mode != actual_image.mode:
+        raise ValueError("images do not match")
+    return np.abs(_signed(np.asarray(expected_image)) - _signed(np.asarray(actual_image)))
+
+
+@register_metric("mad", cost=2, robust_to=("sparse_noise",))
+def mean_absolute_difference(expected_image, actual_image, backend=None):
+    '''Summed channel difference relative to the expected size, what compare_images reports.'''
+    total = difference_sum(expected_image, actual_image, backend)
+    return percentage_from_sum(total, expected_image.width, expected_image.height)
+
+
+@register_metric("max_delta", cost=1)
+def max_channel_delta(expected_image, actual_image, backend=None):
+    '''Largest difference of any channel of any pixel, as a percentage of 255.'''
+    expected_image, actual_image = _overlap(expected_image, actual_image)
+    if (backend or default_backend()) == BACKEND_NUMPY and np is not None:
+        delta = int(_absolute_difference(expected_image, actual_image).max(initial=0))
+    else:
+        diff = ImageChops.difference(as_pil(expected_image), as_pil(actual_image))
+        extrema = diff.getextrema()
+        if not isinstance(extrema[0], tuple):
+            extrema = (extrema,)
+        delta = max(high for _, high in extrema)
+    return delta / 255.0 * 100
+
+
+@register_metric("over_tolerance", cost=2, robust_to=("sparse_noise", "low_amplitude_noise"))
+def pixels_over_tolerance(expected_image, actual_image, backend=None, tolerance=DEFAULT_PIXEL_TOLERANCE):
+    '''Percentage of pixels with any channel differing by more than tolerance.'''
+    expected_image, actual_image = _overlap(expected_image, actual_image)
+    pixel_count = expected_image.width * expected_image.height
+    if not pixel_count:
+        return 0.0
+    if (backend or default_backend()) == BACKEND_NUMPY and np is not None:
+        over = _absolute_difference(expected_image, actual_image) > tolerance
+        if over.ndim == 3:
+            over = over.any(axis=2)
+        count = int(np.count_nonzero(over))
+    else:
+        diff = ImageChops.difference(as_pil(expected_image), as_pil(actual_image))
+        # Flag each band, then merge the flags so a pixel counts once
+        flags = [band.point(lambda value: 255 if value > tolerance else 0) for band in diff.split()]
+        merged = flags[0]
+        for flag in flags[1:]:
+            merged = ImageChops.lighter(merged, flag)
+        count = merged.histogram()[255]
+    return count / float(pixel_count) * 100
+
+
+def _box_mean(array, size):
+    '''Mean of every size x size window of a 2D array, computed from an integral image.'''
+    integral = np.pad(array, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+    total = integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+    return total / float(size * size)
+
+
+@register_metric(
+    "ssim",
+    cost=10,
+    robust_to=("sparse_noise", "low_amplitude_noise", "brightness_shift"),
+    requires_numpy=True,
+)
+def structural_dissimilarity(expected_image, actual_image, backend=None, window=DEFAULT_SSIM_WINDOW):
+    '''One minus the mean windowed SSIM of the luma channels, as a percentage.'''
+    expected_image, actual_image = _overlap(expected_image, actual_image)
+    window = min(window, expected_image.width, expected_image.height)
+    if window < 1:
+        return 0.0
+    x = np.asarray(as_pil(expected_image).convert("L"), dtype=np.float64)
+    y = np.asarray(as_pil(actual_image).convert("L"), dtype=np.float64)
+
+    mu_x = _box_mean(x, window)
+    mu_y = _box_mean(y, window)
+    var_x = _box_mean(x * x, window) - mu_x * mu_x
+    var_y = _box_mean(y * y, window) - mu_y * mu_y
+    covariance = _box_mean(x * y, window) - mu_x * mu_y
+
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    ssim = ((2 * mu_x * mu_y + c1) * (2 * covariance + c2)) / (
+        (mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2)
+    )
+    return (1.0 - float(ssim.mean())) * 100
+
+
+def compare_metric(expected_image_path, actual_image_path, metric=DEFAULT_METRIC, backend=None, **options):
+    '''Score two images with a registered metric and return its percentage.
+
+    "auto" picks select_metric(). Results for pairs of files are cached per
+    pair, file versions, metric and options, so repeated checks are free.
+
+    @param options: Extra keyword arguments of the metric, e.g. tolerance for over_tolerance.
+    '''
+    if metric == "auto":
+        metric = select_metric()
+    metric = get_metric(metric)
+
+    key = None
+    if is_path(expected_image_path) and is_path(actual_image_path):
+        key = (
+            baseline_key(expected_image_path),
+            ImageCache.key(actual_image_path),
+            metric.name,
+            tuple(sorted(options.items())),
+        )
+        with _metric_cache_lock:
+            if key in _metric_cache:
+                _metric_cache.move_to_end(key)
+                return _metric_cache[key]
+
+    if is_identical_by_index(expected_image_path, actual_image_path):
+        score = 0.0
+    else:
+        score = metric.function(
+            as_baseline(expected_image_path), as_image(actual_image_path), backend, **options
+        )
+
+    if key is not None:
+        with _metric_cache_lock:
+            _metric_cache[key] = score
+            while len(_metric_cache) > METRIC_CACHE_SIZE:
+                _metric_cache.popitem(last=False)
+    return score
+
+
+def _compare_pair(index, expected_image_path, actual_image_path, backend):
+    '''Compare one pair in a worker and capture any error for the caller.'''
+    try:
+        return index, compare_images(expected_image_path, actual_image_path, backend), None
+    except Exception as e:  # pylint: disable=broad-except
+        return index, None, e
+
+
+def _process_context():
+    '''Return a spawn context that starts workers with a plain Python interpreter.'''
+    context = multiprocessing.get_context("spawn")
+    # Inside the Maya GUI sys.executable is maya itself, spawn workers with mayapy instead
+    executable = sys.executable
+    name = os.path.basename(executable).lower()
+    if name.startswith("maya") and not name.startswith("mayapy"):
+        extension = os.path.splitext(executable)[1]
+        context.set_executable(os.path.join(os.path.dirname(executable), "mayapy" + extension))
+    return context
+
+
+def _run_jobs(function, arguments, workers, backend):
+    '''Yield function(index, *arguments[index], backend) results in the order they finish.
+
+    Runs in this process when workers is 1, otherwise across a process pool.
+    '''
+    workers = min(workers or os.cpu_count() or 1, len(arguments))
+
+    if workers <= 1:
+        for index, args in enumerate(arguments):
+            yield function(index, *args, backend)
+        return
+
+    with futures.ProcessPoolExecutor(workers, mp_context=_process_context()) as executor:
+        jobs = [executor.submit(function, index, *args, backend) for index, args in enumerate(arguments)]
+        try:
+            for job in futures.as_completed(jobs):
+                yield job.result()
+        finally:
+            # Stop queued comparisons when the caller abandons the generator
+            for job in jobs:
+                job.cancel()
+
+
+def compare_many(pairs, workers=None, backend=None):
+    '''Compare (expected, actual) image path pairs across a pool of processes.
+
+    Results are yielded as (pair, percentage_diff, error) tuples in the order
+    the comparisons finish. percentage_diff is what compare_images returns for
+    the pair and error is the exception it raised, or None.
+
+    @param pairs: Iterable of (expected_image_path, actual_image_path) tuples.
+    @param workers: Number of worker processes. Defaults to the CPU count, 1 compares in this process.
+    @param backend: Optional comparison backend passed to compare_images.
+    '''
+    pairs = [tuple(pair) for pair in pairs]
+    for index, percentage_diff, error in _run_jobs(_compare_pair, pairs, workers, backend):
+        yield pairs[index], percentage_diff, error
+
+
+def is_identical_file(expected_image_path, actual_image_path):
+    '''Return True if two image files hold the same bytes, hashing them only when their sizes match.'''
+    if os.path.getsize(expected_image_path) != os.path.getsize(actual_image_path):
+        return False
+    return image_index.file_hash(expected_image_path) == image_index.file_hash(actual_image_path)
+
+
+def _compare_frame(index, expected_image_path, actual_image_path, backend):
+    '''Compare one frame in a worker, returning (index, percentage_diff, skipped, error).'''
+    try:
+        if is_identical_file(expected_image_path, actual_image_path):
+            return index, 0.0, True, None
+        return index, compare_images(expected_image_path, actual_image_path, backend), False, None
+    except Exception as e:  # pylint: disable=broad-except
+        return index, None, False, e
+
+
+def _frame_pattern(pattern):
+    '''Compile a frame pattern into a regular expression capturing the frame number.
+
+    The frame number is written as a run of # (name.####.png), as a printf
+    placeholder (name.%04d.png) or as * (name.*.png).
+    '''
+    parts = re.split(r"(#+|%0?\d*d|\*)", os.path.basename(pattern))
+    if len(parts) != 3:
+        raise ValueError(f"Pattern needs exactly one frame number placeholder: {pattern}")
+    return re.compile(f"{re.escape(parts[0])}(-?\\d+){re.escape(parts[2])}$")
+
+
+def find_frames(pattern):
+    '''Return {frame number: path} for the files in the pattern's directory that match it.'''
+    directory = os.path.dirname(pattern) or os.curdir
+    regex = _frame_pattern(pattern)
+    frames = {}
+    with os.scandir(directory) as scan:
+        for entry in scan:
+            match = regex.match(entry.name)
+            if match and entry.is_file():
+                frames[int(match.group(1))] = entry.path
+    return frames
+
+
+class SequenceResult(object):
+    """The per-frame outcome of compare_sequences.
+
+    scores maps each compared frame number to its percentage difference,
+    skipped lists the frames whose files were byte-identical, errors maps frames
+    to the exception their comparison raised and missing lists expected frames
+    without an actual frame. stopped is True when the comparison stopped at a
+    failing frame, in which case later frames may have no score.
+    """
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold
+        self.scores = {}
+        self.skipped = []
+        self.errors = {}
+        self.missing = []
+        self.stopped = False
+
+    def is_failure(self, frame):
+        '''Return True if a compared frame errored or exceeds the threshold.'''
+        if frame in self.errors:
+            return True
+        return self.threshold is not None and self.scores[frame] > self.threshold
+
+    @property
+    def failed_frames(self):
+        return sorted(frame for frame in set(self.scores) | set(self.errors) if self.is_failure(frame))
+
+    @property
+    def passed(self):
+        return not self.missing and not self.failed_frames
+
+    def __repr__(self):
+        return (
+            f"SequenceResult(frames={len(self.scores)}, skipped={len(self.skipped)}, "
+            f"failed={self.failed_frames!r}, missing={self.missing!r}, stopped={self.stopped!r})"
+        )
+
+
+def compare_sequences(
+    expected_pattern,
+    actual_pattern,
+    threshold=None,
+    stop_at_first_failure=False,
+    workers=None,
+    backend=None,
+):
+    '''Compare two frame sequences frame by frame and return a SequenceResult.
+
+    Frames are matched by number, see find_frames for the pattern syntax, and
+    compared across a pool of processes like compare_many. Frames whose files
+    are byte-identical are scored 0% without decoding them.
+
+    @param threshold: Percentage above which a frame fails. Without it only errors fail.
+    @param stop_at_first_failure: Stop queueing frames once one fails or is missing.
+    @param workers: Number of worker processes. Defaults to the CPU count, 1 compares in this process.
+    @param backend: Optional comparison backend passed to compare_images.
+    '''
+    expected_frames = find_frames(expected_pattern)
+    actual_frames = find_frames(actual_pattern)
+    result = SequenceResult(threshold)
+    result.missing = sorted(set(expected_frames) - set(actual_frames))
+    if result.missing and stop_at_first_failure:
+        result.stopped = True
+        return result
+
+    frames = sorted(set(expected_frames) & set(actual_frames))
+    arguments = [(expected_frames[frame], actual_frames[frame]) for frame in frames]
+    for index, percentage_diff, skipped, error in _run_jobs(_compare_frame, arguments, workers, backend):
+        frame = frames[index]
+        if error is not None:
+            result.errors[frame] = error
+        else:
+            result.scores[frame] = percentage_diff
+        if skipped:
+            result.skipped.append(frame)
+        if stop_at_first_failure and result.is_failure(frame):
+            result.stopped = True
+            break
+    result.skipped.sort()
+    return result
+
+
+def diff_heatmap(expected_image, actual_image, gain=DEFAULT_HEATMAP_GAIN):
+    '''Return an RGB heatmap of the largest channel difference of each pixel, amplified by gain.'''
+    expected_image, actual_image = _overlap(as_pil(expected_image), as_pil(actual_image))
+    if expected_image.mode != actual_image.mode or expected_image.mode == "P":
+        expected_image, actual_image = expected_image.convert("RGBA"), actual_image.convert("RGBA")
+    bands = ImageChops.difference(expected_image, actual_image).split()
+    difference = bands[0]
+    for band in bands[1:]:
+        difference = ImageChops.lighter(difference, band)
+    difference = difference.point(lambda value: min(value * gain, 255))
+    return ImageOps.colorize(difference, black="black", mid="red", white="yellow")
+
+
+def side_by_side(*images):
+    '''Return the images pasted next to each other on a black RGB canvas.'''
+    images = [as_pil(image).convert("RGB") for image in images]
+    composite = Image.new("RGB", (sum(image.width for image in images), max(image.height for image in images)))
+    x = 0
+    for image in images:
+        composite.paste(image, (x, 0))
+        x += image.width
+    return composite
+
+
+def write_diff_artifacts(expected_image, actual_image, diff_path=None, composite_path=None, gain=DEFAULT_HEATMAP_GAIN):
+    '''Write the diff heatmap of a pair to diff_path and/or an expected | actual | heatmap composite.'''
+    heatmap = diff_heatmap(expected_image, actual_image, gain)
+    if diff_path:
+        heatmap.save(diff_path)
+    if composite_path:
+        side_by_side(expected_image, actual_image, heatmap).save(composite_path)
+
+
+class ArtifactWriter(object):
+    """Runs artifact jobs on a single background thread so tests do not wait on PNG encoding."""
+
+    def __init__(self):
+        self.errors = []
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args):
+        '''Queue function(*args) to run on the writer thread, starting it if needed.'''
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="mayatest-artifact-writer")
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put((function, args))
+
+    def flush(self):
+        '''Block until every queued job has run.'''
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            function, args = self._queue.get()
+            try:
+                function(*args)
+            except Exception as e:
+                self.errors.append(e)
+                print(f"Failed to write diff artifacts. Error: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+
+# Background writer shared by every failing compare_and_assert, drained at exit
+artifact_writer = ArtifactWriter()
+atexit.register(artifact_writer.flush)
+
+
+def compare_and_assert(
+    expected_image_path,
+    actual_image_path,
+    threshold,
+    view_type,
+    early_exit=False,
+    streaming=False,
+    pyramid=False,
+    actual_output_path=None,
+    region=None,
+    mask=None,
+    quick_reject=False,
+    metric=None,
+    diff_output_path=None,
+    composite_output_path=None,
+    tile_size=None,
+    normalize=None,
+    robust_to=(),
+    metric_options=None,
+):
+    '''Compare two images and assert if they are similar within a threshold.
+
+    Either image may be a path or an in-memory image. When the comparison fails
+    and actual_output_path is given, an in-memory actual image is written there
+    so it can be inspected. region and mask limit the comparison to the selected
+    pixels, see compare_images.
+
+    With early_exit the images are compared in strips and the comparison stops
+    as soon as the pass/fail verdict can no longer change. With pyramid reduced
+    resolutions are compared first, see compare_images_pyramid. With streaming
+    the images are decoded band by band to bound memory on very large renders.
+    With quick_reject histogram stages settle clearly identical or clearly
+    different pairs first, see compare_with_stages. At most one of these modes
+    or metric applies, and none of them with region, mask, normalize or tile_size.
+
+    metric scores the pair with a registered metric instead, see compare_metric,
+    and threshold is then compared against that metric's percentage. "auto"
+    picks the cheapest metric tolerating every kind of difference in robust_to,
+    see select_metric, and metric_options are passed on to the metric, e.g.
+    {"tolerance": 8} for over_tolerance.
+
+    With tile_size the full comparison also sums the difference per tile, see
+    compare_images_grid, and a failure message lists the hottest tiles.
+
+    normalize lets images of different modes or slightly different sizes be
+    compared, see load_pair. tile_size cannot be combined with region or mask.
+    Options that cannot apply together raise ValueError rather than being ignored.
+
+    On failure diff_output_path receives an amplified diff heatmap and
+    composite_output_path an expected | actual | heatmap composite. Both are
+    built from the decoded images on artifact_writer's thread, call
+    artifact_writer.flush() to wait for them. They need both images in full,
+    so a failed region or mask comparison decodes whatever the image cache
+    does not hold yet, and a streamed comparison, which never holds a whole
+    image, writes no artifacts.
+
+    The result is recorded in the results manifest of the actual image's
+    directory when both images are files, or the actual one was saved to
+    actual_output_path, see results_manifest.record.
+    '''
+    selective = region is not None or mask is not None
+    # Each of these replaces the full comparison, so only one can apply
+    modes = [
+        name
+        for name, enabled in (
+            ("metric", metric is not None),
+            ("early_exit", early_exit),
+            ("pyramid", pyramid),
+            ("quick_reject", quick_reject),
+            ("streaming", streaming),
+        )
+        if enabled
+    ]
+    if len(modes) > 1:
+        raise ValueError(f"{' and '.join(modes)} cannot be combined")
+    if modes and (selective or normalize is not None or tile_size):
+        raise ValueError(f"{modes[0]} cannot be combined with region, mask, normalize or tile_size")
+    if tile_size and selective:
+        raise ValueError("tile_size cannot be combined with region or mask")
+    if robust_to and metric != "auto":
+        raise ValueError('robust_to requires metric="auto"')
+    if metric_options and metric is None:
+        raise ValueError("metric_options requires a metric")
+
+    if metric == "auto":
+        metric = select_metric(robust_to)
+
+    result = grid = None
+    streamed = False
+    if metric is not None:
+        percentage_diff = compare_metric(expected_image_path, actual_image_path, metric, **(metric_options or {}))
+        result = ComparisonResult(percentage_diff, percentage_diff <= threshold)
+    elif early_exit:
+        result = compare_within_threshold(expected_image_path, actual_image_path, threshold)
+    elif pyramid:
+        result = compare_images_pyramid(expected_image_path, actual_image_path, threshold)
+    elif quick_reject:
+        result = compare_with_stages(expected_image_path, actual_image_path, threshold)
+
+    if result is not None:
+        percentage_diff = result.percentage_diff
+        passed = result.passed
+    else:
+        if streaming:
+            percentage_diff = compare_images_streaming(expected_image_path, actual_image_path)
+            streamed = True
+        elif tile_size:
+            grid = compare_images_grid(expected_image_path, actual_image_path, tile_size, normalize=normalize)
+            percentage_diff = grid.percentage_diff
+        else:
+            percentage_diff = compare_images(
+                expected_image_path, actual_image_path, region=region, mask=mask, normalize=normalize
+            )
+        passed = percentage_diff <= threshold
+
+    if passed:
         message = f"{view_type.capitalize()} view: Images match! Difference in Percentage: {percentage_diff:.2f}%"
-        print("Pass:", message)
-        return True
     else:
         message = f"{view_type.capitalize()} view: Images do not match. Difference in Percentage: {percentage_diff:.2f}%"
-        print("Fail:", message)
-        return False
+    if metric is not None:
+        message += f" ({metric} metric)"
+    if result is not None and result.stage == STAGE_REJECTED:
+        message += " (rejected from histograms, at least this much)"
+    elif result is not None and result.level > 1:
+        message += f" (failed at 1/{result.level} resolution, at least this much)"
+    elif result is not None and result.early_exit and result.rows_total:
+        message += f" (early exit after {result.rows_compared} of {result.rows_total} rows)"
+    if grid is not None and not passed:
+        message += f" Hot tiles: {format_hot_tiles(grid)}"
+
+    print("Pass:" if passed else "Fail:", message)
+    actual_path = actual_image_path if is_path(actual_image_path) else None
+    if not passed and actual_output_path and not is_path(actual_image_path):
+        save_image(actual_image_path, actual_output_path)
+        actual_path = actual_output_path
+        print(f"Actual image saved to: {actual_output_path}")
+    if record_results and is_path(expected_image_path) and actual_path is not None:
+        try:
+            results_manifest.record(
+                expected_image_path,
+                actual_path,
+                metric or DEFAULT_METRIC,
+                percentage_diff,
+                threshold,
+                passed,
+                grid.hot_tiles() if grid is not None else None,
+                exact=result is None or result.exact,
+            )
+        except OSError as e:
+            print(f"Failed to record the result in the results manifest. Error: {str(e)}")
+    if not passed and (diff_output_path or composite_output_path) and streamed:
+        print("Diff artifacts skipped: streamed comparisons do not decode whole images")
+    elif not passed and (diff_output_path or composite_output_path):
+        # Decoded images come from the image cache or baseline store. In-memory
+        # captures are snapshotted here because the caller may reuse their buffer
+        expected_image = as_baseline(expected_image_path)
+        actual_image = as_image(actual_image_path)
+        if not is_path(actual_image_path):
+            actual_image = as_pil(actual_image).copy()
+        artifact_writer.submit(
+            write_diff_artifacts, expected_image, actual_image, diff_output_path, composite_output_path
+        )
+        print(f"Diff artifacts queued for: {diff_output_path or composite_output_path}")
+    return passed
+
+
+def pair_key(name):
+    '''Return the key grouping an image with its variants, the part of its name before the first "_".'''
+    return name.split("_")[0]
+
+
+def variant_order(name, variants=PAIR_VARIANTS):
+    '''Return a sort key placing names by the first variant token they contain, then by name.'''
+    for position, variant in enumerate(variants):
+        if variant in name:
+            return position, name
+    return len(variants), name
+
+
+def find_image_pairs(directory, extra_names=(), variants=PAIR_VARIANTS):
+    '''Group the images of a directory by name prefix in a single pass.
+
+    Returns a list of path lists, one per prefix with at least two images,
+    ordered by variant (ACTUAL, EXPECTED, DIFF, then any other) and sorted by prefix.
+
+    @param directory: Directory holding the images.
+    @param extra_names: Image names to group as if they were in the directory, e.g. packed baselines.
+    @param variants: Name tokens giving the order of the images within a group.
+    '''
+    groups = collections.defaultdict(set)
+    with os.scandir(directory) as scan:
+        for entry in scan:
+            # is_file() is answered from the directory listing on most platforms
+            if image_index.is_image_file(entry.name) and entry.is_file():
+                groups[pair_key(entry.name)].add(entry.name)
+    for name in extra_names:
+        if image_index.is_image_file(name):
+            groups[pair_key(name)].add(name)
+
+    return [
+        [os.path.join(directory, name) for name in sorted(names, key=lambda name: variant_order(name, variants))]
+        for key, names in sorted(groups.items())
+        if len(names) > 1
+    ]
 
 
 def cleanup_images(image_paths):
@@ -39,6 +39,7 @@ import tempfile
 import uuid
 import logging
 import maya.cmds as cmds
+from mayatest import image_utils, results_manifest
 
 # The environment variable that signifies tests are being run with the custom TestResult class.
 CMT_TESTING_VAR = "CMT_UNITTEST"
@@ -321,6 +322,7 @@ class TestResult(unittest.TextTestResult):
         super(TestResult, self).startTestRun()
         # Create an environment variable that specifies tests are being run through the custom runner.
         os.environ[CMT_TESTING_VAR] = "1"
+        image_utils.reset_stage_counts()
 
         ScriptEditorState.suppress_output()
         if Settings.buffer_output:
@@ -334,11 +336,21 @@ class TestResult(unittest.TextTestResult):
             # Restore logging state
             logging.disable(logging.NOTSET)
         ScriptEditorState.restore_output()
+        # Let queued diff heatmaps finish before the temp directory is removed
+        image_utils.artifact_writer.flush()
         if Settings.delete_files and os.path.exists(Settings.temp_dir):
             shutil.rmtree(Settings.temp_dir)
+        # Keep only the latest result of each pair still on disk in the manifests written by this run
+        results_manifest.compact_recorded()
 
         del os.environ[CMT_TESTING_VAR]
 
+        # Report how many image comparisons each quick-reject stage decided
+        stages = image_utils.stage_summary()
+        if any(stages.values()):
+            counts = ", ".join("{0}: {1}".format(stage, count) for stage, count in stages.items())
+            self.stream.writeln("Image comparison stages - {0}".format(counts))
+
         super(TestResult, self).stopTestRun()
 
     def stopTest(self, test):
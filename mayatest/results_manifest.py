@@ -0,0 +1,230 @@
+"""
+Manifest of the comparison results of a directory of images.
+
+compare_and_assert appends one JSON line per comparison to a sidecar file next
+to the actual image, so captures written to a temporary directory take their
+results with them instead of piling up in the reference directory. Each line
+holds the paths and stats of both images, the metric, score, threshold and
+verdict, and the hottest tiles when the pair was compared per tile. Viewers such as the contact sheet read the results back
+instead of diffing the pairs again, and only recompute a pair whose files
+changed since its result was recorded.
+
+Comparisons that stopped early or were decided at a reduced resolution only
+know a bound on the score. Their results are flagged as not exact and viewers
+compare such pairs again rather than show the bound.
+
+Lines are only ever appended, so a test run never has to read the manifest,
+and later results for a pair replace earlier ones when it is loaded.
+compact() rewrites the file with only the latest result of each pair, dropping
+results whose images were deleted or changed since.
+
+Example:
+record(EXPECTED, ACTUAL, "mad", 0.02, 0.1, True)
+lookup(EXPECTED, ACTUAL)["passed"]
+"""
+
+import json
+import os
+import threading
+import time
+
+# Name of the sidecar file written next to the actual images
+MANIFEST_FILE = ".mayatest_results.jsonl"
+MANIFEST_VERSION = 2
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+# Manifests this process appended to, see compact_recorded
+_recorded = set()
+
+
+def manifest_path(directory):
+    '''Return the path of the manifest of a directory.'''
+    return os.path.join(os.path.abspath(directory), MANIFEST_FILE)
+
+
+def file_stat(path):
+    '''Return [mtime_ns, size] of a file, or None if it does not exist.'''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def pair_id(expected_path, actual_path):
+    '''Return the key of a pair, whichever of its images is passed first.'''
+    return "\0".join(sorted((os.path.abspath(expected_path), os.path.abspath(actual_path))))
+
+
+def is_current(result, stats=None):
+    '''Return True if neither image of a recorded result changed since it was recorded.
+
+    @param stats: Current file_stat of the result's expected and actual images, stat'ed when None.
+    '''
+    if stats is None:
+        stats = [file_stat(result["expected"]), file_stat(result["actual"])]
+    return [result["expected_stat"], result["actual_stat"]] == [
+        None if stat is None else list(stat) for stat in stats
+    ]
+
+
+class ResultsManifest(object):
+    """The latest comparison result of each pair in one directory, stored as JSON lines."""
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.path = manifest_path(self.directory)
+        self.results = {}
+        # Lines read by the last load, more than len(results) once pairs were recorded again
+        self.lines = 0
+        self._loaded_stat = None
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        '''Read the manifest, keeping the last result of each pair.'''
+        results = {}
+        lines = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                loaded_stat = os.fstat(f.fileno())
+                for line in f:
+                    lines += 1
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a writer that was killed
+                        continue
+                    if result.get("version") == MANIFEST_VERSION:
+                        results[pair_id(result["expected"], result["actual"])] = result
+        except OSError:
+            loaded_stat = None
+        with self._lock:
+            self.results = results
+            self.lines = lines
+            self._loaded_stat = None if loaded_stat is None else [loaded_stat.st_mtime_ns, loaded_stat.st_size]
+
+    def is_stale(self):
+        '''Return True if results were appended or the file was rewritten since it was loaded.'''
+        return file_stat(self.path) != self._loaded_stat
+
+    def get(self, expected_path, actual_path, stats=None):
+        '''Return the recorded result of a pair if neither image changed since, else None.
+
+        @param stats: Current file_stat of the expected and actual images, stat'ed when None.
+        '''
+        result = self.results.get(pair_id(expected_path, actual_path))
+        if result is None:
+            return None
+        if stats is not None and os.path.abspath(expected_path) != result["expected"]:
+            # The caller passed the pair the other way round
+            stats = stats[::-1]
+        return result if is_current(result, stats) else None
+
+    def compact(self):
+        '''Rewrite the manifest with only the latest current result of each pair.
+
+        Superseded results and results whose images were deleted or changed
+        since they were recorded are dropped, and the file is removed once no
+        result is left. Returns True if the file was rewritten.
+
+        Results appended by another process while the file is rewritten are lost,
+        so only compact once the test run writing to it is over.
+        '''
+        self.load()
+        results = {key: result for key, result in self.results.items() if is_current(result)}
+        if self.lines == len(results):
+            return False
+        with self._lock:
+            if not results:
+                os.remove(self.path)
+            else:
+                temp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    for result in results.values():
+                        f.write(json.dumps(result) + "\n")
+                os.replace(temp_path, self.path)
+            self.results = results
+            self.lines = len(results)
+            self._loaded_stat = file_stat(self.path)
+        return True
+
+
+def get_manifest(directory):
+    '''Return the shared ResultsManifest of a directory, or None if it has none.
+
+    The manifest is reloaded when results were recorded since it was last read.
+    '''
+    directory = os.path.abspath(directory)
+    with _manifests_lock:
+        manifest = _manifests.get(directory)
+        if manifest is None:
+            if not os.path.isfile(manifest_path(directory)):
+                return None
+            manifest = _manifests[directory] = ResultsManifest(directory)
+        elif manifest.is_stale():
+            manifest.load()
+    return manifest
+
+
+def record(expected_path, actual_path, metric, score, threshold, passed, hot_tiles=None, exact=True):
+    '''Append the result of a comparison to the manifest of the actual image's directory.
+
+    Returns the recorded result.
+
+    @param metric: Name of the metric that produced score.
+    @param score: Percentage difference of the pair.
+    @param hot_tiles: (box, percentage) tuples of the most different tiles, see DifferenceGrid.hot_tiles.
+    @param exact: False if score is a partial sum or a bound, see ComparisonResult.exact.
+    '''
+    expected_path = os.path.abspath(expected_path)
+    actual_path = os.path.abspath(actual_path)
+    result = {
+        "version": MANIFEST_VERSION,
+        "expected": expected_path,
+        "actual": actual_path,
+        "expected_stat": file_stat(expected_path),
+        "actual_stat": file_stat(actual_path),
+        "metric": metric,
+        "score": score,
+        "exact": bool(exact),
+        "threshold": threshold,
+        "passed": bool(passed),
+        "hot_tiles": [[list(box), percentage] for box, percentage in hot_tiles or ()],
+        "time": time.time(),
+    }
+    path = manifest_path(os.path.dirname(actual_path))
+    # A single O_APPEND write keeps the lines of concurrent writers whole
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(result) + "\n").encode("utf-8"))
+    finally:
+        os.close(fd)
+    with _manifests_lock:
+        _recorded.add(path)
+    return result
+
+
+def lookup(expected_path, actual_path, stats=None):
+    '''Return the recorded result of a pair if neither image changed since, else None.'''
+    manifest = get_manifest(os.path.dirname(os.path.abspath(actual_path)))
+    if manifest is None:
+        return None
+    return manifest.get(expected_path, actual_path, stats)
+
+
+def compact_recorded():
+    '''Compact every manifest this process recorded results into and return how many were rewritten.'''
+    with _manifests_lock:
+        paths = sorted(_recorded)
+        _recorded.clear()
+    compacted = 0
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        try:
+            compacted += ResultsManifest(os.path.dirname(path)).compact()
+        except OSError as e:
+            print(f"Failed to compact results manifest: {path}. Error: {str(e)}")
+    return compacted
@@ -4,6 +4,7 @@ Utility functions for working with Maya screen setup and screenshots.
 position = screen_utils.get_screen_position(f'{TEST_GEO}.f[1800]')
 position = screen_utils.get_screen_position(xform=TEST_GEO)
 screen_utils.screenshot(path, region=region, region_mode='center')
+image = screen_utils.grab(region=region, region_mode='center')
 
 """
 
@@ -17,7 +18,8 @@ from PIL import ImageGrab  # type: ignore
 from mayatest.Qt import QtCompat, QtWidgets, QtCore, QtGui
 
 
-def screenshot(path, region=None, img_format="PNG", region_mode="absolute"):
+def grab(region=None, region_mode="absolute"):
+    """Capture the screen or a region of it and return the PIL image without saving it"""
     # Check region mode and adjust region accordingly
     if region_mode == "center":
         if region is not None:
@@ -34,9 +36,19 @@ def screenshot(path, region=None, img_format="PNG", region_mode="absolute"):
 
     # Capture the screen or specified region
     if region is None:
-        image = ImageGrab.grab()
-    else:
-        image = ImageGrab.grab(bbox=region)
+        return ImageGrab.grab()
+    return ImageGrab.grab(bbox=region)
+
+
+def grab_viewport():
+    """Read the color buffer of the active viewport into an MImage, without saving it"""
+    image = om.MImage()
+    omui.M3dView.active3dView().readColorBuffer(image, True)
+    return image
+
+
+def screenshot(path, region=None, img_format="PNG", region_mode="absolute"):
+    image = grab(region, region_mode)
 
     # Save the captured region to a file
     image.save(path, img_format)
@@ -0,0 +1,154 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image  # type: ignore
+
+from mayatest import baseline_store, image_utils
+
+
+class TestBaselineStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.expected = os.path.join(self.temp_dir, "cube_EXPECTED.png")
+        self.actual = os.path.join(self.temp_dir, "cube_ACTUAL.png")
+        image = Image.linear_gradient("L").resize((48, 32)).convert("RGBA")
+        image.save(self.expected)
+        image.rotate(180).save(self.actual)
+        self.store = baseline_store.BaselineStore()
+
+    def tearDown(self):
+        image_utils.set_baseline_store(None)
+        self.store.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_converts_once(self):
+        baseline = self.store.open(self.expected)
+        self.assertIsInstance(baseline, baseline_store.RawBaseline)
+        self.assertTrue(os.path.isfile(self.store.raw_path(self.expected)))
+        self.assertIs(self.store.open(self.expected), baseline)
+
+        other_store = baseline_store.BaselineStore()
+        self.assertEqual(other_store.open(self.expected).tobytes(), baseline.tobytes())
+        self.assertEqual(other_store.conversions, 0)
+        other_store.close()
+
+    def test_source_change_invalidates(self):
+        before = self.store.open(self.expected).tobytes()
+        Image.new("RGBA", (48, 32), (1, 2, 3, 4)).save(self.expected)
+        stat = os.stat(self.expected)
+        os.utime(self.expected, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        after = self.store.open(self.expected)
+        self.assertNotEqual(after.tobytes(), before)
+        self.assertEqual(after.tobytes(), Image.open(self.expected).tobytes())
+        self.assertEqual(self.store.conversions, 2)
+
+    def test_comparison_matches_png_path(self):
+        expected_diff = image_utils.compare_images(self.expected, self.actual)
+        image_utils.set_baseline_store(self.store)
+        for backend in (image_utils.BACKEND_PIL, image_utils.default_backend()):
+            self.assertEqual(
+                image_utils.compare_images(self.expected, self.actual, backend=backend),
+                expected_diff,
+            )
+
+    @unittest.skipIf(image_utils.np is None, "numpy is not installed")
+    def test_array_is_zero_copy(self):
+        baseline = self.store.open(self.expected)
+        array = image_utils.np.asarray(baseline)
+        self.assertEqual(array.shape, (32, 48, 4))
+        self.assertFalse(array.flags.owndata)
+        self.assertFalse(array.flags.writeable)
+
+
+class TestBaselineArchive(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.paths = {}
+        for index, mode in enumerate(("RGB", "RGBA", "L")):
+            path = os.path.join(self.temp_dir, f"shot{index}_EXPECTED.png")
+            Image.linear_gradient("L").resize((24 + index, 16)).convert(mode).save(path)
+            self.paths[mode] = path
+        self.store = baseline_store.BaselineStore()
+
+    def tearDown(self):
+        image_utils.set_baseline_store(None)
+        self.store.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_build_and_read(self):
+        self.assertEqual(len(baseline_store.build_archive(self.temp_dir)), 3)
+        archive = baseline_store.get_archive(self.temp_dir)
+        self.assertEqual(sorted(archive.names()), sorted(os.path.basename(path) for path in self.paths.values()))
+        for mode, path in self.paths.items():
+            image = self.store.open(path)
+            self.assertIsInstance(image, baseline_store.ArchiveImage)
+            self.assertEqual(image.mode, mode)
+            self.assertEqual(image.tobytes(), Image.open(path).tobytes())
+            self.assertEqual(image.buffer.obj, archive._map)
+        # Nothing was converted to separate raw files
+        self.assertEqual(self.store.conversions, 0)
+
+    def test_incremental_rebuild(self):
+        baseline_store.build_archive(self.temp_dir)
+        self.assertEqual(baseline_store.build_archive(self.temp_dir), [])
+
+        path = self.paths["RGB"]
+        Image.new("RGB", (8, 8), (1, 2, 3)).save(path)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        self.assertEqual(baseline_store.build_archive(self.temp_dir), [os.path.basename(path)])
+        self.assertEqual(self.store.open(path).tobytes(), Image.open(path).tobytes())
+        self.assertEqual(self.store.open(self.paths["L"]).tobytes(), Image.open(self.paths["L"]).tobytes())
+
+    def test_stale_entry_is_not_served(self):
+        baseline_store.build_archive(self.temp_dir)
+        path = self.paths["RGBA"]
+        Image.new("RGBA", (8, 8), (1, 2, 3, 4)).save(path)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        self.assertIsNone(baseline_store.open_archived(path))
+        self.assertIsInstance(self.store.open(path), baseline_store.RawBaseline)
+
+    def test_compare_with_packed_baseline_only(self):
+        actual = os.path.join(self.temp_dir, "shot0_ACTUAL.png")
+        Image.open(self.paths["RGB"]).rotate(180).save(actual)
+        expected_diff = image_utils.compare_images(self.paths["RGB"], actual)
+        baseline_store.build_archive(self.temp_dir)
+        os.remove(self.paths["RGB"])
+        image_utils.set_baseline_store(self.store)
+        self.assertEqual(image_utils.compare_images(self.paths["RGB"], actual), expected_diff)
+
+    def test_every_mode_reads_packed_baseline_only(self):
+        expected = self.paths["RGB"]
+        actual = os.path.join(self.temp_dir, "shot0_ACTUAL.png")
+        Image.open(expected).rotate(180).save(actual)
+        mask = os.path.join(self.temp_dir, "mask.png")
+        Image.new("L", (24, 16), 255).save(mask)
+        region = (2, 2, 20, 12)
+        comparisons = {
+            "compare_images": lambda: image_utils.compare_images(expected, actual),
+            "region": lambda: image_utils.compare_images(expected, actual, region=region),
+            "mask": lambda: image_utils.compare_images(expected, actual, mask=mask),
+            "streaming": lambda: image_utils.compare_images_streaming(expected, actual, band_height=4),
+            "metric": lambda: image_utils.compare_metric(expected, actual, "max_delta"),
+            "grid": lambda: image_utils.compare_images_grid(expected, actual, 8).percentage_diff,
+            "normalize": lambda: image_utils.compare_images(expected, actual, normalize=image_utils.NORMALIZE_MODE),
+            "early_exit": lambda: image_utils.compare_within_threshold(expected, actual, 100).percentage_diff,
+            "pyramid": lambda: image_utils.compare_images_pyramid(expected, actual, 100, levels=()).percentage_diff,
+            "quick_reject": lambda: image_utils.compare_with_stages(expected, actual, 100).percentage_diff,
+        }
+        scores = {name: compare() for name, compare in comparisons.items()}
+        image_utils.image_cache.clear()
+        image_utils.normalized_cache.clear()
+
+        baseline_store.build_archive(self.temp_dir)
+        os.remove(expected)
+        # No store is installed, the archive next to the baseline is used on its own
+        for name, compare in comparisons.items():
+            self.assertAlmostEqual(compare(), scores[name], msg=name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image  # type: ignore
+
+from mayatest import image_index, image_utils
+
+
+def gradient_image(size=(32, 32)):
+    """Return a small RGB gradient."""
+    return Image.linear_gradient("L").resize(size).convert("RGB")
+
+
+class TestImageIndex(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.expected = os.path.join(self.temp_dir, "cube_EXPECTED.png")
+        gradient_image().save(self.expected)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_update_writes_sidecar(self):
+        index = image_index.update_index(self.temp_dir)
+        self.assertTrue(os.path.isfile(os.path.join(self.temp_dir, image_index.INDEX_FILE)))
+        entry = index.entries["cube_EXPECTED.png"]
+        self.assertEqual(entry["file_hash"], image_index.file_hash(self.expected))
+        self.assertEqual(len(entry["dhash"]), 16)
+        self.assertEqual(image_index.ImageIndex(self.temp_dir).entries, index.entries)
+
+    def test_update_is_incremental(self):
+        index = image_index.update_index(self.temp_dir)
+        index.entries["cube_EXPECTED.png"]["dhash"] = "unchanged"
+        index.update()
+        self.assertEqual(index.entries["cube_EXPECTED.png"]["dhash"], "unchanged")
+
+        gradient_image((16, 16)).save(self.expected)
+        index.update()
+        self.assertNotEqual(index.entries["cube_EXPECTED.png"]["dhash"], "unchanged")
+
+        os.remove(self.expected)
+        index.update()
+        self.assertNotIn("cube_EXPECTED.png", index.entries)
+
+    def test_pixel_identical_pair_short_circuits(self):
+        actual = os.path.join(self.temp_dir, "cube_ACTUAL.png")
+        gradient_image().save(actual, compress_level=0)
+        self.assertFalse(image_utils.is_identical_by_index(self.expected, actual))
+
+        image_index.update_index(self.temp_dir)
+        self.assertTrue(image_utils.is_identical_by_index(self.expected, actual))
+        self.assertEqual(image_utils.compare_images(self.expected, actual), 0.0)
+
+    def test_unindexed_actual_is_hashed(self):
+        image_index.update_index(self.temp_dir)
+        actual_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        same = os.path.join(actual_dir, "same_ACTUAL.png")
+        gradient_image().save(same, compress_level=0)
+        different = os.path.join(actual_dir, "different_ACTUAL.png")
+        gradient_image().rotate(90).save(different)
+        self.assertTrue(image_utils.is_identical_by_index(self.expected, same))
+        self.assertFalse(image_utils.is_identical_by_index(self.expected, different))
+        self.assertGreater(image_utils.compare_images(self.expected, different), 0.0)
+
+    def test_actual_is_not_indexed(self):
+        index = image_index.update_index(self.temp_dir)
+        actual = os.path.join(self.temp_dir, "cube_ACTUAL.png")
+        gradient_image().save(actual, compress_level=0)
+        self.assertTrue(image_utils.is_identical_by_index(self.expected, actual))
+        self.assertNotIn("cube_ACTUAL.png", index.entries)
+        self.assertFalse(index.dirty)
+
+    def test_dhash_rules_out_before_pixel_hash(self):
+        index = image_index.update_index(self.temp_dir)
+        actual = os.path.join(self.temp_dir, "cube_ACTUAL.png")
+        gradient_image().save(actual, compress_level=0)
+        # A pixel-identical actual is only missed if the stored dHash is consulted first
+        index.entries["cube_EXPECTED.png"]["dhash"] = "f" * 16
+        self.assertFalse(image_utils.is_identical_by_index(self.expected, actual))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,778 @@
+import contextlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import weakref
+
+from PIL import Image, ImageChops  # type: ignore
+
+from mayatest import image_utils, results_manifest
+
+
+def noise_image(size, mode="RGB", seed=0):
+    """Return a synthetic image filled with reproducible noise."""
+    rng = random.Random(seed)
+    band_count = len(Image.new(mode, (1, 1)).getbands())
+    data = bytes(rng.randrange(256) for _ in range(size[0] * size[1] * band_count))
+    return Image.frombytes(mode, size, data)
+
+
+class ImageUtilsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def save(self, image, name):
+        path = os.path.join(self.temp_dir, name)
+        image.save(path)
+        return path
+
+    def backends(self):
+        """Return the comparison backends that can run here."""
+        backends = [image_utils.BACKEND_PIL]
+        if image_utils.np is not None:
+            backends.append(image_utils.BACKEND_NUMPY)
+        return backends
+
+
+@unittest.skipIf(image_utils.np is None, "numpy is not installed")
+class TestNumpyBackend(ImageUtilsTestCase):
+    def test_parity_with_pil(self):
+        for mode in ("RGB", "RGBA", "L", "1"):
+            expected = self.save(noise_image((64, 48), mode, seed=1), f"{mode}_EXPECTED.png")
+            actual = self.save(noise_image((64, 48), mode, seed=2), f"{mode}_ACTUAL.png")
+            self.assertEqual(
+                image_utils.compare_images(expected, actual, backend=image_utils.BACKEND_PIL),
+                image_utils.compare_images(expected, actual, backend=image_utils.BACKEND_NUMPY),
+            )
+
+    def test_identical_images(self):
+        image = noise_image((32, 32))
+        expected = self.save(image, "same_EXPECTED.png")
+        actual = self.save(image, "same_ACTUAL.png")
+        self.assertEqual(image_utils.compare_images(expected, actual), 0.0)
+
+    def test_parity_with_size_mismatch(self):
+        expected = self.save(noise_image((40, 30), seed=3), "size_EXPECTED.png")
+        actual = self.save(noise_image((36, 32), seed=4), "size_ACTUAL.png")
+        self.assertEqual(
+            image_utils.compare_images(expected, actual, backend=image_utils.BACKEND_PIL),
+            image_utils.compare_images(expected, actual, backend=image_utils.BACKEND_NUMPY),
+        )
+
+    def test_mode_mismatch_raises(self):
+        expected = self.save(noise_image((8, 8), "RGB"), "mode_EXPECTED.png")
+        actual = self.save(noise_image((8, 8), "RGBA"), "mode_ACTUAL.png")
+        for backend in (image_utils.BACKEND_PIL, image_utils.BACKEND_NUMPY):
+            with self.assertRaises(ValueError):
+                image_utils.compare_images(expected, actual, backend=backend)
+
+
+class TestThresholdComparison(ImageUtilsTestCase):
+    def setUp(self):
+        super(TestThresholdComparison, self).setUp()
+        base = noise_image((64, 64), seed=5)
+        broken = base.copy()
+        broken.paste(noise_image((64, 8), seed=6), (0, 40))
+        self.expected = self.save(base, "strip_EXPECTED.png")
+        self.actual = self.save(broken, "strip_ACTUAL.png")
+
+    def test_same_verdict_as_exhaustive(self):
+        full = image_utils.compare_images(self.expected, self.actual)
+        for threshold in (0.0, full / 2, full, full * 2, 100.0):
+            result = image_utils.compare_within_threshold(
+                self.expected, self.actual, threshold, strip_height=4
+            )
+            self.assertEqual(result.passed, full <= threshold)
+
+    def test_exits_early_on_failure(self):
+        result = image_utils.compare_within_threshold(
+            self.expected, self.actual, 0.01, strip_height=4
+        )
+        self.assertFalse(result.passed)
+        self.assertTrue(result.early_exit)
+        self.assertEqual(result.rows_compared, 44)
+
+    def test_exits_early_on_pass(self):
+        result = image_utils.compare_within_threshold(
+            self.expected, self.actual, 99.0, strip_height=4
+        )
+        self.assertTrue(result.passed)
+        self.assertTrue(result.early_exit)
+        self.assertLess(result.rows_compared, result.rows_total)
+
+
+class TestImageCache(ImageUtilsTestCase):
+    def test_hits_and_misses(self):
+        cache = image_utils.ImageCache()
+        path = self.save(noise_image((16, 16)), "cache.png")
+        first = cache.get(path)
+        self.assertIs(cache.get(path), first)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_changed_file_is_not_stale(self):
+        cache = image_utils.ImageCache()
+        path = self.save(noise_image((16, 16), seed=1), "stale.png")
+        first = cache.get(path)
+        noise_image((16, 16), seed=2).save(path)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        second = cache.get(path)
+        self.assertIsNot(first, second)
+        self.assertEqual(second.tobytes(), noise_image((16, 16), seed=2).tobytes())
+        self.assertEqual(cache.stats()["entries"], 1)
+
+    def test_lru_eviction(self):
+        image_bytes = image_utils.image_nbytes(noise_image((16, 16)))
+        cache = image_utils.ImageCache(max_bytes=image_bytes * 2)
+        paths = [self.save(noise_image((16, 16), seed=i), f"lru{i}.png") for i in range(3)]
+        cache.get(paths[0])
+        cache.get(paths[1])
+        cache.get(paths[0])
+        cache.get(paths[2])
+        stats = cache.stats()
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["bytes"], image_bytes * 2)
+        cache.get(paths[0])
+        self.assertEqual(cache.stats()["hits"], 2)
+
+
+class TestCompareMany(ImageUtilsTestCase):
+    def setUp(self):
+        super(TestCompareMany, self).setUp()
+        self.pairs = []
+        for index in range(3):
+            expected = self.save(noise_image((16, 16), seed=index), f"{index}_EXPECTED.png")
+            actual = self.save(noise_image((16, 16), seed=index + 10), f"{index}_ACTUAL.png")
+            self.pairs.append((expected, actual))
+        self.pairs.append((self.pairs[0][0], os.path.join(self.temp_dir, "missing.png")))
+
+    def check_results(self, results):
+        self.assertEqual(len(results), len(self.pairs))
+        for pair in self.pairs[:-1]:
+            _, percentage_diff, error = results[pair]
+            self.assertIsNone(error)
+            self.assertEqual(percentage_diff, image_utils.compare_images(*pair))
+        _, percentage_diff, error = results[self.pairs[-1]]
+        self.assertIsNone(percentage_diff)
+        self.assertIsInstance(error, FileNotFoundError)
+
+    def test_serial(self):
+        self.check_results({r[0]: r for r in image_utils.compare_many(self.pairs, workers=1)})
+
+    def test_process_pool(self):
+        self.check_results({r[0]: r for r in image_utils.compare_many(self.pairs, workers=2)})
+
+
+class TestStreamingComparison(ImageUtilsTestCase):
+    def test_bands_match_full_decode(self):
+        for mode in ("L", "LA", "RGB", "RGBA"):
+            gradient = Image.linear_gradient("L").resize((70, 45))
+            image = Image.merge("RGBA", [gradient, noise_image((70, 45), "L"), gradient.rotate(90), gradient])
+            image = image.convert(mode)
+            path = self.save(image, f"bands_{mode}.png")
+            for band_height in (1, 7, 45, 100):
+                size, bands = image_utils.open_bands(path, band_height)
+                self.assertEqual(size, image.size)
+                decoded = b"".join(band.tobytes() for band in bands)
+                self.assertEqual(decoded, image.tobytes())
+
+    def test_same_metric_as_compare_images(self):
+        for extension in ("png", "bmp"):
+            expected = self.save(noise_image((50, 40), seed=1), f"stream_EXPECTED.{extension}")
+            actual = self.save(noise_image((50, 44), seed=2), f"stream_ACTUAL.{extension}")
+            self.assertEqual(
+                image_utils.compare_images_streaming(expected, actual, band_height=16),
+                image_utils.compare_images(expected, actual),
+            )
+
+
+class TestPyramidComparison(ImageUtilsTestCase):
+    def setUp(self):
+        super(TestPyramidComparison, self).setUp()
+        base = Image.linear_gradient("L").resize((128, 128)).convert("RGB")
+        self.expected = self.save(base, "pyramid_EXPECTED.png")
+        self.identical = self.save(base, "pyramid_ACTUAL.png")
+        broken = base.copy()
+        broken.paste((255, 0, 0), (0, 0, 64, 64))
+        self.broken = self.save(broken, "broken_ACTUAL.png")
+        speck = base.copy()
+        speck.paste((255, 0, 0), (60, 60, 64, 64))
+        self.speck = self.save(speck, "speck_ACTUAL.png")
+
+    def test_clear_failures_at_coarse_level(self):
+        result = image_utils.compare_images_pyramid(self.expected, self.broken, 0.1)
+        self.assertFalse(result.passed)
+        self.assertEqual(result.level, 8)
+        self.assertLessEqual(result.percentage_diff, image_utils.compare_images(self.expected, self.broken))
+
+    def test_passes_at_full_resolution(self):
+        result = image_utils.compare_images_pyramid(self.expected, self.identical, 0.1)
+        self.assertTrue(result.passed)
+        self.assertEqual(result.level, 1)
+        full = image_utils.compare_images(self.expected, self.speck)
+        result = image_utils.compare_images_pyramid(self.expected, self.speck, full, band=full)
+        self.assertEqual(result.level, 1)
+        self.assertTrue(result.passed)
+        self.assertEqual(result.percentage_diff, full)
+
+    def test_differences_cancelling_out_in_blocks(self):
+        # Inverted checkerboards and stripes shifted by half their period average to the same blocks
+        checkerboard = Image.new("L", (64, 64))
+        stripes = Image.new("L", (64, 64))
+        for x in range(64):
+            for y in range(64):
+                checkerboard.putpixel((x, y), 255 * ((x + y) % 2))
+                stripes.putpixel((x, y), 255 * (x % 8 < 4))
+        pairs = [
+            (checkerboard, ImageChops.invert(checkerboard)),
+            (stripes, ImageChops.offset(stripes, 4, 0)),
+        ]
+        for index, (expected, actual) in enumerate(pairs):
+            expected_path = self.save(expected.convert("RGB"), f"cancel{index}_EXPECTED.png")
+            actual_path = self.save(actual.convert("RGB"), f"cancel{index}_ACTUAL.png")
+            full = image_utils.compare_images(expected_path, actual_path)
+            self.assertGreater(full, 1)
+            for backend in self.backends():
+                result = image_utils.compare_images_pyramid(expected_path, actual_path, 1, backend=backend)
+                self.assertFalse(result.passed, backend)
+                self.assertLessEqual(result.percentage_diff, full)
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertFalse(
+                    image_utils.compare_and_assert(expected_path, actual_path, 1, "shaded", pyramid=True)
+                )
+
+    def test_rounding_does_not_fail_a_passing_pair(self):
+        # Every 8x8 block holds 32 pixels of 1 in one image and 31 in the other,
+        # block averages of 0.5 and 0.48 that Image.reduce rounds to 1 and 0
+        expected = Image.new("RGB", (64, 64))
+        actual = Image.new("RGB", (64, 64))
+        for left in range(0, 64, 8):
+            for top in range(0, 64, 8):
+                for index in range(32):
+                    position = (left + index % 8, top + index // 8)
+                    expected.putpixel(position, (1, 1, 1))
+                    if index < 31:
+                        actual.putpixel(position, (1, 1, 1))
+        expected_path = self.save(expected, "rounding_EXPECTED.png")
+        actual_path = self.save(actual, "rounding_ACTUAL.png")
+        self.assertLess(image_utils.compare_images(expected_path, actual_path), 0.1)
+
+        for backend in self.backends():
+            result = image_utils.compare_images_pyramid(expected_path, actual_path, 0.1, backend=backend)
+            self.assertTrue(result.passed, backend)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(image_utils.compare_and_assert(expected_path, actual_path, 0.1, "shaded", pyramid=True))
+
+
+class FakeMImage(object):
+    """Mimics the Maya MImage calls used by image_utils, rows stored bottom-up."""
+
+    def __init__(self, image):
+        self.image = image.convert("RGBA")
+
+    def getSize(self):
+        return list(self.image.size)
+
+    def pixels(self):
+        return self.image.transpose(Image.FLIP_TOP_BOTTOM).tobytes()
+
+
+class TestInMemoryImages(ImageUtilsTestCase):
+    def setUp(self):
+        super(TestInMemoryImages, self).setUp()
+        self.image = noise_image((24, 16), "RGBA", seed=7)
+        self.other = noise_image((24, 16), "RGBA", seed=8)
+        self.expected = self.save(self.image, "memory_EXPECTED.png")
+        self.actual = self.save(self.other, "memory_ACTUAL.png")
+        self.percentage_diff = image_utils.compare_images(self.expected, self.actual)
+
+    def test_pil_and_raw_images(self):
+        raw = image_utils.RawImage(bytearray(self.other.tobytes()), 24, 16, "RGBA")
+        for actual in (self.other, raw):
+            self.assertEqual(image_utils.compare_images(self.expected, actual), self.percentage_diff)
+            self.assertEqual(image_utils.compare_images(self.image, actual), self.percentage_diff)
+
+    @unittest.skipIf(image_utils.np is None, "numpy is not installed")
+    def test_numpy_array(self):
+        array = image_utils.np.asarray(self.other)
+        self.assertEqual(image_utils.compare_images(self.expected, array), self.percentage_diff)
+
+    def test_pil_image_keeps_owner_alive(self):
+        # A converted QImage is only referenced by the RawImage wrapping its bits
+        owner = FakeMImage(self.other)
+        owner_ref = weakref.ref(owner)
+        raw = image_utils.RawImage(bytearray(self.other.tobytes()), 24, 16, "RGBA", owner=owner)
+        image = raw.to_pil()
+        del owner, raw
+        self.assertIsNotNone(owner_ref())
+        self.assertEqual(image.tobytes(), self.other.tobytes())
+
+    def test_mimage_rows_are_flipped(self):
+        actual = image_utils.as_image(FakeMImage(self.other))
+        self.assertEqual(actual.tobytes(), self.other.tobytes())
+
+    def test_actual_saved_only_on_failure(self):
+        output_path = os.path.join(self.temp_dir, "failed_ACTUAL.png")
+        image_utils.compare_and_assert(self.expected, self.image, 0.1, "shaded", actual_output_path=output_path)
+        self.assertFalse(os.path.exists(output_path))
+        image_utils.compare_and_assert(self.expected, self.other, 0.1, "shaded", actual_output_path=output_path)
+        self.assertEqual(Image.open(output_path).tobytes(), self.other.tobytes())
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            image_utils.compare_images(self.expected, 42)
+
+
+class TestRegionComparison(ImageUtilsTestCase):
+    def setUp(self):
+        super(TestRegionComparison, self).setUp()
+        self.image = noise_image((60, 40), seed=11)
+        self.other = noise_image((60, 40), seed=12)
+        self.expected = self.save(self.image, "roi_EXPECTED.png")
+        self.actual = self.save(self.other, "roi_ACTUAL.png")
+
+    def crop_diff(self, box):
+        return image_utils.compare_images(self.image.crop(box), self.other.crop(box))
+
+    def test_region_matches_cropped_comparison(self):
+        box = (5, 10, 45, 30)
+        for backend in (image_utils.BACKEND_PIL, image_utils.default_backend()):
+            image_utils.image_cache.clear()
+            self.assertAlmostEqual(
+                image_utils.compare_images(self.expected, self.actual, backend=backend, region=box),
+                self.crop_diff(box),
+            )
+
+    @unittest.skipIf(image_utils.np is None, "numpy is not installed")
+    def test_numpy_region(self):
+        box = (5, 10, 45, 30)
+        for region in (image_utils.np.array(box), tuple(image_utils.np.int64(value) for value in box)):
+            self.assertAlmostEqual(
+                image_utils.compare_images(self.expected, self.actual, region=region), self.crop_diff(box)
+            )
+        self.assertAlmostEqual(
+            image_utils.compare_images(self.expected, self.actual, region=image_utils.np.array([box])),
+            self.crop_diff(box),
+        )
+
+    def test_mask_and_boxes(self):
+        mask = Image.new("L", (60, 40), 0)
+        mask.paste(255, (0, 0, 30, 40))
+        mask_path = self.save(mask, "roi_MASK.png")
+        for backend in (image_utils.BACKEND_PIL, image_utils.default_backend()):
+            self.assertAlmostEqual(
+                image_utils.compare_images(self.expected, self.actual, backend=backend, mask=mask_path),
+                self.crop_diff((0, 0, 30, 40)),
+            )
+            # Two boxes side by side select the same pixels as one box covering both
+            self.assertAlmostEqual(
+                image_utils.compare_images(
+                    self.expected, self.actual, backend=backend, region=[(0, 0, 10, 40), (10, 0, 30, 40)]
+                ),
+                self.crop_diff((0, 0, 30, 40)),
+            )
+
+    def test_selection_is_cached_per_reference(self):
+        mask_path = self.save(Image.new("L", (60, 40), 255), "roi_MASK.png")
+        first = image_utils.selection_for(self.expected, (60, 40), (0, 0, 10, 10), mask_path)
+        second = image_utils.selection_for(self.expected, (60, 40), (0, 0, 10, 10), mask_path)
+        self.assertIs(first, second)
+        self.assertEqual(first.count, 100)
+
+    def test_empty_selection(self):
+        self.assertEqual(
+            image_utils.compare_images(self.expected, self.actual, region=(100, 100, 120, 120)), 0.0
+        )
+
+    def test_unsupported_combinations_raise(self):
+        box = (0, 0, 10, 10)
+        for options in (
+            {"early_exit": True, "region": box},
+            {"pyramid": True, "region": box},
+            {"quick_reject": True, "region": box},
+            {"streaming": True, "region": box},
+            {"pyramid": True, "early_exit": True},
+            {"streaming": True, "tile_size": 16},
+            {"tile_size": 16, "region": box},
+        ):
+            with self.assertRaises(ValueError, msg=options):
+                image_utils.compare_and_assert(self.expected, self.actual, 0.1, "shaded", **options)
+
+
+class TestQuickRejectStages(ImageUtilsTestCase):
+    def setUp(self):
+        super(TestQuickRejectStages, self).setUp()
+        image_utils.reset_stage_counts()
+        self.image = noise_image((40, 30), seed=21)
+        self.expected = self.save(self.image, "stage_EXPECTED.png")
+
+    def test_identical_pair(self):
+        actual = self.save(self.image, "stage_ACTUAL.png")
+        result = image_utils.compare_with_stages(self.expected, actual, 0.1)
+        self.assertEqual(result.stage, image_utils.STAGE_IDENTICAL)
+        self.assertEqual(result.percentage_diff, 0.0)
+
+    def test_clearly_different_pair_is_rejected(self):
+        actual = self.save(Image.new("RGB", (40, 30), (255, 255, 255)), "white_ACTUAL.png")
+        result = image_utils.compare_with_stages(self.expected, actual, 0.1)
+        self.assertEqual(result.stage, image_utils.STAGE_REJECTED)
+        self.assertFalse(result.passed)
+        self.assertLessEqual(result.percentage_diff, image_utils.compare_images(self.expected, actual))
+
+    def test_shuffled_pixels_need_precise_stage(self):
+        # Same histogram, different layout: only the per-pixel metric can tell
+        actual = self.save(self.image.transpose(Image.FLIP_LEFT_RIGHT), "flip_ACTUAL.png")
+        full = image_utils.compare_images(self.expected, actual)
+        result = image_utils.compare_with_stages(self.expected, actual, full)
+        self.assertEqual(result.stage, image_utils.STAGE_PRECISE)
+        self.assertEqual(result.percentage_diff, full)
+        self.assertTrue(result.passed)
+
+    def test_summary_counts_stages(self):
+        actual = self.save(self.image, "stage_ACTUAL.png")
+        image_utils.compare_with_stages(self.expected, actual, 0.1)
+        image_utils.compare_with_stages(self.expected, actual, 0.1)
+        summary = image_utils.stage_summary()
+        self.assertEqual(summary[image_utils.STAGE_IDENTICAL], 2)
+        self.assertEqual(summary[image_utils.STAGE_PRECISE], 0)
+
+
+class TestMetrics(ImageUtilsTestCase):
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.image = Image.linear_gradient("L").resize((32, 32)).convert("RGB")
+        self.expected = self.save(self.image, "metric_EXPECTED.png")
+        changed = self.image.copy()
+        changed.putpixel((3, 4), (0, 0, 200))
+        changed.putpixel((10, 10), tuple(min(value + 4, 255) for value in changed.getpixel((10, 10))))
+        self.actual = self.save(changed, "metric_ACTUAL.png")
+
+    def test_mad_matches_compare_images(self):
+        self.assertEqual(
+            image_utils.compare_metric(self.expected, self.actual, "mad"),
+            image_utils.compare_images(self.expected, self.actual),
+        )
+
+    def test_max_delta_and_over_tolerance(self):
+        expected_delta = max(abs(a - b) for a, b in zip(self.image.getpixel((3, 4)), (0, 0, 200)))
+        for backend in self.backends():
+            expected = image_utils.load_image(self.expected)
+            actual = image_utils.load_image(self.actual)
+            self.assertAlmostEqual(
+                image_utils.max_channel_delta(expected, actual, backend), expected_delta / 2.55
+            )
+            # Only the first pixel differs by more than the default tolerance
+            self.assertAlmostEqual(
+                image_utils.pixels_over_tolerance(expected, actual, backend), 100.0 / 1024
+            )
+            self.assertAlmostEqual(
+                image_utils.pixels_over_tolerance(expected, actual, backend, tolerance=0), 200.0 / 1024
+            )
+
+    @unittest.skipIf(image_utils.np is None, "numpy is not installed")
+    def test_ssim(self):
+        self.assertEqual(image_utils.compare_metric(self.expected, self.expected, "ssim"), 0.0)
+        score = image_utils.compare_metric(self.expected, self.actual, "ssim")
+        self.assertGreater(score, 0.0)
+        self.assertLess(score, 100.0)
+
+    def test_results_are_cached(self):
+        calls = []
+
+        @image_utils.register_metric("counting", cost=100)
+        def counting(expected_image, actual_image, backend=None):
+            calls.append(1)
+            return 1.0
+
+        try:
+            image_utils.compare_metric(self.expected, self.actual, "counting")
+            image_utils.compare_metric(self.expected, self.actual, "counting")
+            self.assertEqual(len(calls), 1)
+        finally:
+            del image_utils.METRICS["counting"]
+
+    def test_select_metric(self):
+        self.assertEqual(image_utils.select_metric(), "max_delta")
+        self.assertEqual(image_utils.select_metric(["low_amplitude_noise"]), "over_tolerance")
+        with self.assertRaises(ValueError):
+            image_utils.select_metric(["everything"])
+
+    def test_compare_and_assert_with_metric(self):
+        self.assertFalse(image_utils.compare_and_assert(self.expected, self.actual, 0.1, "shaded", metric="max_delta"))
+        self.assertTrue(image_utils.compare_and_assert(self.expected, self.actual, 0.1, "shaded", metric="over_tolerance"))
+
+    def test_compare_and_assert_auto_metric(self):
+        self.assertFalse(image_utils.compare_and_assert(self.expected, self.actual, 0.1, "shaded", metric="auto"))
+        self.assertTrue(
+            image_utils.compare_and_assert(
+                self.expected, self.actual, 0.1, "shaded", metric="auto", robust_to=["low_amplitude_noise"]
+            )
+        )
+        # Every changed pixel counts without a tolerance
+        self.assertFalse(
+            image_utils.compare_and_assert(
+                self.expected, self.actual, 0.1, "shaded",
+                metric="auto", robust_to=["low_amplitude_noise"], metric_options={"tolerance": 0},
+            )
+        )
+        with self.assertRaises(ValueError):
+            image_utils.compare_and_assert(self.expected, self.actual, 0.1, "shaded", robust_to=["sparse_noise"])
+
+
+class TestDiffArtifacts(ImageUtilsTestCase):
+    def setUp(self):
+        super(TestDiffArtifacts, self).setUp()
+        self.image = Image.new("RGB", (16, 8), (100, 100, 100))
+        self.expected = self.save(self.image, "cube_EXPECTED.png")
+        self.changed = self.image.copy()
+        self.changed.putpixel((2, 3), (102, 100, 100))
+        self.diff_path = os.path.join(self.temp_dir, "cube_DIFF.png")
+        self.composite_path = os.path.join(self.temp_dir, "cube_COMPOSITE.png")
+
+    def test_heatmap_is_amplified(self):
+        heatmap = image_utils.diff_heatmap(self.image, self.changed, gain=64)
+        self.assertEqual(heatmap.size, (16, 8))
+        self.assertEqual(heatmap.getpixel((0, 0)), (0, 0, 0))
+        self.assertEqual(heatmap.getpixel((2, 3))[0], 255)
+
+    def test_artifacts_written_on_failure_only(self):
+        self.assertTrue(
+            image_utils.compare_and_assert(
+                self.expected, self.image, 0.1, "shaded",
+                diff_output_path=self.diff_path, composite_output_path=self.composite_path,
+            )
+        )
+        self.assertFalse(
+            image_utils.compare_and_assert(
+                self.expected, self.changed, 0.0, "shaded",
+                diff_output_path=self.diff_path, composite_output_path=self.composite_path,
+            )
+        )
+        # The in-memory actual was snapshotted, changing it must not affect the artifacts
+        self.changed.putpixel((2, 3), (100, 100, 100))
+        image_utils.artifact_writer.flush()
+        with Image.open(self.diff_path) as diff:
+            self.assertNotEqual(diff.getpixel((2, 3)), (0, 0, 0))
+        with Image.open(self.composite_path) as composite:
+            self.assertEqual(composite.size, (48, 8))
+
+    def test_no_artifacts_when_passing(self):
+        image_utils.compare_and_assert(self.expected, self.image, 0.1, "shaded", diff_output_path=self.diff_path)
+        image_utils.artifact_writer.flush()
+        self.assertFalse(os.path.exists(self.diff_path))
+
+    def test_no_artifacts_when_streaming(self):
+        actual = self.save(self.changed, "cube_ACTUAL.png")
+        self.assertFalse(
+            image_utils.compare_and_assert(
+                self.expected, actual, 0.0, "shaded", streaming=True, diff_output_path=self.diff_path
+            )
+        )
+        image_utils.artifact_writer.flush()
+        self.assertFalse(os.path.exists(self.diff_path))
+
+
+class TestDifferenceGrid(ImageUtilsTestCase):
+    def setUp(self):
+        super(TestDifferenceGrid, self).setUp()
+        self.expected = self.save(noise_image((100, 70), "RGB", seed=1), "grid_EXPECTED.png")
+        changed = noise_image((100, 70), "RGB", seed=1)
+        changed.paste((0, 0, 0), (70, 40, 80, 50))
+        self.actual = self.save(changed, "grid_ACTUAL.png")
+
+    def test_grid_matches_global_score(self):
+        for backend in self.backends():
+            grid = image_utils.compare_images_grid(self.expected, self.actual, tile_size=32, backend=backend)
+            self.assertEqual(len(grid.sums), 3)
+            self.assertEqual(len(grid.sums[0]), 4)
+            self.assertAlmostEqual(
+                grid.percentage_diff, image_utils.compare_images(self.expected, self.actual, backend=backend)
+            )
+
+    def test_hot_tiles(self):
+        for backend in self.backends():
+            grid = image_utils.compare_images_grid(self.expected, self.actual, tile_size=32, backend=backend)
+            boxes = [box for box, _ in grid.hot_tiles()]
+            # The change sits in the tile at column 2, row 1 only
+            self.assertEqual(boxes, [(64, 32, 96, 64)])
+            # Edge tiles are clipped to the image
+            self.assertEqual(grid.tile_box(3, 2), (96, 64, 100, 70))
+
+    def test_identical_grid(self):
+        grid = image_utils.compare_images_grid(self.expected, self.expected)
+        self.assertEqual(grid.percentage_diff, 0.0)
+        self.assertEqual(grid.hot_tiles(), [])
+
+    def test_failure_message_lists_hot_tiles(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            passed = image_utils.compare_and_assert(self.expected, self.actual, 0.0, "shaded", tile_size=32)
+        self.assertFalse(passed)
+        self.assertIn("Hot tiles: (64, 32, 96, 64)", output.getvalue())
+
+    def test_result_is_recorded(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            image_utils.compare_and_assert(self.expected, self.actual, 0.0, "shaded", tile_size=32)
+        result = results_manifest.lookup(self.expected, self.actual)
+        self.assertFalse(result["passed"])
+        self.assertEqual(result["metric"], image_utils.DEFAULT_METRIC)
+        self.assertAlmostEqual(result["score"], image_utils.compare_images(self.expected, self.actual))
+        self.assertEqual(result["hot_tiles"][0][0], [64, 32, 96, 64])
+        self.assertIn("(64, 32, 96, 64)", image_utils.format_hot_tiles(result["hot_tiles"]))
+
+        image_utils.set_record_results(False)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                image_utils.compare_and_assert(self.expected, self.expected, 0.0, "shaded")
+        finally:
+            image_utils.set_record_results(True)
+        self.assertIsNone(results_manifest.lookup(self.expected, self.expected))
+
+    def test_early_exit_score_is_not_exact(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            image_utils.compare_and_assert(self.expected, self.actual, 0.0, "shaded", early_exit=True)
+        result = results_manifest.lookup(self.expected, self.actual)
+        self.assertFalse(result["passed"])
+        self.assertFalse(result["exact"])
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            image_utils.compare_and_assert(self.expected, self.actual, 0.0, "shaded")
+        self.assertTrue(results_manifest.lookup(self.expected, self.actual)["exact"])
+
+
+class TestCompareSequences(ImageUtilsTestCase):
+    def setUp(self):
+        super(TestCompareSequences, self).setUp()
+        for frame in range(1, 7):
+            image = noise_image((16, 16), "RGB", seed=frame)
+            self.save(image, f"turntable_EXPECTED.{frame:04d}.png")
+            if frame == 4:
+                image.paste((0, 0, 0), (0, 0, 8, 8))
+            # Re-encoding at another level keeps the pixels but changes the bytes
+            actual = os.path.join(self.temp_dir, f"turntable_ACTUAL.{frame:04d}.png")
+            image.save(actual, compress_level=1 if frame == 5 else 6)
+        self.expected = os.path.join(self.temp_dir, "turntable_EXPECTED.####.png")
+        self.actual = os.path.join(self.temp_dir, "turntable_ACTUAL.%04d.png")
+
+    def test_find_frames(self):
+        frames = image_utils.find_frames(os.path.join(self.temp_dir, "turntable_EXPECTED.*.png"))
+        self.assertEqual(sorted(frames), [1, 2, 3, 4, 5, 6])
+        with self.assertRaises(ValueError):
+            image_utils.find_frames(os.path.join(self.temp_dir, "turntable.png"))
+
+    def test_per_frame_scores(self):
+        for workers in (1, 2):
+            result = image_utils.compare_sequences(self.expected, self.actual, 0.1, workers=workers)
+            self.assertEqual(sorted(result.scores), [1, 2, 3, 4, 5, 6])
+            self.assertEqual(result.skipped, [1, 2, 3, 6])
+            self.assertEqual(result.scores[5], 0.0)
+            self.assertEqual(result.failed_frames, [4])
+            self.assertFalse(result.passed)
+            self.assertFalse(result.stopped)
+
+    def test_stop_at_first_failure(self):
+        result = image_utils.compare_sequences(self.expected, self.actual, 0.1, stop_at_first_failure=True, workers=1)
+        self.assertTrue(result.stopped)
+        self.assertEqual(sorted(result.scores), [1, 2, 3, 4])
+
+    def test_missing_frames_fail(self):
+        os.remove(os.path.join(self.temp_dir, "turntable_ACTUAL.0006.png"))
+        result = image_utils.compare_sequences(self.expected, self.actual, 50.0, workers=1)
+        self.assertEqual(result.missing, [6])
+        self.assertEqual(result.failed_frames, [])
+        self.assertFalse(result.passed)
+
+
+class TestNormalizedComparison(ImageUtilsTestCase):
+    def setUp(self):
+        super(TestNormalizedComparison, self).setUp()
+        image_utils.normalized_cache.clear()
+        self.image = Image.linear_gradient("L").resize((100, 80)).convert("RGB")
+        self.expected = self.save(self.image, "panel_EXPECTED.png")
+
+    def test_common_mode(self):
+        self.assertEqual(image_utils.common_mode("RGB", "RGBA"), "RGBA")
+        self.assertEqual(image_utils.common_mode("L", "RGB"), "RGB")
+        self.assertEqual(image_utils.common_mode("L", "LA"), "LA")
+        self.assertEqual(image_utils.common_mode("RGBA", "RGBA"), "RGBA")
+
+    def test_mode_normalization(self):
+        actual = self.image.convert("RGBA")
+        with self.assertRaises(ValueError):
+            image_utils.compare_images(self.expected, actual)
+        self.assertEqual(image_utils.compare_images(self.expected, actual, normalize=image_utils.NORMALIZE_MODE), 0.0)
+
+    def test_size_normalization_is_cached(self):
+        actual = self.image.resize((98, 79), image_utils.DEFAULT_RESAMPLE)
+        for _ in range(2):
+            self.assertEqual(
+                image_utils.compare_images(self.expected, actual, normalize=image_utils.NORMALIZE_SIZE), 0.0
+            )
+        stats = image_utils.normalized_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 1, 1))
+
+        # Another target geometry is cached separately
+        other = self.image.resize((99, 80), image_utils.DEFAULT_RESAMPLE)
+        image_utils.compare_images(self.expected, other, normalize=image_utils.NORMALIZE_SIZE)
+        self.assertEqual(image_utils.normalized_cache.stats()["entries"], 2)
+
+    def test_size_change_limit(self):
+        with self.assertRaises(ValueError):
+            image_utils.compare_images(self.expected, self.image.resize((50, 40)), normalize=image_utils.NORMALIZE_SIZE)
+        # Only the mode is normalized, the overlapping area is compared as before
+        cropped = self.image.crop((0, 0, 98, 80))
+        self.assertEqual(
+            image_utils.compare_images(self.expected, cropped, normalize=image_utils.NORMALIZE_MODE),
+            image_utils.compare_images(self.expected, cropped),
+        )
+
+    def test_compare_and_assert(self):
+        actual = self.image.resize((98, 79), image_utils.DEFAULT_RESAMPLE).convert("RGBA")
+        self.assertTrue(
+            image_utils.compare_and_assert(self.expected, actual, 0.1, "shaded", normalize=image_utils.NORMALIZE_SIZE)
+        )
+        with self.assertRaises(ValueError):
+            image_utils.compare_and_assert(self.expected, actual, 0.1, "shaded", metric="mad", normalize="size")
+
+
+class TestFindImagePairs(ImageUtilsTestCase):
+    def touch(self, *names):
+        for name in names:
+            open(os.path.join(self.temp_dir, name), "wb").close()
+
+    def test_groups_by_prefix_in_variant_order(self):
+        self.touch(
+            "cube_EXPECTED.png", "cube_DIFF.png", "cube_ACTUAL.png",
+            "sphere_ACTUAL.png", "sphere_EXPECTED.png",
+            "lonely_ACTUAL.png", "notes_ACTUAL.txt", "notes_EXPECTED.txt",
+        )
+        os.mkdir(os.path.join(self.temp_dir, "cone_ACTUAL.png"))
+        self.touch("cone_EXPECTED.png")
+        pairs = image_utils.find_image_pairs(self.temp_dir)
+        names = [[os.path.basename(path) for path in pair] for pair in pairs]
+        self.assertEqual(
+            names,
+            [
+                ["cube_ACTUAL.png", "cube_EXPECTED.png", "cube_DIFF.png"],
+                ["sphere_ACTUAL.png", "sphere_EXPECTED.png"],
+            ],
+        )
+
+    def test_extra_names(self):
+        self.touch("cube_ACTUAL.png")
+        pairs = image_utils.find_image_pairs(self.temp_dir, ["cube_EXPECTED.png", "cube_ACTUAL.png"])
+        self.assertEqual(
+            pairs,
+            [[os.path.join(self.temp_dir, "cube_ACTUAL.png"), os.path.join(self.temp_dir, "cube_EXPECTED.png")]],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
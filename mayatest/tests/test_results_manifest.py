@@ -0,0 +1,91 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mayatest import results_manifest
+
+
+class TestResultsManifest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.expected = self.write("cube_EXPECTED.png", b"expected")
+        self.actual = self.write("cube_ACTUAL.png", b"actual")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def write(self, name, data):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def manifest_lines(self):
+        with open(results_manifest.manifest_path(self.temp_dir)) as f:
+            return f.readlines()
+
+    def test_record_and_lookup(self):
+        self.assertIsNone(results_manifest.lookup(self.expected, self.actual))
+        results_manifest.record(self.expected, self.actual, "mad", 0.5, 0.1, False, [((0, 0, 8, 8), 4.0)])
+        result = results_manifest.lookup(self.expected, self.actual)
+        self.assertEqual(result["score"], 0.5)
+        self.assertFalse(result["passed"])
+        self.assertEqual(result["hot_tiles"], [[[0, 0, 8, 8], 4.0]])
+        # A pair is found whichever image is passed first
+        self.assertEqual(results_manifest.lookup(self.actual, self.expected), result)
+
+    def test_latest_result_wins(self):
+        results_manifest.record(self.expected, self.actual, "mad", 0.5, 0.1, False)
+        results_manifest.record(self.expected, self.actual, "mad", 0.05, 0.1, True)
+        self.assertTrue(results_manifest.lookup(self.expected, self.actual)["passed"])
+
+    def test_changed_file_invalidates_result(self):
+        results_manifest.record(self.expected, self.actual, "mad", 0.0, 0.1, True)
+        stats = [results_manifest.file_stat(self.expected), results_manifest.file_stat(self.actual)]
+        self.assertIsNotNone(results_manifest.lookup(self.expected, self.actual, stats))
+        self.write("cube_ACTUAL.png", b"rewritten actual")
+        self.assertIsNone(results_manifest.lookup(self.expected, self.actual))
+
+    def test_truncated_line_is_skipped(self):
+        results_manifest.record(self.expected, self.actual, "mad", 0.0, 0.1, True)
+        with open(results_manifest.manifest_path(self.temp_dir), "a") as f:
+            f.write('{"version": 2, "expected": ')
+        manifest = results_manifest.ResultsManifest(self.temp_dir)
+        self.assertEqual(len(manifest.results), 1)
+
+    def test_compact(self):
+        other = self.write("sphere_ACTUAL.png", b"other")
+        for score in (0.3, 0.2, 0.1):
+            results_manifest.record(self.expected, self.actual, "mad", score, 0.1, score <= 0.1)
+        results_manifest.record(self.expected, other, "mad", 1.0, 0.1, False)
+        self.assertEqual(len(self.manifest_lines()), 4)
+
+        self.assertGreaterEqual(results_manifest.compact_recorded(), 1)
+        lines = [json.loads(line) for line in self.manifest_lines()]
+        self.assertEqual(sorted(result["score"] for result in lines), [0.1, 1.0])
+        self.assertEqual(results_manifest.lookup(self.expected, self.actual)["score"], 0.1)
+        # Nothing left to drop
+        self.assertFalse(results_manifest.ResultsManifest(self.temp_dir).compact())
+
+    def test_compact_drops_deleted_images(self):
+        capture_dir = os.path.join(self.temp_dir, "captures")
+        os.makedirs(capture_dir)
+        capture = os.path.join(capture_dir, "cube_ACTUAL.png")
+        with open(capture, "wb") as f:
+            f.write(b"capture")
+        results_manifest.record(self.expected, capture, "mad", 0.0, 0.1, True)
+        # Results are kept next to the actual image, not in the reference directory
+        self.assertFalse(os.path.exists(results_manifest.manifest_path(self.temp_dir)))
+        self.assertTrue(os.path.exists(results_manifest.manifest_path(capture_dir)))
+
+        results_manifest.record(self.expected, self.actual, "mad", 0.0, 0.1, True)
+        os.remove(self.actual)
+        results_manifest.compact_recorded()
+        self.assertFalse(os.path.exists(results_manifest.manifest_path(self.temp_dir)))
+        self.assertIsNotNone(results_manifest.lookup(self.expected, capture))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image  # type: ignore
+
+from mayatest import thumbnail_cache
+
+
+class TestThumbnailCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.temp_dir, "cube_EXPECTED.png")
+        Image.linear_gradient("L").resize((400, 300)).convert("RGB").save(self.source)
+        self.cache = thumbnail_cache.ThumbnailCache(os.path.join(self.temp_dir, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_thumbnail_is_cached(self):
+        image, full_size = self.cache.thumbnail(self.source, 100, 100)
+        self.assertEqual(image.size, (100, 75))
+        self.assertEqual(full_size, (400, 300))
+        self.assertEqual(self.cache.misses, 1)
+
+        cached, full_size = self.cache.thumbnail(self.source, 100, 100)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(full_size, (400, 300))
+        self.assertEqual(cached.tobytes(), image.tobytes())
+
+    def test_thumbnail_returned_when_cache_is_not_writable(self):
+        # A file where the cache directory should be makes every write fail
+        blocked = os.path.join(self.temp_dir, "blocked")
+        open(blocked, "w").close()
+        cache = thumbnail_cache.ThumbnailCache(blocked)
+        with contextlib.redirect_stdout(io.StringIO()):
+            image, full_size = cache.thumbnail(self.source, 100, 100)
+        self.assertEqual(image.size, (100, 75))
+        self.assertEqual(full_size, (400, 300))
+
+    def test_key_covers_source_and_dimensions(self):
+        path = self.cache.path(self.source, 100, 100)
+        self.assertNotEqual(path, self.cache.path(self.source, 50, 50))
+        Image.new("RGB", (10, 10)).save(self.source)
+        stat = os.stat(self.source)
+        os.utime(self.source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        self.assertNotEqual(path, self.cache.path(self.source, 100, 100))
+
+    def test_stale_thumbnail_is_regenerated(self):
+        self.cache.thumbnail(self.source, 100, 100)
+        Image.new("RGB", (40, 40), (255, 0, 0)).save(self.source)
+        stat = os.stat(self.source)
+        os.utime(self.source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        image, full_size = self.cache.thumbnail(self.source, 100, 100)
+        self.assertEqual(full_size, (40, 40))
+        self.assertEqual(image.getpixel((0, 0)), (255, 0, 0))
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_cleanup_removes_least_recently_used(self):
+        sources = []
+        for index in range(4):
+            source = os.path.join(self.temp_dir, f"shot{index}_EXPECTED.png")
+            Image.effect_noise((64, 64), 64).save(source)
+            sources.append(source)
+            self.cache.thumbnail(source, 64, 64)
+            # Spread the access times so the LRU order is unambiguous
+            path = self.cache.path(source, 64, 64)
+            os.utime(path, ns=(index * 10 ** 9, index * 10 ** 9))
+        # Reading the oldest thumbnail makes it the most recently used
+        self.assertIsNotNone(self.cache.get(sources[0], 64, 64))
+
+        size = os.path.getsize(self.cache.path(sources[1], 64, 64))
+        removed = self.cache.cleanup(max_bytes=size * 3)
+        self.assertGreaterEqual(removed, 1)
+        self.assertIsNone(self.cache.get(sources[1], 64, 64))
+        self.assertIsNotNone(self.cache.get(sources[0], 64, 64))
+        self.assertIsNotNone(self.cache.get(sources[3], 64, 64))
+
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(sources[3], 64, 64))
+
+
+if __name__ == "__main__":
+    unittest.main()
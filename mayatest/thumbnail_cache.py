@@ -0,0 +1,185 @@
+"""
+Persistent on-disk cache of contact sheet thumbnails.
+
+Thumbnails are stored as small PNGs named by a hash of the source path, its
+mtime and size and the thumbnail dimensions, so a source that changes simply
+misses the cache and gets a new thumbnail. The full size of the source is kept
+in a PNG text chunk for callers that map positions back onto the source.
+Reading a thumbnail marks it as recently used, and once the directory grows
+past its size cap the least recently used thumbnails are deleted.
+
+Example:
+cache = ThumbnailCache()
+image, full_size = cache.thumbnail(path, 200, 200)
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from PIL import Image, PngImagePlugin  # type: ignore
+
+# Environment variable overriding the default cache directory
+CACHE_DIR_VAR = "MAYATEST_THUMBNAIL_CACHE"
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# Writes between two size checks, and the fraction of the cap a cleanup frees down to
+CLEANUP_INTERVAL = 64
+CLEANUP_TARGET = 0.9
+
+THUMBNAIL_EXTENSION = ".png"
+# PNG text chunk holding the "width height" of the source image
+SIZE_KEY = "mayatest.size"
+
+
+def default_directory():
+    '''Return the thumbnail cache directory, from MAYATEST_THUMBNAIL_CACHE if it is set.'''
+    return os.environ.get(CACHE_DIR_VAR) or os.path.join(tempfile.gettempdir(), "mayatest_thumbnails")
+
+
+def read_full_size(text):
+    '''Return the source (width, height) stored in a thumbnail's text chunk, or None.'''
+    try:
+        width, height = text.split()
+        return int(width), int(height)
+    except (AttributeError, ValueError):
+        return None
+
+
+class ThumbnailCache(object):
+    """A directory of thumbnails keyed by source path, mtime, size and thumbnail dimensions.
+
+    @param directory: Cache directory. Defaults to default_directory().
+    @param max_bytes: Size cap of the directory, older thumbnails are deleted past it.
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or default_directory()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def path(self, source_path, width, height, stat=None):
+        '''Return where the thumbnail of the current version of a source is stored.'''
+        source_path = os.path.abspath(source_path)
+        stat = stat or os.stat(source_path)
+        key = f"{source_path}\0{stat.st_mtime_ns}\0{stat.st_size}\0{width}x{height}"
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        # Shard by the first byte so no folder holds every thumbnail
+        return os.path.join(self.directory, digest[:2], digest + THUMBNAIL_EXTENSION)
+
+    def get(self, source_path, width, height, stat=None):
+        '''Return the path of an up to date cached thumbnail, or None.'''
+        path = self.path(source_path, width, height, stat)
+        try:
+            # Reading marks the thumbnail as recently used for cleanup
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def write(self, source_path, width, height, save, stat=None):
+        '''Store a thumbnail written by save(path) and return its path.
+
+        save must write a PNG to the path it is given, e.g. a bound QImage.save.
+        '''
+        path = self.path(source_path, width, height, stat)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            save(temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        with self._lock:
+            self._writes += 1
+            cleanup = self._writes % CLEANUP_INTERVAL == 0
+        if cleanup:
+            self.cleanup()
+        return path
+
+    def put(self, source_path, width, height, image, full_size, stat=None):
+        '''Store a PIL thumbnail together with the full size of its source and return its path.'''
+        info = PngImagePlugin.PngInfo()
+        info.add_text(SIZE_KEY, f"{full_size[0]} {full_size[1]}")
+        return self.write(
+            source_path, width, height, lambda path: image.save(path, "PNG", pnginfo=info), stat
+        )
+
+    def thumbnail(self, source_path, width, height):
+        '''Return (PIL thumbnail, full source size), from the cache or decoded and stored.
+
+        This is how the contact sheet reads its thumbnails. A thumbnail that
+        cannot be stored is still returned, it is just decoded again next time.
+        '''
+        stat = os.stat(source_path)
+        path = self.get(source_path, width, height, stat)
+        if path is not None:
+            with Image.open(path) as image:
+                image.load()
+            full_size = read_full_size(image.text.get(SIZE_KEY))
+            if full_size is not None:
+                return image, full_size
+
+        with Image.open(source_path) as image:
+            full_size = image.size
+            # Lets JPEGs decode at a fraction of their size
+            image.draft("RGB", (width, height))
+            image.thumbnail((width, height))
+            # thumbnail() leaves images that already fit unloaded
+            image.load()
+        try:
+            self.put(source_path, width, height, image, full_size, stat)
+        except OSError as e:
+            print(f"Failed to cache thumbnail of {source_path}. Error: {str(e)}")
+        return image, full_size
+
+    def cleanup(self, max_bytes=None):
+        '''Delete the least recently used thumbnails until the directory fits its cap.
+
+        Returns the number of deleted thumbnails.
+        '''
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        files = []
+        total = 0
+        try:
+            shards = os.scandir(self.directory)
+        except OSError:
+            return 0
+        with shards:
+            for shard in shards:
+                if not shard.is_dir():
+                    continue
+                with os.scandir(shard.path) as entries:
+                    for entry in entries:
+                        if not entry.name.endswith(THUMBNAIL_EXTENSION):
+                            continue
+                        stat = entry.stat()
+                        files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                        total += stat.st_size
+        if total <= max_bytes:
+            return 0
+
+        removed = 0
+        target = max_bytes * CLEANUP_TARGET
+        for _, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        '''Delete every cached thumbnail.'''
+        return self.cleanup(0)